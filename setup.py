@@ -15,6 +15,14 @@ setup(
         'vumi',
         'Twisted>=13.1.0',
     ],
+    extras_require={
+        'lxml': ['lxml'],
+    },
+    entry_points={
+        'console_scripts': [
+            'vxblastsms-replay = vxblastsms.replay:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
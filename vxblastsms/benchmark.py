@@ -0,0 +1,557 @@
+"""
+Benchmarks for the BlastSMS USSD transport.
+
+Run with ``python -m vxblastsms.benchmark``. Results are written as JSON so
+that runs against different releases can be compared.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from StringIO import StringIO
+from xml.dom import minidom
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
+from twisted.internet.task import react
+from twisted.python import log
+
+import vxblastsms
+from vxblastsms.codec import (
+    CODECS, DecodeError, XmlCodec, decode_request, encode_response,
+    encode_response_dom)
+from vxblastsms.harness import TransportHarness, send_all, summarise_results
+from vxblastsms.replycache import ReplyCache
+
+
+RESPONSE_VALUES = {
+    'msisdn': u'27123456789',
+    'sessionid': u'1234567890',
+    'appid': u'test_app_id',
+    'type': u'2',
+    'msg': (u'Welcome to the service.\n1. Check balance\n'
+            u'2. Buy airtime & data\n3. Help'),
+}
+
+REQUEST_FIELDS = set(['msisdn', 'shortcode', 'sessionid', 'type', 'msg',
+                      'appid'])
+MAX_REQUEST_SIZE = 8192
+
+
+def make_request_body(msisdn='27123456789', shortcode='*120*1234#',
+                      sessionid='1234567890', type='2', msg='1', appid=None,
+                      extra=''):
+    """
+    Build a BlastSMS request body the same way the transport tests do,
+    optionally with ``extra`` markup before the closing tag.
+    """
+    e_ussdresp = Element('ussdresp')
+    for field, value in [('msisdn', msisdn), ('shortcode', shortcode),
+                         ('sessionid', sessionid), ('type', type),
+                         ('msg', msg), ('appid', appid)]:
+        SubElement(e_ussdresp, field).text = value
+    body = minidom.parseString(
+        tostring(e_ussdresp, encoding='utf-8')).toxml(encoding='utf-8')
+    return body.replace('</ussdresp>', extra + '</ussdresp>')
+
+
+REQUEST_BODIES = {
+    'normal': make_request_body(),
+    'large_msg': make_request_body(msg='x' * 8000),
+    'huge_msg': make_request_body(msg='x' * (1024 * 1024)),
+    'deep_nesting': make_request_body(
+        extra='<a>' * 1000 + '</a>' * 1000),
+    'trailing_junk': make_request_body(extra='<junk>x</junk>' * 500),
+}
+
+
+def time_per_call(func, number):
+    """
+    Return the best per call time in microseconds of three runs of
+    ``number`` calls to ``func``.
+    """
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    return best / number * 1e6
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_objects():
+    gc.collect()
+    return len(gc.get_objects())
+
+
+def bench_encode(args):
+    """
+    Compare the DOM based and the direct ``<ussdresp>`` encoders, and the
+    direct encoder with a warm reply cache.
+    """
+    reply_cache = ReplyCache()
+
+    def dom():
+        encode_response_dom(**RESPONSE_VALUES)
+
+    def direct():
+        encode_response(**RESPONSE_VALUES)
+
+    def cached():
+        reply_cache.encode(**RESPONSE_VALUES)
+
+    before = time_per_call(dom, args.number)
+    after = time_per_call(direct, args.number)
+    cached_after = time_per_call(cached, args.number)
+    return {
+        'encode_response_dom_us': before,
+        'encode_response_us': after,
+        'reply_cache_hit_us': cached_after,
+        'speedup': before / after,
+        'reply_cache_speedup': after / cached_after,
+    }
+
+
+def decode_request_etree(body):
+    """The original ``ElementTree`` based request decoder."""
+    req_data = {}
+    root = ElementTree.fromstring(body.read())
+    for subel in root:
+        if subel.text is not None:
+            req_data[subel.tag] = subel.text
+    return req_data
+
+
+def bench_decode(args):
+    """
+    Compare the ``ElementTree`` and the streaming request decoders on
+    normal and pathological request bodies.
+    """
+    results = {}
+    for name, body in sorted(REQUEST_BODIES.iteritems()):
+        iterations = max(1, args.number * 300 / len(body))
+
+        def etree():
+            decode_request_etree(StringIO(body))
+
+        def strict():
+            try:
+                decode_request(StringIO(body), MAX_REQUEST_SIZE)
+            except DecodeError:
+                pass
+
+        def permissive():
+            try:
+                decode_request(
+                    StringIO(body), MAX_REQUEST_SIZE, REQUEST_FIELDS)
+            except DecodeError:
+                pass
+
+        results[name] = {
+            'size': len(body),
+            'etree_us': time_per_call(etree, iterations),
+            'decode_request_us': time_per_call(strict, iterations),
+            'decode_request_permissive_us': time_per_call(
+                permissive, iterations),
+        }
+    return results
+
+
+def bench_codecs(args):
+    """
+    Compare the wire codecs side by side: encoding a reply, encoding one
+    with a warm reply cache, and decoding normal and large requests.
+    """
+    results = {}
+    for name, codec_class in sorted(CODECS.iteritems()):
+        codec = codec_class()
+        reply_cache = ReplyCache(codec=codec)
+
+        def encode():
+            codec.encode_response(**RESPONSE_VALUES)
+
+        def cached():
+            reply_cache.encode(**RESPONSE_VALUES)
+
+        result = {
+            'encode_response_us': time_per_call(encode, args.number),
+            'reply_cache_hit_us': time_per_call(cached, args.number),
+        }
+        for body_name in ('normal', 'large_msg'):
+            body = REQUEST_BODIES[body_name]
+            iterations = max(1, args.number * 300 / len(body))
+
+            def decode():
+                codec.decode_request(StringIO(body), MAX_REQUEST_SIZE)
+
+            result['decode_%s_us' % (body_name,)] = time_per_call(
+                decode, iterations)
+        results[name] = result
+    return results
+
+
+def calibrate(number):
+    """
+    Time a fixed piece of pure Python work, so that timings can be
+    compared across machines as multiples of it.
+    """
+    data = [(i * 7919) % 1009 for i in xrange(200)]
+
+    def work():
+        sorted(data)
+        ''.join(str(value) for value in data[:50])
+
+    return time_per_call(work, number)
+
+
+def allocations_per_call(func, number):
+    """
+    Return the average number of objects tracked by the garbage collector
+    that each of ``number`` calls to ``func`` leaves allocated, after a
+    warm up call. Objects freed before the call returns aren't counted, so
+    this catches leaks and caches that grow rather than garbage.
+    """
+    func()
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in xrange(number):
+            func()
+        after = gc.get_count()[0]
+    finally:
+        if enabled:
+            gc.enable()
+    return float(after - before) / number
+
+
+def get_regression_paths():
+    """The message handling paths checked for performance regressions."""
+    codec = XmlCodec()
+    reply_cache = ReplyCache(codec=codec)
+    body = REQUEST_BODIES['normal']
+    large_body = REQUEST_BODIES['large_msg']
+    return {
+        'decode_request': lambda: codec.decode_request(
+            StringIO(body), MAX_REQUEST_SIZE, REQUEST_FIELDS),
+        'decode_request_strict': lambda: codec.decode_request(
+            StringIO(body), MAX_REQUEST_SIZE),
+        'decode_large_request': lambda: codec.decode_request(
+            StringIO(large_body), MAX_REQUEST_SIZE, REQUEST_FIELDS),
+        'encode_response': lambda: codec.encode_response(**RESPONSE_VALUES),
+        'reply_cache_hit': lambda: reply_cache.encode(**RESPONSE_VALUES),
+    }
+
+
+def bench_regression(args):
+    """
+    Measure the time and allocations of each call on the message handling
+    paths. Times are also given relative to :func:`calibrate`, which is
+    what :func:`find_regressions` compares.
+    """
+    calibration = calibrate(args.number)
+    results = {'calibration_us': calibration, 'paths': {}}
+    for name, func in sorted(get_regression_paths().iteritems()):
+        call_time = time_per_call(func, args.number)
+        results['paths'][name] = {
+            'time_us': call_time,
+            'relative_time': call_time / calibration,
+            'allocations': allocations_per_call(func, args.number),
+        }
+    return results
+
+
+def find_regressions(results, baseline, time_tolerance=2.0,
+                     allocation_tolerance=0.1):
+    """
+    Compare :func:`bench_regression` results with a baseline run of it.
+    Returns a description of every path that got more than
+    ``time_tolerance`` times slower relative to the calibration, or
+    leaves more than ``allocation_tolerance`` more objects allocated per
+    call. Times aren't compared if ``time_tolerance`` is ``None``.
+    """
+    regressions = []
+    for name, expected in sorted(baseline['paths'].iteritems()):
+        actual = results['paths'].get(name)
+        if actual is None:
+            continue
+        if (time_tolerance is not None and actual['relative_time'] >
+                expected['relative_time'] * time_tolerance):
+            regressions.append(
+                '%s takes %.1f times the calibration, baseline %.1f' % (
+                    name, actual['relative_time'],
+                    expected['relative_time']))
+        if (actual['allocations'] >
+                expected['allocations'] + allocation_tolerance):
+            regressions.append(
+                '%s leaves %.2f objects allocated per call, baseline %.2f' % (
+                    name, actual['allocations'], expected['allocations']))
+    return regressions
+
+
+def make_session_bodies(sessions, steps=3):
+    """
+    Build request bodies for ``sessions`` sessions, each made up of a new
+    session request, ``steps - 1`` responses and a release, interleaved
+    so that every session is in flight at once.
+    """
+    bodies = []
+    for step in range(steps + 1):
+        if step == 0:
+            request_type, msg = '1', None
+        elif step == steps:
+            request_type, msg = '3', None
+        else:
+            request_type, msg = '2', str(step)
+        for session in range(sessions):
+            bodies.append(make_request_body(
+                msisdn='2771%07d' % (session,),
+                sessionid='benchmark-%d' % (session,),
+                type=request_type, msg=msg))
+    return bodies
+
+
+@inlineCallbacks
+def run_load(harness, bodies, concurrency):
+    """
+    Send ``bodies`` to ``harness`` with at most ``concurrency`` requests
+    open at a time and return throughput, latency and memory figures.
+    """
+    objects_before = count_objects()
+    rss_before = max_rss_kb()
+    cpu_before = cpu_seconds()
+    start = time.time()
+    results = yield send_all(harness, bodies, concurrency)
+    duration = time.time() - start
+    cpu = cpu_seconds() - cpu_before
+    yield harness.wait_idle()
+    rss_after = max_rss_kb()
+    objects_after = count_objects()
+
+    result = summarise_results(results, duration)
+    result.update({
+        'concurrency': concurrency,
+        'cpu_s': cpu,
+        'max_rss_growth_kb': rss_after - rss_before,
+        'gc_objects_growth': objects_after - objects_before,
+    })
+    returnValue(result)
+
+
+@inlineCallbacks
+def bench_load(args):
+    """
+    Drive the transport with concurrent simulated BlastSMS sessions
+    answered by an in-process echo application.
+    """
+    harness = TransportHarness()
+    yield harness.start()
+    try:
+        # Warm up so that one-off allocations don't count as growth.
+        yield run_load(harness, make_session_bodies(100), args.concurrency)
+        result = yield run_load(
+            harness, make_session_bodies(args.sessions), args.concurrency)
+    finally:
+        yield harness.stop()
+    returnValue(result)
+
+
+class TextLogObserver(object):
+    """
+    A log observer that formats every event like a log file observer
+    would, without the cost of writing it anywhere.
+    """
+
+    def __init__(self):
+        self.events = 0
+
+    def __call__(self, event):
+        log.textFromEventDict(event)
+        self.events += 1
+
+
+# Transport configs the logging benchmark compares. Logging is off in the
+# baseline.
+LOGGING_CONFIGS = [
+    ('off', {'message_log_level': 'warning'}),
+    ('info', {'message_log_level': 'info'}),
+    ('info_redacted', {
+        'message_log_level': 'info',
+        'message_log_redact': True,
+    }),
+    ('info_sampled', {
+        'message_log_level': 'info',
+        'message_log_sample_rate': 100,
+    }),
+]
+
+
+@inlineCallbacks
+def bench_logging(args):
+    """
+    Measure the share of the transport's CPU time that goes to logging by
+    running the load benchmark with each of ``LOGGING_CONFIGS``.
+    """
+    observer = TextLogObserver()
+    log.addObserver(observer)
+    results = {}
+    try:
+        for name, config in LOGGING_CONFIGS:
+            harness = TransportHarness(config)
+            yield harness.start()
+            try:
+                yield run_load(
+                    harness, make_session_bodies(100), args.concurrency)
+                events_before = observer.events
+                result = yield run_load(
+                    harness, make_session_bodies(args.sessions),
+                    args.concurrency)
+            finally:
+                yield harness.stop()
+            results[name] = {
+                'cpu_s': result['cpu_s'],
+                'throughput_rps': result['throughput_rps'],
+                'log_events': observer.events - events_before,
+            }
+    finally:
+        log.removeObserver(observer)
+
+    baseline = results['off']['cpu_s']
+    for result in results.itervalues():
+        result['logging_cpu_share'] = (
+            (result['cpu_s'] - baseline) / result['cpu_s'])
+    returnValue(results)
+
+
+@inlineCallbacks
+def time_to_first_reply(transport_config, body):
+    """
+    Start a transport and send it ``body``. Returns the started harness
+    and the seconds from starting it until the reply arrived.
+    """
+    # Don't count collecting what earlier runs left behind.
+    gc.collect()
+    start = time.time()
+    harness = TransportHarness(transport_config)
+    yield harness.start()
+    code, _, _ = yield harness.request(body)
+    if code != 200:
+        raise RuntimeError('Restarted transport replied with %s.' % (code,))
+    returnValue((harness, time.time() - start))
+
+
+@inlineCallbacks
+def bench_restart(args):
+    """
+    Measure a rolling restart: how long draining a transport with a
+    request open in every session takes, and how long until a new
+    transport serves traffic again, with and without loading the old
+    one's sessions.
+    """
+    snapshot_dir = tempfile.mkdtemp(prefix='vxblastsms-sessions-')
+    snapshot_file = os.path.join(snapshot_dir, 'sessions.json')
+    transport_config = {'session_snapshot_file': snapshot_file}
+    bodies = make_session_bodies(args.sessions)
+    sessions = args.sessions
+    results = {'sessions': sessions}
+    try:
+        harness = TransportHarness(transport_config)
+        yield harness.start()
+        yield send_all(harness, bodies[:sessions * 2], args.concurrency)
+        for body in bodies[sessions * 2:sessions * 3]:
+            harness.request(body)
+        start = time.time()
+        yield harness.transport.start_drain()
+        results['drain_ms'] = (time.time() - start) * 1000
+        yield harness.wait_idle()
+        yield harness.stop()
+
+        # The next request in the first session.
+        next_body = bodies[sessions * 2]
+        harness, restart = yield time_to_first_reply(
+            transport_config, next_body)
+        results['warm_restart_ms'] = restart * 1000
+        results['restored_sessions'] = harness.transport.restored_sessions
+        yield harness.stop()
+
+        harness, restart = yield time_to_first_reply({}, next_body)
+        results['cold_restart_ms'] = restart * 1000
+        yield harness.stop()
+    finally:
+        shutil.rmtree(snapshot_dir)
+    returnValue(results)
+
+
+BENCHMARKS = {
+    'codecs': bench_codecs,
+    'decode': bench_decode,
+    'encode': bench_encode,
+    'load': bench_load,
+    'logging': bench_logging,
+    'regression': bench_regression,
+    'restart': bench_restart,
+}
+
+
+@inlineCallbacks
+def run_benchmarks(reactor, args):
+    results = {
+        'vxblastsms_version': vxblastsms.__version__,
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'benchmarks': {},
+    }
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        results['benchmarks'][name] = yield maybeDeferred(
+            BENCHMARKS[name], args)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(
+        results, output, indent=2, sort_keys=True, separators=(',', ': '))
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the BlastSMS USSD transport.')
+    parser.add_argument(
+        'benchmarks', nargs='*', metavar='BENCHMARK',
+        help='Benchmarks to run, one of %s. Defaults to all of them.' % (
+            ', '.join(sorted(BENCHMARKS)),))
+    parser.add_argument(
+        '--number', type=int, default=10000,
+        help='Number of iterations per timing run of the codec benchmarks.')
+    parser.add_argument(
+        '--sessions', type=int, default=2000,
+        help='Number of simulated sessions for the load benchmark.')
+    parser.add_argument(
+        '--concurrency', type=int, default=1000,
+        help='Maximum number of open requests in the load benchmark.')
+    parser.add_argument(
+        '--output', metavar='FILE',
+        help='Write the JSON results to FILE instead of standard output.')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % (', '.join(sorted(unknown)),))
+
+    react(run_benchmarks, [args])
+
+
+if __name__ == '__main__':
+    main()
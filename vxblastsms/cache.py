@@ -0,0 +1,115 @@
+"""Bounded in-memory caches with time based expiry."""
+from collections import OrderedDict
+
+
+class TimedCache(object):
+    """
+    A mapping with a maximum size whose entries expire ``ttl`` seconds
+    after they were last set or touched.
+
+    Entries are kept in the order they were last touched, so both expiry
+    and eviction only ever look at the oldest entries and cost O(1) per
+    entry removed, however large the cache is.
+
+    :param float ttl:
+        Seconds after which an untouched entry expires.
+    :param int max_size:
+        Maximum number of entries. Adding an entry to a full cache evicts
+        the least recently touched one. ``None`` means unbounded.
+    :param clock:
+        An object with a ``seconds()`` method, usually the reactor.
+    """
+
+    def __init__(self, ttl, max_size, clock):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def set(self, key, value, timestamp=None):
+        """
+        Set ``key`` to ``value`` and mark it as recently touched. Returns
+        the list of ``(key, value)`` pairs evicted to make space.
+
+        ``timestamp`` sets when the entry was last touched instead. Entries
+        have to be set in the order they were touched, or expiry will miss
+        some of them.
+        """
+        if timestamp is None:
+            timestamp = self.clock.seconds()
+        self._entries.pop(key, None)
+        self._entries[key] = (timestamp, value)
+        evicted = []
+        if self.max_size is not None:
+            while len(self._entries) > self.max_size:
+                evicted_key, (_, evicted_value) = self._entries.popitem(
+                    last=False)
+                evicted.append((evicted_key, evicted_value))
+        self.evictions += len(evicted)
+        return evicted
+
+    def touch(self, key):
+        """
+        Mark ``key`` as recently touched and return its value, or ``None``
+        if it isn't cached.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._entries[key] = (self.clock.seconds(), entry[1])
+        return entry[1]
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def expire(self):
+        """
+        Remove all expired entries and return them as a list of
+        ``(key, value)`` pairs, oldest first.
+        """
+        deadline = self.clock.seconds() - self.ttl
+        expired = []
+        for key, (timestamp, value) in self._entries.iteritems():
+            if timestamp > deadline:
+                break
+            expired.append((key, value))
+        for key, _ in expired:
+            del self._entries[key]
+        self.expirations += len(expired)
+        return expired
+
+    def itervalues(self):
+        for _, value in self._entries.itervalues():
+            yield value
+
+    def iterentries(self):
+        """
+        Iterate over ``(key, timestamp, value)`` for every entry, least
+        recently touched first.
+        """
+        for key, (timestamp, value) in self._entries.iteritems():
+            yield key, timestamp, value
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
@@ -0,0 +1,637 @@
+# -*- coding: utf-8 -*-
+"""Encoding and decoding of the BlastSMS USSD XML wire format."""
+import re
+from xml.etree.ElementTree import Element, SubElement, tostring
+from xml.dom import minidom
+from xml.parsers import expat
+
+from vumi.utils import load_class_by_string
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+ENCODING = 'utf-8'
+XML_DECLARATION_TEMPLATE = '<?xml version="1.0" encoding="%s"?>'
+XML_DECLARATION = XML_DECLARATION_TEMPLATE % (ENCODING,)
+RESPONSE_ROOT = 'ussdresp'
+RESPONSE_FIELDS = ('msisdn', 'sessionid', 'appid', 'type', 'msg')
+REQUEST_FIELDS = ('msisdn', 'shortcode', 'sessionid', 'type', 'msg', 'appid')
+
+# Characters that are not allowed in an XML 1.0 document. The DOM based
+# encoder fails when re-parsing these, so we refuse them up front.
+_INVALID_XML_CHARS = re.compile(
+    u'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+_NEEDS_ESCAPING = re.compile(u'[&<>"\r]')
+
+# Size of the chunks fed to the parser when decoding a request body.
+DECODE_CHUNK_SIZE = 1024
+
+# The maximum length of a USSD message, in GSM 03.38 characters.
+MAX_USSD_LENGTH = 182
+
+# The GSM 03.38 default alphabet, less the escape to the extension table,
+# and the characters of the extension table, which take two septets each.
+GSM7_BASIC_CHARS = (
+    u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    u'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM7_EXTENSION_CHARS = u'^{}\\[~]|€'
+
+
+class EncodeError(ValueError):
+    """Raised when a value cannot be represented in a USSD response."""
+
+
+class DecodeError(ValueError):
+    """
+    Raised when a request body cannot be decoded.
+
+    ``reason`` is a short machine readable description of the problem and
+    ``detail`` a human readable one.
+    """
+
+    def __init__(self, reason, detail):
+        super(DecodeError, self).__init__(reason, detail)
+        self.reason = reason
+        self.detail = detail
+
+
+class RequestTooLarge(DecodeError):
+    """Raised when a request body exceeds the maximum allowed size."""
+
+    def __init__(self, max_size):
+        super(RequestTooLarge, self).__init__(
+            'request_too_large',
+            'Request body exceeds %d bytes.' % (max_size,))
+
+
+def _compile_tags(tags):
+    return dict(
+        (field, ('<%s>' % (tag,), '</%s>' % (tag,), '<%s/>' % (tag,)))
+        for field, tag in tags.iteritems())
+
+
+def escape_text(value):
+    """
+    Escape ``value`` for use as element text, exactly as a minidom
+    round trip would.
+
+    Returns a unicode string, or ``None`` if the element should be written
+    as an empty tag.
+    """
+    if not value:
+        return None
+    if isinstance(value, str):
+        # Mirrors ElementTree, which only accepts ASCII byte strings.
+        value = value.decode('ascii')
+    elif not isinstance(value, unicode):
+        raise TypeError('cannot serialize %r (type %s)' % (
+            value, type(value).__name__))
+    if _INVALID_XML_CHARS.search(value) is not None:
+        raise EncodeError('Invalid XML character in %r' % (value,))
+    if _NEEDS_ESCAPING.search(value) is not None:
+        value = (value.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+                 .replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+                 .replace(u'"', u'&quot;').replace(u'>', u'&gt;'))
+    return value
+
+
+def _encode_fields(parts, fields, values, charset, tags):
+    for field, value in zip(fields, values):
+        open_tag, close_tag, empty_tag = tags[field]
+        text = escape_text(value)
+        if text is None:
+            parts.append(empty_tag)
+        else:
+            try:
+                parts.extend((open_tag, text.encode(charset), close_tag))
+            except UnicodeEncodeError as e:
+                raise EncodeError('Cannot encode %r as %s: %s' % (
+                    value, charset, e.reason))
+    return parts
+
+
+class ReplyEncoding(object):
+    """
+    The characters a link accepts in replies, how their length is
+    counted, and the charset replies are sent in.
+    """
+
+    def __init__(self, name, charset):
+        self.name = name
+        self.charset = charset
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.name)
+
+    def check(self, text):
+        """Raise :class:`EncodeError` if ``text`` can't be sent."""
+
+    def length(self, text):
+        return len(text)
+
+    def truncate(self, text, max_length):
+        return text[:max_length]
+
+    def prepare(self, text, max_length=None):
+        """
+        Check that ``text`` can be sent and cut it down to ``max_length``.
+        Returns the text to send and whether it was truncated.
+        """
+        if not text:
+            return text, False
+        if isinstance(text, str):
+            text = text.decode('ascii')
+        self.check(text)
+        if max_length is None or self.length(text) <= max_length:
+            return text, False
+        return self.truncate(text, max_length), True
+
+
+class CharsetReplyEncoding(ReplyEncoding):
+    """Replies must be representable in ``charset``."""
+
+    def check(self, text):
+        try:
+            text.encode(self.charset)
+        except UnicodeEncodeError as e:
+            raise EncodeError('Cannot encode %r as %s: %s' % (
+                text, self.charset, e.reason))
+
+
+class GSM7ReplyEncoding(ReplyEncoding):
+    """
+    Replies must be made of characters in the GSM 03.38 default alphabet
+    and its extension table, and their length is counted in septets. They
+    are sent as UTF-8.
+    """
+
+    _INVALID = re.compile(u'[^%s%s]' % (
+        re.escape(GSM7_BASIC_CHARS), re.escape(GSM7_EXTENSION_CHARS)))
+    _EXTENSION = re.compile(u'[%s]' % (re.escape(GSM7_EXTENSION_CHARS),))
+
+    def check(self, text):
+        match = self._INVALID.search(text)
+        if match is not None:
+            raise EncodeError('Cannot encode %r as GSM 03.38: %r' % (
+                text, match.group()))
+
+    def length(self, text):
+        return len(text) + len(self._EXTENSION.findall(text))
+
+    def truncate(self, text, max_length):
+        length = 0
+        for index, char in enumerate(text):
+            length += 2 if char in GSM7_EXTENSION_CHARS else 1
+            if length > max_length:
+                return text[:index]
+        return text
+
+
+REPLY_ENCODINGS = {
+    'utf-8': ReplyEncoding('utf-8', 'utf-8'),
+    'iso-8859-1': CharsetReplyEncoding('iso-8859-1', 'iso-8859-1'),
+    'gsm7': GSM7ReplyEncoding('gsm7', 'utf-8'),
+}
+
+
+def get_reply_encoding(name):
+    """
+    Return the :class:`ReplyEncoding` called ``name``. Raises
+    ``ValueError`` if there isn't one.
+    """
+    try:
+        return REPLY_ENCODINGS[name.lower()]
+    except (KeyError, AttributeError):
+        raise ValueError('Unknown reply encoding %r, expected one of %s.' % (
+            name, ', '.join(sorted(REPLY_ENCODINGS))))
+
+
+class _DecodingDone(Exception):
+    """Raised from parser callbacks once all wanted fields are found."""
+
+
+class _RequestDecoder(object):
+    """
+    Parser callbacks that collect the text of the flat children of the
+    root element.
+    """
+
+    def __init__(self, stop_fields, names):
+        self.stop_fields = stop_fields
+        self.names = names
+        self.values = {}
+        self.seen = set()
+        self.depth = 0
+        self.text = []
+
+    def start(self, tag, attrs):
+        self.depth += 1
+        if self.depth > 2:
+            raise DecodeError(
+                'unexpected_nesting', 'Unexpected nested element %r.' % (
+                    tag,))
+        del self.text[:]
+
+    def end(self, tag):
+        if self.depth == 2:
+            tag = self.names.get(tag, tag)
+            self.seen.add(tag)
+            if self.text and tag is not None:
+                self.values[tag] = u''.join(self.text).encode(ENCODING)
+            if self.stop_fields is not None and self.stop_fields <= self.seen:
+                raise _DecodingDone()
+        self.depth -= 1
+
+    def data(self, text):
+        if self.depth == 2:
+            self.text.append(text)
+
+    def doctype(self, *args):
+        raise DecodeError(
+            'unexpected_doctype', 'Document type declarations not allowed.')
+
+
+def _read_body(body, max_size):
+    if not isinstance(body, str):
+        body = body.read() if max_size is None else body.read(max_size + 1)
+    if max_size is not None and len(body) > max_size:
+        raise RequestTooLarge(max_size)
+    return body
+
+
+def _check_doctype(body):
+    # Tree building parsers expand entities before we could object to
+    # them, so document types are refused before parsing.
+    if '<!DOCTYPE' in body:
+        raise DecodeError(
+            'unexpected_doctype', 'Document type declarations not allowed.')
+
+
+class WireCodec(object):
+    """
+    Decodes requests from and encodes replies to a USSD aggregator.
+
+    Decoded requests are dicts mapping the names in
+    :data:`REQUEST_FIELDS` to their UTF-8 encoded values. Replies are
+    encoded in two parts, the start holding the ``msisdn`` and
+    ``sessionid`` and the end the rest, so that the end of a reply many
+    subscribers get can be encoded once and cached.
+    """
+    name = None
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.name)
+
+    def decode_request(self, body, max_size=None, stop_fields=None):
+        """
+        Decode a request body, given as a byte string or a file-like
+        object. Bodies larger than ``max_size`` bytes are rejected with
+        :class:`RequestTooLarge`, and decoding may stop as soon as all of
+        the ``stop_fields`` have been seen. Raises :class:`DecodeError` for
+        bodies that can't be decoded.
+        """
+        raise NotImplementedError()
+
+    def encode_response_start(self, msisdn, sessionid, charset=ENCODING):
+        raise NotImplementedError()
+
+    def encode_response_end(self, appid, type, msg, charset=ENCODING):
+        raise NotImplementedError()
+
+    def encode_response(self, msisdn, sessionid, appid, type, msg,
+                        charset=ENCODING):
+        """
+        Encode a reply as bytes in ``charset``. Raises
+        :class:`EncodeError` if it can't be.
+        """
+        return (self.encode_response_start(msisdn, sessionid, charset) +
+                self.encode_response_end(appid, type, msg, charset))
+
+
+class XmlCodec(WireCodec):
+    """
+    The BlastSMS ``<ussdresp>`` format, decoded by a streaming parser and
+    encoded directly to bytes, without building a document.
+
+    Variants of the format can be described by the name of the ``root``
+    element of replies and ``tags``, a mapping of field names to the tags
+    used for them where they differ.
+    """
+    name = 'xml'
+
+    def __init__(self, root=RESPONSE_ROOT, tags=None):
+        self.root = root
+        self.tags = dict((field, field) for field in REQUEST_FIELDS)
+        if tags is not None:
+            unknown = set(tags) - set(self.tags)
+            if unknown:
+                raise ValueError('Unknown fields: %s' % (
+                    ', '.join(sorted(unknown)),))
+            self.tags.update(tags)
+        self.names = dict((tag, field) for field, tag in self.tags.iteritems())
+        if len(self.names) != len(self.tags):
+            raise ValueError('Fields must have different tags.')
+        # The usual tags of renamed fields are ignored rather than decoded
+        # as those fields.
+        for field in self.tags:
+            self.names.setdefault(field, None)
+        self._tags = _compile_tags(self.tags)
+        self._heads = {}
+        self._tail = '</%s>' % (root,)
+
+    def _head(self, charset):
+        head = self._heads.get(charset)
+        if head is None:
+            head = self._heads[charset] = '%s<%s>' % (
+                XML_DECLARATION_TEMPLATE % (charset,), self.root)
+        return head
+
+    def decode_request(self, body, max_size=None, stop_fields=None):
+        body = _read_body(body, max_size)
+        decoder = _RequestDecoder(stop_fields, self.names)
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = decoder.start
+        parser.EndElementHandler = decoder.end
+        parser.CharacterDataHandler = decoder.data
+        parser.StartDoctypeDeclHandler = decoder.doctype
+
+        try:
+            for offset in xrange(0, len(body), DECODE_CHUNK_SIZE):
+                parser.Parse(body[offset:offset + DECODE_CHUNK_SIZE], False)
+            parser.Parse('', True)
+        except _DecodingDone:
+            pass
+        except DecodeError:
+            raise
+        except (expat.ExpatError, LookupError, ValueError) as e:
+            # Declared encodings expat can't use give LookupError or
+            # ValueError, and bytes Python can't decode UnicodeDecodeError.
+            raise DecodeError('invalid_xml', str(e))
+        return decoder.values
+
+    def encode_response(self, msisdn, sessionid, appid, type, msg,
+                        charset=ENCODING):
+        parts = _encode_fields(
+            [self._head(charset)], RESPONSE_FIELDS,
+            (msisdn, sessionid, appid, type, msg), charset, self._tags)
+        parts.append(self._tail)
+        return ''.join(parts)
+
+    def encode_response_start(self, msisdn, sessionid, charset=ENCODING):
+        return ''.join(_encode_fields(
+            [self._head(charset)], RESPONSE_FIELDS[:2], (msisdn, sessionid),
+            charset, self._tags))
+
+    def encode_response_end(self, appid, type, msg, charset=ENCODING):
+        parts = _encode_fields(
+            [], RESPONSE_FIELDS[2:], (appid, type, msg), charset, self._tags)
+        parts.append(self._tail)
+        return ''.join(parts)
+
+
+class DomXmlCodec(XmlCodec):
+    """
+    The same format as :class:`XmlCodec`, decoded and encoded through
+    :mod:`xml.dom.minidom` documents the way the transport originally did.
+    It is much slower, and kept as a reference for the others.
+    """
+    name = 'dom'
+
+    def decode_request(self, body, max_size=None, stop_fields=None):
+        body = _read_body(body, max_size)
+        _check_doctype(body)
+        try:
+            document = minidom.parseString(body)
+        except (expat.ExpatError, LookupError, ValueError) as e:
+            raise DecodeError('invalid_xml', str(e))
+        values = {}
+        for element in document.documentElement.childNodes:
+            if element.nodeType != element.ELEMENT_NODE:
+                continue
+            text = []
+            for node in element.childNodes:
+                if node.nodeType == node.ELEMENT_NODE:
+                    raise DecodeError(
+                        'unexpected_nesting',
+                        'Unexpected nested element %r.' % (node.tagName,))
+                if node.nodeType in (node.TEXT_NODE, node.CDATA_SECTION_NODE):
+                    text.append(node.data)
+            field = self.names.get(element.tagName, element.tagName)
+            if text and field is not None:
+                values[field] = u''.join(text).encode(ENCODING)
+        return values
+
+    def _encode_document(self, fields, values, charset):
+        root = Element(self.root)
+        for field, value in zip(fields, values):
+            SubElement(root, self.tags[field]).text = value
+        try:
+            return minidom.parseString(
+                tostring(root, encoding=ENCODING)).toxml(encoding=charset)
+        except expat.ExpatError as e:
+            raise EncodeError('Invalid XML in reply: %s' % (e,))
+        except UnicodeEncodeError as e:
+            raise EncodeError('Cannot encode reply as %s: %s' % (
+                charset, e.reason))
+
+    def encode_response_start(self, msisdn, sessionid, charset=ENCODING):
+        document = self._encode_document(
+            RESPONSE_FIELDS[:2], (msisdn, sessionid), charset)
+        return document[:-len(self._tail)]
+
+    def encode_response_end(self, appid, type, msg, charset=ENCODING):
+        document = self._encode_document(
+            RESPONSE_FIELDS[2:], (appid, type, msg), charset)
+        return document[len(self._head(charset)):]
+
+    def encode_response(self, msisdn, sessionid, appid, type, msg,
+                        charset=ENCODING):
+        return self._encode_document(
+            RESPONSE_FIELDS, (msisdn, sessionid, appid, type, msg), charset)
+
+
+class LxmlXmlCodec(XmlCodec):
+    """
+    The same format as :class:`XmlCodec`, decoded and encoded with
+    :mod:`lxml`. Only available if lxml is installed.
+
+    Replies are equivalent to the other codecs' but not byte for byte the
+    same, because lxml escapes a few characters differently.
+    """
+    name = 'lxml'
+
+    def __init__(self, root=RESPONSE_ROOT, tags=None):
+        if lxml_etree is None:
+            raise ValueError('The lxml codec needs lxml to be installed.')
+        super(LxmlXmlCodec, self).__init__(root, tags)
+        self._parser = lxml_etree.XMLParser(
+            resolve_entities=False, no_network=True)
+
+    def decode_request(self, body, max_size=None, stop_fields=None):
+        body = _read_body(body, max_size)
+        _check_doctype(body)
+        try:
+            root = lxml_etree.fromstring(body, self._parser)
+        except lxml_etree.XMLSyntaxError as e:
+            # lxml's messages quote the body, which needn't be ASCII.
+            raise DecodeError('invalid_xml', e.msg.encode(ENCODING))
+        except TypeError as e:
+            # Raised instead of a syntax error when the message quotes
+            # bytes that aren't valid UTF-8.
+            raise DecodeError('invalid_xml', str(e))
+        values = {}
+        for element in root:
+            if not isinstance(element.tag, basestring):
+                # Comments and processing instructions.
+                continue
+            text = [element.text or u'']
+            for node in element:
+                if isinstance(node.tag, basestring):
+                    raise DecodeError(
+                        'unexpected_nesting',
+                        'Unexpected nested element %r.' % (node.tag,))
+                text.append(node.tail or u'')
+            text = u''.join(text)
+            field = self.names.get(element.tag, element.tag)
+            if text and field is not None:
+                values[field] = text.encode(ENCODING)
+        return values
+
+    def _encode_fields(self, fields, values, charset):
+        parts = []
+        for field, value in zip(fields, values):
+            element = lxml_etree.Element(self.tags[field])
+            if value:
+                if isinstance(value, str):
+                    value = value.decode('ascii')
+                try:
+                    value.encode(charset)
+                    element.text = value
+                except UnicodeEncodeError as e:
+                    raise EncodeError('Cannot encode %r as %s: %s' % (
+                        value, charset, e.reason))
+                except ValueError as e:
+                    raise EncodeError('Invalid XML in %r: %s' % (value, e))
+            parts.append(lxml_etree.tostring(
+                element, encoding=charset, xml_declaration=False))
+        return parts
+
+    def encode_response_start(self, msisdn, sessionid, charset=ENCODING):
+        return self._head(charset) + ''.join(self._encode_fields(
+            RESPONSE_FIELDS[:2], (msisdn, sessionid), charset))
+
+    def encode_response_end(self, appid, type, msg, charset=ENCODING):
+        return ''.join(self._encode_fields(
+            RESPONSE_FIELDS[2:], (appid, type, msg), charset)) + self._tail
+
+    def encode_response(self, msisdn, sessionid, appid, type, msg,
+                        charset=ENCODING):
+        # XmlCodec's single pass encoder doesn't go through lxml.
+        return WireCodec.encode_response(
+            self, msisdn, sessionid, appid, type, msg, charset)
+
+
+CODECS = {
+    'xml': XmlCodec,
+    'dom': DomXmlCodec,
+}
+if lxml_etree is not None:
+    CODECS['lxml'] = LxmlXmlCodec
+
+DEFAULT_CODEC = XmlCodec()
+
+
+def get_codec(name, options=None):
+    """
+    Return a :class:`WireCodec` built with the keyword arguments in
+    ``options``. ``name`` is either one of :data:`CODECS` or the dotted
+    path of a :class:`WireCodec` subclass. Raises ``ValueError`` if
+    there's no such codec or it doesn't accept ``options``.
+    """
+    codec_class = CODECS.get(name)
+    if codec_class is None:
+        try:
+            codec_class = load_class_by_string(name)
+        except (ImportError, AttributeError, ValueError):
+            raise ValueError('Unknown codec %r, expected one of %s or the '
+                             'path of a codec class.' % (
+                                 name, ', '.join(sorted(CODECS))))
+        if not (isinstance(codec_class, type) and
+                issubclass(codec_class, WireCodec)):
+            raise ValueError('%r is not a codec class.' % (name,))
+    try:
+        return codec_class(**(options or {}))
+    except TypeError as e:
+        raise ValueError('Invalid options for codec %r: %s' % (name, e))
+
+
+def encode_response(msisdn, sessionid, appid, type, msg, charset=ENCODING):
+    """
+    Serialise a ``<ussdresp>`` document straight to bytes in ``charset``.
+
+    With the default UTF-8 charset, the output is byte-identical to
+    :func:`encode_response_dom`.
+    """
+    return DEFAULT_CODEC.encode_response(
+        msisdn, sessionid, appid, type, msg, charset)
+
+
+def encode_response_start(msisdn, sessionid, charset=ENCODING):
+    """
+    Serialise the start of a ``<ussdresp>`` document, up to the end of the
+    ``sessionid``. Together with :func:`encode_response_end` this gives the
+    same bytes as :func:`encode_response`, so that the end of a response
+    that is the same for many subscribers can be encoded once.
+    """
+    return DEFAULT_CODEC.encode_response_start(msisdn, sessionid, charset)
+
+
+def encode_response_end(appid, type, msg, charset=ENCODING):
+    """
+    Serialise the rest of a ``<ussdresp>`` document after the
+    ``sessionid``. See :func:`encode_response_start`.
+    """
+    return DEFAULT_CODEC.encode_response_end(appid, type, msg, charset)
+
+
+def encode_response_dom(msisdn, sessionid, appid, type, msg):
+    """
+    Serialise a ``<ussdresp>`` document using ElementTree and minidom.
+
+    This is the original, much slower encoder. It is kept as the reference
+    implementation for parity tests and benchmarks.
+    """
+    e_ussdresp = Element(RESPONSE_ROOT)
+    for field, value in zip(
+            RESPONSE_FIELDS, (msisdn, sessionid, appid, type, msg)):
+        SubElement(e_ussdresp, field).text = value
+
+    return minidom.parseString(tostring(
+        e_ussdresp,
+        encoding=ENCODING,
+    )).toxml(encoding=ENCODING)
+
+
+def decode_request(body, max_size=None, stop_fields=None):
+    """
+    Decode a BlastSMS request document into a dict mapping the tags of the
+    root element's children to their (UTF-8 encoded) text. Children without
+    text are left out.
+
+    :param body:
+        Either a byte string or a file-like object holding the request body.
+    :param int max_size:
+        If given, bodies larger than this many bytes are rejected with
+        :class:`RequestTooLarge` without being parsed.
+    :param set stop_fields:
+        If given, decoding stops as soon as all of these tags have been
+        seen and anything after them is ignored.
+
+    Raises :class:`DecodeError` for malformed or unexpectedly structured
+    bodies.
+    """
+    return DEFAULT_CODEC.decode_request(body, max_size, stop_fields)
@@ -0,0 +1,86 @@
+"""Detection of requests BlastSMS retries."""
+from vxblastsms.cache import TimedCache
+
+
+class SeenRequest(object):
+    """
+    A request we've seen recently. ``waiting`` holds the ids of retries
+    waiting for the reply, and ``response`` the ``(body, code)`` sent in
+    reply once there is one.
+    """
+    __slots__ = ('request_id', 'waiting', 'response')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.waiting = []
+        self.response = None
+
+
+class DedupeIndex(object):
+    """
+    Remembers requests for ``window`` seconds, and their replies for
+    ``window`` seconds after they are sent, so that retries can be
+    answered without involving the application.
+
+    At most ``max_size`` requests are remembered.
+    """
+
+    def __init__(self, window, max_size, clock):
+        self._requests = TimedCache(window, max_size, clock)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._requests)
+
+    def lookup(self, key):
+        """
+        Return the :class:`SeenRequest` for ``key``, or ``None`` if we
+        haven't seen it recently.
+        """
+        seen = self._requests.get(key)
+        if seen is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return seen
+
+    def add(self, key, request_id):
+        self._requests.set(key, SeenRequest(request_id))
+
+    def complete(self, key, request_id, response):
+        """
+        Remember the reply to a request and return the ids of the retries
+        waiting for it.
+        """
+        seen = self._requests.get(key)
+        if seen is None or seen.request_id != request_id:
+            return []
+        waiting, seen.waiting = seen.waiting, []
+        seen.response = response
+        # Retries are only likely for a while after the reply is sent.
+        self._requests.set(key, seen)
+        return waiting
+
+    def discard(self, key, request_id):
+        """
+        Forget a request that went away without a reply, so that the next
+        retry is handled like a new request.
+        """
+        seen = self._requests.get(key)
+        if (seen is not None and seen.request_id == request_id and
+                seen.response is None):
+            self._requests.pop(key)
+
+    def expire(self):
+        self._requests.expire()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._requests),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self._requests.evictions,
+        }
@@ -0,0 +1,197 @@
+"""
+Run the BlastSMS USSD transport in process, for benchmarks and replays.
+
+The transport and an application are connected by the in-memory AMQP
+broker from :mod:`vumi.tests.helpers`, so no broker has to be running.
+That module is installed with vumi, and is the only test helper needed.
+"""
+import time
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.web.http_headers import Headers
+
+from vumi.application import ApplicationWorker
+from vumi.tests.helpers import WorkerHelper
+from vumi.transports.httprpc.httprpc import HttpRpcResource
+
+from vxblastsms.ussd import BlastSMSUssdTransport
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+class HarnessRequest(object):
+    """
+    Just enough of a :class:`twisted.web.server.Request` for the transport
+    to read a request body and write its response.
+    """
+
+    def __init__(self, body):
+        self.method = 'POST'
+        self.content = StringIO(body)
+        self.client = IPv4Address('TCP', '127.0.0.1', 12345)
+        self.responseCode = 200
+        self.responseHeaders = Headers()
+        self.written = []
+        self.finished = False
+        self._finish_deferreds = []
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+    def setResponseCode(self, code, message=None):
+        self.responseCode = code
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+        deferreds, self._finish_deferreds = self._finish_deferreds, []
+        for d in deferreds:
+            d.callback(None)
+
+    def notifyFinish(self):
+        if self.finished:
+            return succeed(None)
+        d = Deferred()
+        self._finish_deferreds.append(d)
+        return d
+
+
+class EchoApplication(ApplicationWorker):
+    """Replies to every message with its own content."""
+
+    def consume_user_message(self, message):
+        return self.reply_to(message, message['content'] or 'Welcome')
+
+
+class TransportHarness(object):
+    """
+    Runs a :class:`BlastSMSUssdTransport` and an :class:`EchoApplication`
+    in process, connected by vumi's fake AMQP broker.
+
+    Requests are fed straight to the transport's HTTP resource, so the
+    numbers include everything the transport and the message broker
+    client do but not the cost of the HTTP server or the network.
+    """
+
+    transport_name = 'blastsms_benchmark'
+
+    def __init__(self, transport_config=None, transport_class=None):
+        self.transport_config = {
+            'transport_name': self.transport_name,
+            'web_path': '/api/blastsms/ussd/',
+            'web_port': 0,
+            'app_id': 'benchmark',
+        }
+        self.transport_config.update(transport_config or {})
+        self.transport_class = transport_class or BlastSMSUssdTransport
+        self.worker_helper = WorkerHelper()
+        self.requests_sent = 0
+
+    @inlineCallbacks
+    def start(self):
+        self.transport = yield self.worker_helper.get_worker(
+            self.transport_class, dict(self.transport_config))
+        self.application = yield self.worker_helper.get_worker(
+            EchoApplication, {'transport_name': self.transport_name})
+        self.resource = HttpRpcResource(self.transport)
+
+    def stop(self):
+        return self.worker_helper.cleanup()
+
+    def wait_idle(self):
+        """
+        Wait for the broker to deliver everything in flight. Until it has,
+        the fake broker holds on to a chain of Deferreds that would show up
+        as memory growth.
+        """
+        return self.worker_helper.broker.wait_delivery()
+
+    def request(self, body):
+        """
+        Send a request body to the transport. Returns a Deferred that fires
+        with the response code, the response body and the latency in
+        seconds once the transport has finished the request.
+        """
+        self.requests_sent += 1
+        if self.requests_sent % 1000 == 0:
+            # The fake broker keeps every message it has seen.
+            self.worker_helper.broker.clear_messages('vumi')
+
+        request = HarnessRequest(body)
+        d = request.notifyFinish()
+        start = time.time()
+        self.resource.render(request)
+        d.addCallback(lambda _: (
+            request.responseCode, ''.join(request.written),
+            time.time() - start))
+        return d
+
+
+def send_all(harness, bodies, concurrency):
+    """
+    Send ``bodies`` to ``harness`` with at most ``concurrency`` requests
+    open at a time. Returns a Deferred that fires with the list of
+    results once every request has finished, or fails with the first error
+    raised while reading ``bodies``.
+    """
+    done = Deferred()
+    results = []
+    sent = [0]
+    bodies = iter(bodies)
+
+    def send_next():
+        if done.called:
+            return
+        try:
+            body = next(bodies, None)
+        except Exception:
+            done.errback()
+            return
+        if body is not None:
+            sent[0] += 1
+            harness.request(body).addCallback(finished)
+        elif len(results) == sent[0]:
+            done.callback(results)
+
+    def finished(result):
+        results.append(result)
+        # Requests can finish synchronously, so we start the next one from
+        # the reactor rather than recursing.
+        reactor.callLater(0, send_next)
+
+    for _ in range(concurrency):
+        send_next()
+    return done
+
+
+def summarise_results(results, duration):
+    """
+    Summarise the ``(code, body, latency)`` results of requests sent over
+    ``duration`` seconds.
+    """
+    latencies = sorted(latency for _, _, latency in results)
+    status_codes = {}
+    for code, _, _ in results:
+        status_codes[code] = status_codes.get(code, 0) + 1
+    return {
+        'requests': len(results),
+        'errors': len(results) - status_codes.get(200, 0),
+        'status_codes': dict(
+            (str(code), count) for code, count in status_codes.iteritems()),
+        'duration_s': duration,
+        'throughput_rps': len(results) / duration if duration else None,
+        'latency_ms': dict(
+            (name, latencies and percentile(latencies, fraction) * 1000)
+            for name, fraction in [
+                ('p50', 0.5), ('p99', 0.99), ('p999', 0.999), ('max', 1)]),
+    }
@@ -0,0 +1,119 @@
+"""Aggregate statistics about the journeys subscribers take through menus."""
+import json
+import time
+
+from vxblastsms.stats import LATENCY_BUCKETS, Histogram
+
+
+# Upper bounds, in seconds, of the session duration histogram buckets.
+DURATION_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 90, 120, 180, 300, 600)
+
+# The key that shortcodes beyond ``max_shortcodes`` are counted under.
+OTHER_SHORTCODES = '_other'
+
+
+class ShortcodeJourneys(object):
+    """
+    How sessions on one shortcode went: how they ended, how many steps
+    they took, how long they lasted and how long each step took to answer.
+
+    Steps after the ``max_steps``th share a latency histogram, so the
+    memory used doesn't depend on how long sessions are.
+    """
+
+    def __init__(self, max_steps):
+        self.max_steps = max_steps
+        self.ends = {}
+        self.steps = Histogram(range(1, max_steps + 1))
+        self.durations = Histogram(DURATION_BUCKETS)
+        self.step_latencies = [
+            Histogram(LATENCY_BUCKETS) for _ in xrange(max_steps + 1)]
+
+    def record_step(self, step, latency):
+        self.step_latencies[min(step, self.max_steps + 1) - 1].record(latency)
+
+    def record_end(self, steps, reason, duration):
+        self.ends[reason] = self.ends.get(reason, 0) + 1
+        self.steps.record(steps)
+        self.durations.record(duration)
+
+    def get_stats(self):
+        step_latencies = {}
+        for index, histogram in enumerate(self.step_latencies):
+            if histogram.count:
+                step = index + 1
+                name = str(step) if step <= self.max_steps else '%d+' % (step,)
+                step_latencies[name] = histogram.get_stats()
+        return {
+            'sessions': self.steps.count,
+            'ends': dict(self.ends),
+            'steps': self.steps.get_stats(),
+            'durations': self.durations.get_stats(),
+            'step_latencies': step_latencies,
+        }
+
+
+class JourneyAggregator(object):
+    """
+    Per-shortcode :class:`ShortcodeJourneys`, built up from the steps and
+    ends of sessions as they happen rather than by keeping every session.
+
+    Recording costs a dictionary lookup and a histogram update. At most
+    ``max_shortcodes`` shortcodes are counted separately, and sessions on
+    any others are counted together, so memory is bounded however many
+    shortcodes subscribers dial.
+    """
+
+    def __init__(self, max_steps=20, max_shortcodes=1000):
+        self.max_steps = max_steps
+        self.max_shortcodes = max_shortcodes
+        self.shortcodes = {}
+        self.started_at = time.time()
+
+    def get_journeys(self, shortcode):
+        journeys = self.shortcodes.get(shortcode)
+        if journeys is None:
+            if len(self.shortcodes) >= self.max_shortcodes:
+                shortcode = OTHER_SHORTCODES
+                journeys = self.shortcodes.get(shortcode)
+            if journeys is None:
+                journeys = ShortcodeJourneys(self.max_steps)
+                self.shortcodes[shortcode] = journeys
+        return journeys
+
+    def record_step(self, shortcode, step, latency):
+        """
+        Record that the ``step``th request of a session on ``shortcode``
+        was answered ``latency`` seconds after it arrived.
+        """
+        self.get_journeys(shortcode).record_step(step, latency)
+
+    def record_end(self, shortcode, steps, reason, duration):
+        """
+        Record that a session on ``shortcode`` ended for ``reason`` after
+        ``steps`` steps and ``duration`` seconds.
+        """
+        self.get_journeys(shortcode).record_end(steps, reason, duration)
+
+    def get_stats(self):
+        return dict(
+            (shortcode, journeys.get_stats())
+            for shortcode, journeys in self.shortcodes.iteritems())
+
+    def flush(self, path=None):
+        """
+        Return the journeys since the last flush and reset them, appending
+        them as a line of JSON to the file at ``path`` if given.
+        """
+        now = time.time()
+        report = {
+            'timestamp': now,
+            'interval': now - self.started_at,
+            'shortcodes': self.get_stats(),
+        }
+        self.shortcodes = {}
+        self.started_at = now
+        if path is not None:
+            with open(path, 'a') as journey_file:
+                journey_file.write(json.dumps(report, sort_keys=True) + '\n')
+        return report
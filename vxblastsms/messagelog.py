@@ -0,0 +1,79 @@
+"""Cheap logging of the messages passing through the transport."""
+import logging
+
+from vumi import log
+
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+
+def redact_msisdn(msisdn):
+    """Mask all but the last three digits of ``msisdn``."""
+    if msisdn is None:
+        return None
+    visible = 3 if len(msisdn) > 6 else 0
+    return '*' * (len(msisdn) - visible) + msisdn[len(msisdn) - visible:]
+
+
+class MessageLogger(object):
+    """
+    Logs the messages handled by the transport.
+
+    Messages below ``level`` cost a comparison. Other messages are handed to
+    Twisted's log as a ``format`` string and its fields, so the text is only
+    built by the log observers that write it out.
+
+    :param int level:
+        The lowest level to log at.
+    :param int body_sample_rate:
+        Only one in every ``body_sample_rate`` outbound bodies is logged.
+    :param bool redact:
+        Mask msisdns and leave message content out of the logs.
+    """
+
+    def __init__(self, level=logging.INFO, body_sample_rate=1, redact=False):
+        self.level = level
+        self.body_sample_rate = body_sample_rate
+        self.redact = redact
+        self.bodies_seen = 0
+
+    def rejected(self, reason, detail):
+        if self.level > logging.INFO:
+            return
+        log.info(
+            format='BlastSMSUssdTransport rejected inbound message: '
+                   '%(reason)s %(detail)s',
+            reason=reason, detail=detail)
+
+    def inbound(self, msisdn, shortcode, sessionid):
+        if self.level > logging.INFO:
+            return
+        if self.redact:
+            msisdn = redact_msisdn(msisdn)
+        log.info(
+            format='BlastSMSUssdTransport receiving inbound message from '
+                   '%(msisdn)s to %(shortcode)s.',
+            msisdn=msisdn, shortcode=shortcode, sessionid=sessionid)
+
+    def outbound(self, msisdn, sessionid, body):
+        if self.level > logging.INFO:
+            return
+        self.bodies_seen += 1
+        if self.bodies_seen % self.body_sample_rate:
+            return
+        if self.redact:
+            log.info(
+                format='BlastSMSUssdTransport outbound message to '
+                       '%(msisdn)s of %(size)d bytes.',
+                msisdn=redact_msisdn(msisdn), sessionid=sessionid,
+                size=len(body))
+        else:
+            log.info(
+                format='BlastSMSUssdTransport outbound message with '
+                       'content: %(body)r',
+                msisdn=msisdn, sessionid=sessionid, body=body)
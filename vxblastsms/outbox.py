@@ -0,0 +1,174 @@
+"""A bounded queue of events waiting to be published."""
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+from vumi import log
+
+
+class EventOutbox(object):
+    """
+    Queues events so that publishing them doesn't hold up the reply path.
+
+    Queued events are published in batches, ``flush_interval`` seconds after
+    the first event of a batch is queued or as soon as ``batch_size``
+    events are waiting, with at most ``max_in_flight`` publishes
+    unfinished at a time.
+
+    When ``high_water`` events are waiting or being published,
+    ``on_full`` is called so that the caller can stop producing events, and
+    ``on_drained`` is called once the depth is back down to
+    ``low_water``. Neither is called once the outbox has been stopped.
+    Events queued while ``max_size`` events are waiting are dropped.
+
+    :param publish:
+        Called with the keyword arguments of each event. May return a
+        Deferred.
+    :param clock:
+        An ``IReactorTime`` provider, usually the reactor.
+    """
+
+    def __init__(self, publish, clock, max_size=10000, batch_size=100,
+                 flush_interval=0.01, max_in_flight=100, high_water=None,
+                 low_water=None, on_full=None, on_drained=None):
+        self.publish = publish
+        self.clock = clock
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_in_flight = max_in_flight
+        self.high_water = high_water if high_water is not None else (
+            max_size // 2)
+        self.low_water = low_water if low_water is not None else (
+            self.high_water // 2)
+        self.on_full = on_full
+        self.on_drained = on_drained
+
+        self._queue = deque()
+        self._flush_call = None
+        self._flushing = False
+        self._drain_waiters = []
+        self._dropping = False
+        self.stopped = False
+        self.full = False
+        self.in_flight = 0
+        self.published = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def depth(self):
+        """The number of events waiting or being published."""
+        return len(self._queue) + self.in_flight
+
+    def put(self, **event):
+        """
+        Queue an event. Returns ``False`` if the event was dropped because
+        the outbox is full.
+        """
+        if len(self._queue) >= self.max_size:
+            if not self._dropping:
+                self._dropping = True
+                log.warning(
+                    'Event outbox full, dropping events. %d dropped so '
+                    'far.' % (self.dropped,))
+            self.dropped += 1
+            return False
+        if self._dropping:
+            self._dropping = False
+            log.info('Event outbox has room again, %d events dropped so '
+                     'far.' % (self.dropped,))
+        self._queue.append(event)
+        if not self.full and self.depth() >= self.high_water:
+            self.full = True
+            if self.on_full is not None and not self.stopped:
+                self.on_full()
+        if len(self._queue) >= self.batch_size:
+            self._schedule_flush(0)
+        else:
+            self._schedule_flush(self.flush_interval)
+        return True
+
+    def _schedule_flush(self, delay):
+        if self._flush_call is not None:
+            if delay > 0 or self._flush_call.getTime() <= (
+                    self.clock.seconds()):
+                return
+            self._flush_call.cancel()
+        self._flush_call = self.clock.callLater(delay, self.flush)
+
+    def flush(self):
+        """Publish as many queued events as ``max_in_flight`` allows."""
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        self._flushing = True
+        try:
+            while self._queue and self.in_flight < self.max_in_flight:
+                event = self._queue.popleft()
+                self.in_flight += 1
+                d = maybeDeferred(self.publish, **event)
+                d.addCallbacks(self._published, self._failed)
+                d.addBoth(self._finished)
+        finally:
+            self._flushing = False
+        self._check_depth()
+
+    def _published(self, _):
+        self.published += 1
+
+    def _failed(self, failure):
+        self.errors += 1
+        log.err(failure, 'Failed to publish event.')
+
+    def _finished(self, _):
+        self.in_flight -= 1
+        if not self._flushing:
+            if self._queue:
+                self._schedule_flush(0)
+            self._check_depth()
+
+    def _check_depth(self):
+        depth = self.depth()
+        if self.full and depth <= self.low_water:
+            self.full = False
+            if self.on_drained is not None and not self.stopped:
+                self.on_drained()
+        if depth == 0:
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def drain(self):
+        """
+        Publish everything queued. Returns a Deferred that fires once there
+        is nothing left to publish.
+        """
+        if self.depth() == 0:
+            return succeed(None)
+        d = Deferred()
+        self._drain_waiters.append(d)
+        self.flush()
+        return d
+
+    def stop(self):
+        """
+        Stop calling ``on_full`` and ``on_drained``, and cancel the next
+        flush. Events can still be queued and drained.
+        """
+        self.stopped = True
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+    def get_stats(self):
+        return {
+            'queued': len(self._queue),
+            'in_flight': self.in_flight,
+            'published': self.published,
+            'errors': self.errors,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,169 @@
+"""Sampling profiler for the transport's request handling."""
+import gc
+import json
+import time
+from functools import wraps
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class CallStats(object):
+    """Costs of the sampled calls of one function."""
+    __slots__ = ('calls', 'sampled', 'time', 'max_time', 'allocations',
+                 'allocation_samples')
+
+    def __init__(self):
+        self.calls = 0
+        self.sampled = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.allocations = 0
+        self.allocation_samples = 0
+
+    def get_stats(self):
+        sampled = self.sampled or 1
+        mean_time = self.time / sampled
+        return {
+            'calls': self.calls,
+            'sampled': self.sampled,
+            'mean_ms': mean_time * 1000,
+            'max_ms': self.max_time * 1000,
+            'estimated_total_ms': mean_time * self.calls * 1000,
+            'mean_allocations': (
+                float(self.allocations) / self.allocation_samples
+                if self.allocation_samples else None),
+        }
+
+
+class CallProfiler(object):
+    """
+    Times one in every ``sample_rate`` calls of the functions it wraps, and
+    counts the objects they allocate.
+
+    Only the time a call spends before returning is counted, which for a
+    function returning a Deferred is the time it holds up the reactor.
+    Allocations are the net number of objects tracked by the garbage
+    collector that a call creates, which costs nothing extra to count.
+    Calls during which a collection ran are left out of the allocation
+    figures.
+
+    :meth:`dump` reports the costs since the last dump along with what has
+    grown in memory: the lines allocating the most if :mod:`tracemalloc` is
+    available and tracing (for example because ``PYTHONTRACEMALLOC`` is
+    set), or else the types with the most new objects if ``count_objects``
+    is set. Counting objects means walking every object the garbage
+    collector knows about, which holds up the caller for as long as that
+    takes, so it is off by default.
+    """
+
+    def __init__(self, sample_rate=100, memory_top=10, count_objects=False):
+        self.sample_rate = sample_rate
+        self.memory_top = memory_top
+        self.count_objects = count_objects
+        self.calls = {}
+        self._snapshot = None
+
+    def wrap(self, name, func):
+        """Return ``func`` wrapped so that its calls are profiled."""
+        self.calls[name] = CallStats()
+        sample_rate = self.sample_rate
+        calls = self.calls
+
+        @wraps(func)
+        def profiled(*args, **kw):
+            stats = calls[name]
+            stats.calls += 1
+            if stats.calls % sample_rate:
+                return func(*args, **kw)
+            allocated = gc.get_count()[0]
+            start = default_timer()
+            try:
+                return func(*args, **kw)
+            finally:
+                elapsed = default_timer() - start
+                allocations = gc.get_count()[0] - allocated
+                stats.sampled += 1
+                stats.time += elapsed
+                if elapsed > stats.max_time:
+                    stats.max_time = elapsed
+                if allocations >= 0:
+                    stats.allocations += allocations
+                    stats.allocation_samples += 1
+
+        return profiled
+
+    def snapshot_memory(self):
+        """
+        Return the biggest changes in memory use since the last snapshot,
+        or ``None`` if there is no cheap way to tell and counting objects
+        is off.
+        """
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            return self._diff_tracemalloc()
+        if self.count_objects:
+            return self._diff_object_counts()
+        return None
+
+    def _diff_tracemalloc(self):
+        snapshot = tracemalloc.take_snapshot()
+        if self._snapshot is None or not isinstance(
+                self._snapshot, tracemalloc.Snapshot):
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self._snapshot, 'lineno')
+        self._snapshot = snapshot
+        return {
+            'source': 'tracemalloc',
+            'top': [{
+                'where': str(stat.traceback),
+                'size': stat.size,
+                'size_diff': getattr(stat, 'size_diff', stat.size),
+                'count': stat.count,
+                'count_diff': getattr(stat, 'count_diff', stat.count),
+            } for stat in stats[:self.memory_top]],
+        }
+
+    def _diff_object_counts(self):
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        previous = self._snapshot
+        if not isinstance(previous, dict):
+            previous = {}
+        self._snapshot = counts
+        growth = sorted(
+            ((count - previous.get(name, 0), name, count)
+             for name, count in counts.iteritems()),
+            reverse=True)
+        return {
+            'source': 'gc',
+            'top': [{
+                'type': type_name,
+                'count': count,
+                'count_diff': diff,
+            } for diff, type_name, count in growth[:self.memory_top]],
+        }
+
+    def dump(self, path=None):
+        """
+        Return the costs since the last dump and reset them, appending them
+        as a line of JSON to the file at ``path`` if given.
+        """
+        report = {
+            'timestamp': time.time(),
+            'calls': dict(
+                (name, stats.get_stats())
+                for name, stats in self.calls.iteritems()),
+            'memory': self.snapshot_memory(),
+        }
+        for name in self.calls:
+            self.calls[name] = CallStats()
+        if path is not None:
+            with open(path, 'a') as profile_file:
+                profile_file.write(json.dumps(report, sort_keys=True) + '\n')
+        return report
@@ -0,0 +1,60 @@
+"""Token bucket rate limiting of inbound requests."""
+from vxblastsms.cache import TimedCache
+
+
+class TokenBucket(object):
+    """The state of one key's bucket."""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter(object):
+    """
+    Allows ``rate`` requests per second per key, with bursts of up to
+    ``burst`` requests.
+
+    A bucket that has been idle long enough to fill up again is the same
+    as a new one, so buckets are kept in a :class:`TimedCache` that
+    forgets them after that long. At most ``max_keys`` buckets are kept,
+    which only makes the limiter more lenient.
+    """
+
+    def __init__(self, rate, burst, clock, max_keys=100000):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self._buckets = TimedCache(burst / self.rate, max_keys, clock)
+        self.limited = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key):
+        """Take a token from ``key``'s bucket if there is one."""
+        now = self.clock.seconds()
+        bucket = self._buckets.touch(key)
+        if bucket is None:
+            self._buckets.set(key, TokenBucket(self.burst - 1, now))
+            return True
+        bucket.tokens = min(
+            self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens < 1:
+            self.limited += 1
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def expire(self):
+        """Forget buckets that have filled up again."""
+        self._buckets.expire()
+
+    def get_stats(self):
+        return {
+            'keys': len(self._buckets),
+            'limited': self.limited,
+            'evicted': self._buckets.evictions,
+        }
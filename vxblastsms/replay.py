@@ -0,0 +1,209 @@
+"""
+Replay captured BlastSMS traffic through the transport offline.
+
+The capture file holds one JSON object per line, with the ``timestamp`` in
+seconds that a request was received and its XML ``body``::
+
+    {"timestamp": 1480000000.25, "body": "<?xml ...><ussdresp>...</ussdresp>"}
+
+Requests are fed to a :class:`BlastSMSUssdTransport` running in process
+with an application that echoes them, either as fast as the transport
+answers them or at the speed they were captured. Throughput, latency and
+error counts are written as JSON. See :mod:`vxblastsms.harness` for how the
+transport is run, which needs vumi's test helpers.
+"""
+import argparse
+import json
+import sys
+import time
+
+import yaml
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.task import react
+
+from vxblastsms.harness import (
+    TransportHarness, send_all, summarise_results)
+
+
+def read_capture(capture_file):
+    """
+    Read ``(timestamp, body)`` pairs from the lines of ``capture_file``.
+    """
+    for line_number, line in enumerate(capture_file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            timestamp = float(record['timestamp'])
+            body = record['body'].encode('utf-8')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise ValueError('Invalid record on line %d: %r' % (
+                line_number, e))
+        yield timestamp, body
+
+
+def send_timed(harness, records, speed, clock=reactor):
+    """
+    Send the bodies of the ``(timestamp, body)`` pairs in ``records`` to
+    ``harness`` at their captured times, with time sped up by ``speed``.
+    Returns a Deferred that fires with the list of results and the
+    largest number of seconds a request was sent late, once every request
+    has finished, or fails with the first error raised while reading
+    ``records``.
+    """
+    done = Deferred()
+    results = []
+    state = {'sent': 0, 'sending': True, 'max_lag': 0.0, 'first': None}
+    records = iter(records)
+    start = clock.seconds()
+
+    def send(body, due):
+        state['max_lag'] = max(state['max_lag'], clock.seconds() - due)
+        state['sent'] += 1
+        harness.request(body).addCallback(finished)
+
+    def send_due():
+        try:
+            for timestamp, body in records:
+                if state['first'] is None:
+                    state['first'] = timestamp
+                due = start + (timestamp - state['first']) / float(speed)
+                if due > clock.seconds():
+                    clock.callLater(
+                        due - clock.seconds(), send_then_continue, body, due)
+                    return
+                send(body, due)
+        except Exception:
+            state['sending'] = False
+            if not done.called:
+                done.errback()
+            return
+        state['sending'] = False
+        check_done()
+
+    def send_then_continue(body, due):
+        send(body, due)
+        send_due()
+
+    def finished(result):
+        results.append(result)
+        check_done()
+
+    def check_done():
+        if (not state['sending'] and len(results) == state['sent'] and
+                not done.called):
+            done.callback((results, state['max_lag']))
+
+    send_due()
+    return done
+
+
+@inlineCallbacks
+def replay(harness, records, speed=None, concurrency=100):
+    """
+    Replay ``records`` through ``harness`` at ``speed`` times their
+    captured speed, or as fast as possible with at most ``concurrency``
+    requests open at a time if ``speed`` is ``None``, and return
+    throughput, latency and error figures.
+    """
+    start = time.time()
+    if speed is None:
+        results = yield send_all(
+            harness, (body for _, body in records), concurrency)
+        max_lag = None
+    else:
+        results, max_lag = yield send_timed(harness, records, speed)
+    duration = time.time() - start
+    yield harness.wait_idle()
+
+    result = summarise_results(results, duration)
+    result.update({
+        'speed': speed,
+        'concurrency': concurrency if speed is None else None,
+        'max_lag_ms': max_lag * 1000 if max_lag is not None else None,
+        'transport': harness.transport.get_stats(),
+    })
+    returnValue(result)
+
+
+def load_transport_config(path):
+    with open(path) as config_file:
+        config = yaml.safe_load(config_file) or {}
+    if not isinstance(config, dict):
+        raise ValueError('%s should contain a transport config mapping.' % (
+            path,))
+    return config
+
+
+def load_capture(path):
+    """
+    Read every record from the capture at ``path``, or standard input if
+    it is ``-``, so that a bad line is reported before anything is sent.
+    """
+    if path == '-':
+        return list(read_capture(sys.stdin))
+    with open(path) as capture_file:
+        return list(read_capture(capture_file))
+
+
+@inlineCallbacks
+def run_replay(reactor, args):
+    try:
+        transport_config = {}
+        if args.config:
+            transport_config = load_transport_config(args.config)
+        records = load_capture(args.capture)
+    except (IOError, ValueError) as e:
+        raise SystemExit('vxblastsms-replay: %s' % (e,))
+    harness = TransportHarness(transport_config)
+    yield harness.start()
+    try:
+        result = yield replay(
+            harness, records, args.speed, args.concurrency)
+    finally:
+        yield harness.stop()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(result, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay captured BlastSMS traffic through the transport.')
+    parser.add_argument(
+        'capture', metavar='CAPTURE',
+        help='File of captured requests, one JSON object with a timestamp '
+             'and a body per line, or - for standard input.')
+    parser.add_argument(
+        '--speed', type=float,
+        help='Replay at this multiple of the captured speed, for example 1 '
+             'for the captured speed. Defaults to as fast as possible.')
+    parser.add_argument(
+        '--concurrency', type=int, default=100,
+        help='Maximum number of open requests when replaying as fast as '
+             'possible.')
+    parser.add_argument(
+        '--config', metavar='FILE',
+        help='YAML file of transport config to replay with.')
+    parser.add_argument(
+        '--output', metavar='FILE',
+        help='Write the JSON results to FILE instead of standard output.')
+    args = parser.parse_args(argv)
+    if args.speed is not None and args.speed <= 0:
+        parser.error('--speed must be positive')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    return args
+
+
+def main(argv=None):
+    react(run_replay, [parse_args(argv)])
+
+
+if __name__ == '__main__':
+    main()
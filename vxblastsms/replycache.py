@@ -0,0 +1,95 @@
+"""A cache of pre-encoded replies."""
+import sys
+from collections import OrderedDict
+
+from vxblastsms.codec import DEFAULT_CODEC, REPLY_ENCODINGS
+
+
+class ReplyCache(object):
+    """
+    Encodes ``<ussdresp>`` replies, keeping the encoded ends of recent ones.
+
+    Everything after the ``sessionid`` of a reply depends only on its
+    ``msg``, ``type``, ``appid`` and encoding, and most replies are menus
+    that many subscribers see. The cache keeps the checked, truncated,
+    escaped and encoded end of the ``max_size`` most recently used
+    replies, so encoding a cached reply only escapes the msisdn and
+    sessionid. The least recently used ends are evicted when there are
+    more than ``max_size`` of them or they use more than about
+    ``max_bytes`` of memory.
+
+    Replies are encoded by the :class:`vxblastsms.codec.WireCodec`
+    ``codec``, which defaults to the BlastSMS XML format.
+    """
+
+    def __init__(self, max_size=1000, max_bytes=10 * 1024 * 1024,
+                 codec=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.codec = codec if codec is not None else DEFAULT_CODEC
+        self._ends = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.truncated = 0
+
+    def __len__(self):
+        return len(self._ends)
+
+    def _entry_bytes(self, key, entry):
+        return sys.getsizeof(key[0]) + sys.getsizeof(entry[0])
+
+    def encode(self, msisdn, sessionid, appid, type, msg, encoding=None,
+               max_length=None):
+        """
+        Return the same bytes as the codec's ``encode_response`` for
+        ``msg`` prepared with the :class:`ReplyEncoding` ``encoding``,
+        which defaults to UTF-8, and truncated to ``max_length``.
+
+        Raises :class:`vxblastsms.codec.EncodeError` if ``msg`` can't be
+        sent in ``encoding``.
+        """
+        if encoding is None:
+            encoding = REPLY_ENCODINGS['utf-8']
+        key = (msg, type, appid, encoding, max_length)
+        entry = self._ends.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+            self._ends[key] = entry
+        else:
+            self.misses += 1
+            text, truncated = encoding.prepare(msg, max_length)
+            entry = (
+                self.codec.encode_response_end(
+                    appid, type, text, encoding.charset),
+                truncated)
+            self._add(key, entry)
+        end, truncated = entry
+        if truncated:
+            self.truncated += 1
+        return self.codec.encode_response_start(
+            msisdn, sessionid, encoding.charset) + end
+
+    def _add(self, key, entry):
+        entry_bytes = self._entry_bytes(key, entry)
+        if self.max_size < 1 or entry_bytes > self.max_bytes:
+            return
+        self._ends[key] = entry
+        self.bytes += entry_bytes
+        while len(self._ends) > self.max_size or self.bytes > self.max_bytes:
+            evicted_key, evicted_entry = self._ends.popitem(last=False)
+            self.bytes -= self._entry_bytes(evicted_key, evicted_entry)
+            self.evictions += 1
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._ends),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'truncated': self.truncated,
+        }
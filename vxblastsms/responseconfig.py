@@ -0,0 +1,161 @@
+"""Per shortcode and per app settings for the replies we send."""
+import yaml
+
+from vxblastsms.codec import MAX_USSD_LENGTH, ReplyEncoding, get_reply_encoding
+
+
+def check_positive(name, value, types):
+    """
+    Raise :class:`ValueError` unless ``value`` is ``None`` or a positive
+    instance of ``types``. YAML gives us ``'5s'`` or ``true`` as happily as
+    ``5``, and those would only fail once a request used them.
+    """
+    if value is None:
+        return
+    if (not isinstance(value, types) or isinstance(value, bool) or
+            value <= 0):
+        raise ValueError('%s must be a positive number, not %r.' % (
+            name, value))
+
+
+def check_overrides(name, overrides):
+    """Raise :class:`ValueError` unless ``overrides`` is a dict."""
+    if not isinstance(overrides, dict):
+        raise ValueError('Settings for %s must be a mapping, not %r.' % (
+            name, overrides))
+
+
+class ResponseSettings(object):
+    """
+    The settings used to reply to a request. Instances are shared between
+    requests and must not be changed.
+
+    ``encoding`` is the name of a reply encoding from
+    :data:`vxblastsms.codec.REPLY_ENCODINGS`, and is checked along with the
+    messages we send on the application's behalf when the settings are
+    created.
+    """
+    FIELDS = ('app_id', 'reply_deadline', 'deadline_message', 'close_message',
+              'busy_message', 'encoding', 'max_reply_length')
+    __slots__ = FIELDS
+
+    def __init__(self, app_id=None, reply_deadline=None,
+                 deadline_message=None, close_message=None,
+                 busy_message=None, encoding='utf-8',
+                 max_reply_length=MAX_USSD_LENGTH):
+        self.app_id = app_id
+        self.reply_deadline = reply_deadline
+        self.deadline_message = deadline_message
+        self.close_message = close_message
+        self.busy_message = busy_message
+        if not isinstance(encoding, ReplyEncoding):
+            encoding = get_reply_encoding(encoding)
+        self.encoding = encoding
+        check_positive('reply_deadline', reply_deadline, (int, long, float))
+        check_positive('max_reply_length', max_reply_length, (int, long))
+        self.max_reply_length = max_reply_length
+        for message in (deadline_message, close_message, busy_message):
+            if message is not None and not isinstance(message, basestring):
+                raise ValueError('Messages must be strings, not %r.' % (
+                    message,))
+            if message:
+                encoding.prepare(message)
+
+    def replace(self, overrides):
+        """
+        Return new settings with the values in the ``overrides`` dict
+        replacing ours.
+        """
+        check_overrides('a shortcode or app', overrides)
+        unknown = set(overrides) - set(self.FIELDS)
+        if unknown:
+            raise ValueError('Unknown response settings: %s' % (
+                ', '.join(sorted(unknown)),))
+        values = dict((field, getattr(self, field)) for field in self.FIELDS)
+        values.update(overrides)
+        return ResponseSettings(**values)
+
+
+def config_key(key):
+    """
+    Return a shortcode or appid used as a config key as unicode, the way
+    requests give them. YAML loads unquoted keys like ``8864`` as numbers,
+    which would otherwise never match. Numbers with leading zeros have to
+    be quoted, because YAML reads them as octal.
+    """
+    if isinstance(key, str):
+        return key.decode('utf-8')
+    if isinstance(key, unicode):
+        return key
+    if isinstance(key, (int, long)) and not isinstance(key, bool):
+        return unicode(key)
+    raise ValueError(
+        'Shortcodes and appids must be strings, not %r.' % (key,))
+
+
+class ResponseConfigIndex(object):
+    """
+    Response settings resolved for every configured shortcode and app, so
+    that finding the settings for a request is a dict lookup.
+
+    :param ResponseSettings default:
+        Settings for shortcodes that aren't configured.
+    :param dict shortcodes:
+        Mapping of shortcode to a dict of settings overriding the defaults.
+        A shortcode's ``apps`` setting maps appids to settings overriding
+        the shortcode's. Keys are converted with :func:`config_key`.
+    """
+
+    def __init__(self, default, shortcodes=None):
+        self.default = default
+        self._index = {}
+        for shortcode, overrides in (shortcodes or {}).iteritems():
+            shortcode = config_key(shortcode)
+            check_overrides(shortcode, overrides)
+            overrides = dict(overrides)
+            apps = overrides.pop('apps', None) or {}
+            check_overrides('the apps of %s' % (shortcode,), apps)
+            settings = default.replace(overrides)
+            self._add((shortcode, None), settings)
+            for appid, app_overrides in apps.iteritems():
+                appid = config_key(appid)
+                check_overrides('%s %s' % (shortcode, appid), app_overrides)
+                self._add((shortcode, appid), settings.replace(app_overrides))
+
+    def _add(self, key, settings):
+        if key in self._index:
+            raise ValueError('Settings for %s given more than once.' % (
+                ' '.join(part for part in key if part is not None),))
+        self._index[key] = settings
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, shortcode, appid=None):
+        settings = self._index.get((shortcode, appid))
+        if settings is None:
+            if appid is not None:
+                settings = self._index.get((shortcode, None), self.default)
+            else:
+                settings = self.default
+        return settings
+
+
+def load_shortcodes_file(path):
+    """
+    Read shortcode settings from the YAML file at ``path``. The file holds
+    a ``shortcodes`` mapping in the same format as the transport's
+    ``shortcodes`` config.
+    """
+    with open(path) as config_file:
+        try:
+            data = yaml.safe_load(config_file)
+        except yaml.YAMLError as e:
+            raise ValueError('Invalid YAML in %s: %s' % (path, e))
+    if data is None:
+        return {}
+    if not isinstance(data, dict) or not isinstance(
+            data.get('shortcodes', {}), dict):
+        raise ValueError(
+            '%s should contain a mapping of shortcodes.' % (path,))
+    return data.get('shortcodes', {})
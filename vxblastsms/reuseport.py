@@ -0,0 +1,26 @@
+"""Sharing a listening port between transport processes."""
+import socket
+
+# Python 2 doesn't expose SO_REUSEPORT. This is its value on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def listen_reuse_port(reactor, port, factory, interface='', backlog=50):
+    """
+    Listen for TCP connections on ``port`` with ``SO_REUSEPORT`` set, so
+    that several processes can listen on the same port and have the
+    kernel spread incoming connections between them.
+
+    Returns the :class:`IListeningPort`.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # The reactor has its own copy of the file descriptor.
+        sock.close()
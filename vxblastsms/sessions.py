@@ -0,0 +1,149 @@
+"""Tracking of active USSD sessions."""
+import json
+import os
+
+from vxblastsms.cache import TimedCache
+
+
+class Session(object):
+    """
+    An active USSD session. ``steps`` is the number of requests in it that
+    the application was asked to answer.
+    """
+    __slots__ = ('sessionid', 'msisdn', 'shortcode', 'started_at', 'steps')
+
+    def __init__(self, sessionid, msisdn, shortcode, started_at):
+        self.sessionid = sessionid
+        self.msisdn = msisdn
+        self.shortcode = shortcode
+        self.started_at = started_at
+        self.steps = 1
+
+
+class SessionTable(object):
+    """
+    A bounded index of active sessions keyed by BlastSMS ``sessionid``.
+
+    Sessions that see no traffic for ``ttl`` seconds are dropped by
+    :meth:`expire`, and the least recently active session is dropped when
+    more than ``max_size`` sessions are open.
+
+    If given, ``on_end`` is called with every session that stops being
+    tracked and the reason: the one given to :meth:`close`, ``expired`` or
+    ``evicted``.
+    """
+
+    def __init__(self, ttl, max_size, clock, on_end=None):
+        self.clock = clock
+        self.on_end = on_end
+        self._sessions = TimedCache(ttl, max_size, clock)
+        self.opened = 0
+        self.closed = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, sessionid):
+        return sessionid in self._sessions
+
+    def get(self, sessionid):
+        return self._sessions.get(sessionid)
+
+    def open(self, sessionid, msisdn, shortcode):
+        """Start tracking a new session and return it."""
+        session = Session(sessionid, msisdn, shortcode, self.clock.seconds())
+        evicted = self._sessions.set(sessionid, session)
+        self.opened += 1
+        if self.on_end is not None:
+            for _, evicted_session in evicted:
+                self.on_end(evicted_session, 'evicted')
+        return session
+
+    def resume(self, sessionid, msisdn, shortcode):
+        """
+        Mark a session as active and return it. Sessions we don't know
+        about, for example because they were started before a restart, are
+        opened.
+        """
+        session = self._sessions.touch(sessionid)
+        if session is None:
+            session = self.open(sessionid, msisdn, shortcode)
+        else:
+            session.steps += 1
+        return session
+
+    def close(self, sessionid, reason=None):
+        """
+        Stop tracking a session. Returns the session, or ``None`` if it
+        wasn't being tracked.
+        """
+        session = self._sessions.pop(sessionid)
+        if session is not None:
+            self.closed += 1
+            if self.on_end is not None:
+                self.on_end(session, reason)
+        return session
+
+    def expire(self):
+        """Drop idle sessions and return them."""
+        expired = [session for _, session in self._sessions.expire()]
+        if self.on_end is not None:
+            for session in expired:
+                self.on_end(session, 'expired')
+        return expired
+
+    def save(self, path):
+        """
+        Write the active sessions to the file at ``path`` as JSON, so that
+        another process can :meth:`load` them. The file is replaced in one
+        step, so a reader never sees half of it.
+        """
+        snapshot = {
+            'timestamp': self.clock.seconds(),
+            'sessions': [
+                [session.sessionid, session.msisdn, session.shortcode,
+                 session.started_at, session.steps, active_at]
+                for _, active_at, session in self._sessions.iterentries()],
+        }
+        tmp_path = '%s.tmp' % (path,)
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.rename(tmp_path, path)
+        return len(snapshot['sessions'])
+
+    def load(self, path):
+        """
+        Start tracking the sessions in a file written by :meth:`save` that
+        haven't expired since. Returns the number of sessions loaded.
+        Raises ``IOError`` if the file can't be read and ``ValueError`` if
+        it isn't a snapshot.
+        """
+        with open(path) as snapshot_file:
+            try:
+                records = json.load(snapshot_file)['sessions']
+            except (KeyError, TypeError) as e:
+                raise ValueError('Invalid session snapshot: %r' % (e,))
+        deadline = self.clock.seconds() - self._sessions.ttl
+        loaded = 0
+        for record in records:
+            try:
+                (sessionid, msisdn, shortcode, started_at, steps,
+                 active_at) = record
+            except (TypeError, ValueError):
+                raise ValueError('Invalid session: %r' % (record,))
+            if active_at <= deadline:
+                continue
+            session = Session(sessionid, msisdn, shortcode, started_at)
+            session.steps = steps
+            self._sessions.set(sessionid, session, active_at)
+            loaded += 1
+        return loaded
+
+    def get_stats(self):
+        return {
+            'active': len(self._sessions),
+            'opened': self.opened,
+            'closed': self.closed,
+            'expired': self._sessions.expirations,
+            'evicted': self._sessions.evictions,
+        }
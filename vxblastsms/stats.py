@@ -0,0 +1,181 @@
+"""Cheap in-process statistics for the transport."""
+from bisect import bisect_left
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets. Recording a value is a binary search
+    over the bucket bounds and an increment, so it is cheap enough to do
+    for every message.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is for values larger than every bucket bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def get_stats(self):
+        buckets = dict(
+            (repr(bound), count)
+            for bound, count in zip(self.buckets, self.counts))
+        buckets['+Inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': buckets,
+        }
+
+
+class LatencyRecorder(object):
+    """A set of named latency histograms."""
+
+    def __init__(self, stages, buckets=LATENCY_BUCKETS):
+        self.histograms = dict(
+            (stage, Histogram(buckets)) for stage in stages)
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    def get_stats(self):
+        return dict(
+            (stage, histogram.get_stats())
+            for stage, histogram in self.histograms.iteritems())
+
+
+class RollingCounter(object):
+    """
+    Counts events over the last ``window`` seconds.
+
+    The window is split into ``slots`` slots, and the counts of slots that
+    have fallen out of the window are dropped when the clock moves into a
+    new slot. Adding an event and reading the total both cost O(1),
+    however many events there are, and the total covers between
+    ``window`` and ``window`` minus one slot's worth of seconds.
+
+    :param clock:
+        An object with a ``seconds()`` method, usually the reactor.
+    """
+
+    def __init__(self, window, clock, slots=60):
+        self.window = float(window)
+        self.clock = clock
+        self.slots = slots
+        self.slot_width = self.window / slots
+        self.counts = [0] * slots
+        self.count = 0
+        self._slot = None
+
+    def _current_slot(self):
+        """Drop slots that have left the window and return the current one."""
+        slot = int(self.clock.seconds() / self.slot_width)
+        if slot != self._slot:
+            if self._slot is None or not 0 < slot - self._slot < self.slots:
+                for index in xrange(self.slots):
+                    self._clear_slot(index)
+            else:
+                for old_slot in xrange(self._slot + 1, slot + 1):
+                    self._clear_slot(old_slot % self.slots)
+            self._slot = slot
+        return slot % self.slots
+
+    def _clear_slot(self, index):
+        self.count -= self.counts[index]
+        self.counts[index] = 0
+
+    def add(self, count=1):
+        self.counts[self._current_slot()] += count
+        self.count += count
+
+    def get_count(self):
+        self._current_slot()
+        return self.count
+
+    def get_rate(self):
+        """Events per second over the window."""
+        return self.get_count() / self.window
+
+
+class RollingHistogram(RollingCounter):
+    """
+    A :class:`Histogram` of the values recorded over the last ``window``
+    seconds. Recording a value costs the same as recording it in a
+    :class:`Histogram`, and reading the window's stats costs O(buckets).
+    """
+
+    def __init__(self, window, clock, slots=60, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.slot_buckets = [[0] * (len(self.buckets) + 1)
+                             for _ in xrange(slots)]
+        self.slot_sums = [0.0] * slots
+        self.slot_maxes = [0.0] * slots
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        super(RollingHistogram, self).__init__(window, clock, slots)
+
+    def _clear_slot(self, index):
+        super(RollingHistogram, self)._clear_slot(index)
+        slot_buckets = self.slot_buckets[index]
+        for bucket, count in enumerate(slot_buckets):
+            if count:
+                self.bucket_counts[bucket] -= count
+                slot_buckets[bucket] = 0
+        self.sum -= self.slot_sums[index]
+        self.slot_sums[index] = 0.0
+        self.slot_maxes[index] = 0.0
+
+    def record(self, value):
+        index = self._current_slot()
+        bucket = bisect_left(self.buckets, value)
+        self.slot_buckets[index][bucket] += 1
+        self.bucket_counts[bucket] += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.slot_sums[index] += value
+        self.sum += value
+        if value > self.slot_maxes[index]:
+            self.slot_maxes[index] = value
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound of the bucket holding the value ``fraction``
+        of the way through the window's values, or ``None`` if there are
+        none. The result is never more than the window's maximum.
+        """
+        if self.count == 0:
+            return None
+        window_max = max(self.slot_maxes)
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, window_max)
+        return window_max
+
+    def get_stats(self):
+        self._current_slot()
+        return {
+            'count': self.count,
+            'rate': self.count / self.window,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': max(self.slot_maxes),
+        }
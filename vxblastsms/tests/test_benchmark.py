@@ -0,0 +1,96 @@
+import json
+import os
+import sys
+from argparse import Namespace
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.benchmark import (
+    bench_regression, bench_restart, find_regressions, make_session_bodies,
+    run_load)
+from vxblastsms.harness import TransportHarness
+
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+class TestRunLoad(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.harness = TransportHarness()
+        yield self.harness.start()
+        self.add_cleanup(self.harness.stop)
+
+    @inlineCallbacks
+    def test_run_load(self):
+        result = yield run_load(self.harness, make_session_bodies(5), 3)
+        self.assertEqual(result['requests'], 20)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['concurrency'], 3)
+        self.assertEqual(
+            sorted(result['latency_ms']), ['max', 'p50', 'p99', 'p999'])
+        self.assertEqual(len(self.harness.transport._requests), 0)
+        self.assertEqual(len(self.harness.transport.sessions), 0)
+
+
+class TestBenchRestart(VumiTestCase):
+
+    @inlineCallbacks
+    def test_bench_restart(self):
+        result = yield bench_restart(Namespace(sessions=5, concurrency=3))
+        self.assertEqual(result['restored_sessions'], 5)
+        for name in ('drain_ms', 'warm_restart_ms', 'cold_restart_ms'):
+            self.assertTrue(result[name] >= 0)
+
+
+class TestRegressions(VumiTestCase):
+
+    def make_results(self, relative_time, allocations):
+        return {'paths': {'decode_request': {
+            'relative_time': relative_time, 'allocations': allocations}}}
+
+    def test_find_regressions(self):
+        baseline = self.make_results(1.0, 0.0)
+        self.assertEqual(
+            find_regressions(self.make_results(1.9, 0.05), baseline), [])
+        self.assertEqual(
+            find_regressions(self.make_results(2.5, 0.0), baseline),
+            ['decode_request takes 2.5 times the calibration, baseline 1.0'])
+        self.assertEqual(
+            find_regressions(self.make_results(1.0, 1.0), baseline),
+            ['decode_request leaves 1.00 objects allocated per call, '
+             'baseline 0.00'])
+        self.assertEqual(
+            find_regressions(
+                self.make_results(2.5, 0.0), baseline, time_tolerance=None),
+            [])
+
+    def test_find_regressions_new_path(self):
+        self.assertEqual(
+            find_regressions(
+                self.make_results(1.0, 0.0), {'paths': {}}), [])
+
+    def test_against_baseline(self):
+        """
+        The message handling paths are no slower and leave no more objects
+        allocated than when the baseline was recorded, with::
+
+            python -m vxblastsms.benchmark regression --number 10000 \\
+                --output vxblastsms/tests/benchmark_baseline.json
+
+        Times aren't checked when tracing (for coverage, say) or if
+        ``VXBLASTSMS_SKIP_TIMING_TESTS`` is set, for slow or busy machines.
+        """
+        with open(BASELINE_FILE) as baseline_file:
+            baseline = json.load(baseline_file)['benchmarks']['regression']
+        time_tolerance = 2.0
+        if (sys.gettrace() is not None or
+                os.environ.get('VXBLASTSMS_SKIP_TIMING_TESTS')):
+            time_tolerance = None
+        results = bench_regression(Namespace(number=300))
+        self.assertEqual(
+            find_regressions(results, baseline, time_tolerance), [])
@@ -0,0 +1,70 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.cache import TimedCache
+
+
+class TestTimedCache(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_set_and_get(self):
+        cache = TimedCache(10, None, self.clock)
+        self.assertEqual(cache.set('a', 1), [])
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertTrue('a' in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_pop(self):
+        cache = TimedCache(10, None, self.clock)
+        cache.set('a', 1)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'gone'), 'gone')
+        self.assertEqual(len(cache), 0)
+
+    def test_expire(self):
+        cache = TimedCache(10, None, self.clock)
+        cache.set('a', 1)
+        self.clock.advance(5)
+        cache.set('b', 2)
+        self.clock.advance(5)
+        self.assertEqual(cache.expire(), [('a', 1)])
+        self.assertEqual(cache.expire(), [])
+        self.clock.advance(5)
+        self.assertEqual(cache.expire(), [('b', 2)])
+        self.assertEqual(cache.get_stats(), {
+            'size': 0, 'evictions': 0, 'expirations': 2})
+
+    def test_touch(self):
+        cache = TimedCache(10, None, self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.clock.advance(5)
+        self.assertEqual(cache.touch('a'), 1)
+        self.assertEqual(cache.touch('c'), None)
+        self.clock.advance(5)
+        self.assertEqual(cache.expire(), [('b', 2)])
+        self.assertEqual(list(cache.itervalues()), [1])
+
+    def test_max_size(self):
+        cache = TimedCache(10, 2, self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.touch('a')
+        self.assertEqual(cache.set('c', 3), [('b', 2)])
+        self.assertEqual(sorted(cache.itervalues()), [1, 3])
+        self.assertEqual(cache.get_stats(), {
+            'size': 2, 'evictions': 1, 'expirations': 0})
+
+    def test_set_timestamp(self):
+        cache = TimedCache(10, None, self.clock)
+        self.clock.advance(20)
+        cache.set('a', 1, timestamp=5)
+        cache.set('b', 2)
+        self.assertEqual(
+            list(cache.iterentries()), [('a', 5, 1), ('b', 20, 2)])
+        self.assertEqual(cache.expire(), [('a', 1)])
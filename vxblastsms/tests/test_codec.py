@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+from StringIO import StringIO
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.codec import (
+    DecodeError, DomXmlCodec, EncodeError, LxmlXmlCodec, RequestTooLarge,
+    XmlCodec, decode_request, encode_response, encode_response_dom,
+    encode_response_end, encode_response_start, escape_text, get_codec,
+    get_reply_encoding, lxml_etree)
+
+
+class TestEncodeResponse(VumiTestCase):
+
+    defaults = {
+        'msisdn': u'273334444',
+        'sessionid': u'test_session_id',
+        'appid': u'test_app_id',
+        'type': u'2',
+        'msg': u'We are the Knights Who Say ... Ni!',
+    }
+
+    def assert_parity(self, **fields):
+        values = dict(self.defaults, **fields)
+        expected = encode_response_dom(**values)
+        self.assertEqual(encode_response(**values), expected)
+        self.assertEqual(
+            encode_response_start(values['msisdn'], values['sessionid']) +
+            encode_response_end(values['appid'], values['type'],
+                                values['msg']),
+            expected)
+
+    def test_defaults(self):
+        self.assert_parity()
+        self.assertEqual(
+            encode_response(**self.defaults),
+            '<?xml version="1.0" encoding="utf-8"?><ussdresp>'
+            '<msisdn>273334444</msisdn>'
+            '<sessionid>test_session_id</sessionid>'
+            '<appid>test_app_id</appid>'
+            '<type>2</type>'
+            '<msg>We are the Knights Who Say ... Ni!</msg>'
+            '</ussdresp>')
+
+    def test_none_fields(self):
+        for field in self.defaults:
+            self.assert_parity(**{field: None})
+        self.assert_parity(msisdn=None, sessionid=None, appid=None,
+                           type=None, msg=None)
+
+    def test_empty_fields(self):
+        for field in self.defaults:
+            self.assert_parity(**{field: u''})
+
+    def test_byte_strings(self):
+        self.assert_parity(msg='ascii only', appid='app')
+
+    def test_unicode(self):
+        self.assert_parity(msg=u'Thrëë, my lord.')
+        self.assert_parity(msg=u'Дякую, 谢谢, شكرا')
+        self.assert_parity(msg=u'\U0001f600 � ퟿ ')
+        self.assert_parity(appid=u'äpp', sessionid=u'séssion')
+
+    def test_markup_characters(self):
+        self.assert_parity(msg=u'<b>1 & 2</b> "quoted" \'single\'')
+        self.assert_parity(msg=u'&amp; already escaped &lt;')
+        self.assert_parity(msg=u']]> <![CDATA[ x ]]>')
+        self.assert_parity(appid=u'a&b', msisdn=u'<27>')
+
+    def test_whitespace(self):
+        self.assert_parity(msg=u'1. Yes\n2. No')
+        self.assert_parity(msg=u'1. Yes\r\n2. No\r3. Maybe')
+        self.assert_parity(msg=u'\ttabbed  ')
+        self.assert_parity(msg=u'   ')
+
+    def test_invalid_characters(self):
+        for char in [u'\x00', u'\x08', u'\x0b', u'\x1f', u'\ud800',
+                     u'\ufffe', u'\uffff']:
+            msg = u'bad %s char' % (char,)
+            self.assertRaises(
+                EncodeError, encode_response, **dict(self.defaults, msg=msg))
+            self.assertRaises(
+                Exception, encode_response_dom,
+                **dict(self.defaults, msg=msg))
+
+    def test_non_ascii_byte_string(self):
+        values = dict(self.defaults, msg=u'Thrëë'.encode('utf-8'))
+        self.assertRaises(UnicodeDecodeError, encode_response, **values)
+        self.assertRaises(UnicodeDecodeError, encode_response_dom, **values)
+
+    def test_escape_text(self):
+        self.assertEqual(escape_text(None), None)
+        self.assertEqual(escape_text(u''), None)
+        self.assertEqual(escape_text(u'a<b'), u'a&lt;b')
+        self.assertRaises(TypeError, escape_text, 27)
+
+
+class TestReplyEncodings(VumiTestCase):
+
+    def test_charset(self):
+        body = encode_response(
+            u'273334444', u'1', u'app', u'2', u'Thrëë', charset='iso-8859-1')
+        self.assertTrue(body.startswith(
+            '<?xml version="1.0" encoding="iso-8859-1"?><ussdresp>'))
+        self.assertTrue('<msg>Thr\xeb\xeb</msg>' in body)
+        self.assertEqual(
+            encode_response_start(u'273334444', u'1', 'iso-8859-1') +
+            encode_response_end(u'app', u'2', u'Thrëë', 'iso-8859-1'),
+            body)
+        self.assertRaises(
+            EncodeError, encode_response, u'273334444', u'1', u'app', u'2',
+            u'Дякую', charset='iso-8859-1')
+
+    def test_get_reply_encoding(self):
+        self.assertEqual(get_reply_encoding('UTF-8').charset, 'utf-8')
+        self.assertEqual(get_reply_encoding('gsm7').name, 'gsm7')
+        self.assertRaises(ValueError, get_reply_encoding, 'ebcdic')
+        self.assertRaises(ValueError, get_reply_encoding, None)
+
+    def test_utf8(self):
+        encoding = get_reply_encoding('utf-8')
+        self.assertEqual(encoding.prepare(u'Дякую'), (u'Дякую', False))
+        self.assertEqual(encoding.prepare(u'Дякую', 3), (u'Дяк', True))
+        self.assertEqual(encoding.prepare('ascii', 5), (u'ascii', False))
+        self.assertEqual(encoding.prepare(None, 5), (None, False))
+
+    def test_latin1(self):
+        encoding = get_reply_encoding('iso-8859-1')
+        self.assertEqual(encoding.prepare(u'Thrëë', 4), (u'Thrë', True))
+        self.assertRaises(EncodeError, encoding.prepare, u'Дякую')
+
+    def test_gsm7(self):
+        encoding = get_reply_encoding('gsm7')
+        self.assertEqual(encoding.charset, 'utf-8')
+        self.assertEqual(encoding.prepare(u'Ça co'), (u'Ça co', False))
+        self.assertRaises(EncodeError, encoding.prepare, u'Ça coûte 5€')
+        self.assertRaises(EncodeError, encoding.prepare, u'\U0001f600')
+        self.assertEqual(encoding.length(u'[1] Δ €5'), 11)
+        self.assertEqual(encoding.prepare(u'ab€', 3), (u'ab', True))
+        self.assertEqual(encoding.prepare(u'ab€', 4), (u'ab€', False))
+        self.assertEqual(encoding.prepare(u'a' * 200, 182)[0], u'a' * 182)
+
+
+class TestDecodeRequest(VumiTestCase):
+
+    body = (
+        '<?xml version="1.0" encoding="utf-8"?><ussdresp>'
+        '<msisdn>273334444</msisdn>'
+        '<shortcode>*1234#</shortcode>'
+        '<sessionid>test_session_id</sessionid>'
+        '<type>2</type>'
+        '<msg>1 &amp; 2</msg>'
+        '<appid/>'
+        '</ussdresp>')
+
+    expected = {
+        'msisdn': '273334444',
+        'shortcode': '*1234#',
+        'sessionid': 'test_session_id',
+        'type': '2',
+        'msg': '1 & 2',
+    }
+
+    def test_decode(self):
+        self.assertEqual(decode_request(self.body), self.expected)
+
+    def test_decode_file(self):
+        self.assertEqual(decode_request(StringIO(self.body)), self.expected)
+
+    def test_decode_unicode(self):
+        body = self.body.replace('1 &amp; 2', u'Thrëë'.encode('utf-8'))
+        self.assertEqual(decode_request(body)['msg'], u'Thrëë'.encode('utf-8'))
+
+    def test_decode_across_chunks(self):
+        body = self.body.replace('1 &amp; 2', 'x' * 5000)
+        self.assertEqual(decode_request(body)['msg'], 'x' * 5000)
+
+    def test_stop_fields(self):
+        body = self.body.replace('<appid/>', '<appid/>' + '<junk/>' * 1000)
+        self.assertEqual(
+            decode_request(body, stop_fields=set(self.expected) | {'appid'}),
+            self.expected)
+        self.assertEqual(
+            decode_request(body + '<trailing garbage', stop_fields=set([
+                'msisdn', 'shortcode', 'sessionid', 'type', 'msg', 'appid'])),
+            self.expected)
+
+    def test_max_size(self):
+        self.assertEqual(
+            decode_request(self.body, max_size=len(self.body)), self.expected)
+        err = self.assertRaises(
+            RequestTooLarge, decode_request, self.body,
+            max_size=len(self.body) - 1)
+        self.assertEqual(err.reason, 'request_too_large')
+        self.assertRaises(
+            RequestTooLarge, decode_request, StringIO(self.body),
+            max_size=10)
+
+    def test_malformed(self):
+        err = self.assertRaises(
+            DecodeError, decode_request, self.body[:-3])
+        self.assertEqual(err.reason, 'invalid_xml')
+        err = self.assertRaises(DecodeError, decode_request, '')
+        self.assertEqual(err.reason, 'invalid_xml')
+
+    def test_nesting(self):
+        body = self.body.replace(
+            '<appid/>', '<appid><a><b>c</b></a></appid>')
+        err = self.assertRaises(DecodeError, decode_request, body)
+        self.assertEqual(err.reason, 'unexpected_nesting')
+
+    def test_doctype(self):
+        body = (
+            '<?xml version="1.0"?>'
+            '<!DOCTYPE lolz [<!ENTITY lol "lol">]>'
+            '<ussdresp><msg>&lol;</msg></ussdresp>')
+        err = self.assertRaises(DecodeError, decode_request, body)
+        self.assertEqual(err.reason, 'unexpected_doctype')
+
+    def test_unsupported_encoding(self):
+        # expat can't decode multi-byte encodings other than UTF-8 and
+        # UTF-16.
+        body = '<?xml version="1.0" encoding="utf-7"?><ussdresp/>'
+        err = self.assertRaises(DecodeError, decode_request, body)
+        self.assertEqual(err.reason, 'invalid_xml')
+
+
+class CodecConformanceMixin(object):
+    """
+    Checks that a codec decodes the same requests and encodes the same
+    replies as the others. Subclasses set ``codec_class``.
+    """
+
+    codec_class = None
+    # Whether replies are byte for byte the same as the reference encoder's.
+    byte_identical = True
+
+    requests = [
+        (TestDecodeRequest.body, TestDecodeRequest.expected),
+        ('<ussdresp><msisdn>27</msisdn><msg><![CDATA[<1>]]></msg>'
+         '<!-- comment --><type>1</type></ussdresp>',
+         {'msisdn': '27', 'msg': '<1>', 'type': '1'}),
+        ('<ussdresp><msg>Thr\xc3\xab\xc3\xab<!-- x --> 2</msg></ussdresp>',
+         {'msg': 'Thr\xc3\xab\xc3\xab 2'}),
+        ('<ussdresp><msg>  </msg><appid></appid><extra>x</extra></ussdresp>',
+         {'msg': '  ', 'extra': 'x'}),
+    ]
+
+    invalid_requests = [
+        ('invalid_xml', ''),
+        ('invalid_xml', TestDecodeRequest.body[:-3]),
+        ('invalid_xml', '<ussdresp><msg>1</ussdresp>'),
+        ('unexpected_nesting', TestDecodeRequest.body.replace(
+            '<appid/>', '<appid><a>b</a></appid>')),
+        ('unexpected_doctype',
+         '<?xml version="1.0"?><!DOCTYPE lolz [<!ENTITY lol "lol">]>'
+         '<ussdresp><msg>&lol;</msg></ussdresp>'),
+        ('invalid_xml', '<?xml version="1.0" encoding="ut-8"?><ussdresp/>'),
+        ('invalid_xml',
+         '<ussdresp><msg><![CDATA[' + u'€'.encode('utf-8') * 20 + '\xe2'),
+    ]
+
+    replies = [
+        TestEncodeResponse.defaults,
+        dict(TestEncodeResponse.defaults, appid=None, msg=u''),
+        dict(TestEncodeResponse.defaults, msg=u'Thrëë, Дякую, 谢谢 \U0001f600'),
+        dict(TestEncodeResponse.defaults,
+             msg=u'<b>1 & 2</b> "quoted" ]]> \'single\'\n\ttabbed  '),
+        dict(TestEncodeResponse.defaults, appid='app', msg='ascii only'),
+    ]
+
+    def get_codec(self):
+        return self.codec_class()
+
+    def test_decode(self):
+        codec = self.get_codec()
+        for body, expected in self.requests:
+            self.assertEqual(codec.decode_request(body), expected)
+            self.assertEqual(
+                codec.decode_request(StringIO(body), max_size=len(body)),
+                expected)
+
+    def test_decode_invalid(self):
+        codec = self.get_codec()
+        for reason, body in self.invalid_requests:
+            err = self.assertRaises(DecodeError, codec.decode_request, body)
+            self.assertEqual(err.reason, reason)
+
+    def test_decode_too_large(self):
+        codec = self.get_codec()
+        body = TestDecodeRequest.body
+        self.assertRaises(
+            RequestTooLarge, codec.decode_request, body,
+            max_size=len(body) - 1)
+        self.assertRaises(
+            RequestTooLarge, codec.decode_request, StringIO(body),
+            max_size=10)
+
+    def test_encode(self):
+        codec = self.get_codec()
+        for values in self.replies:
+            body = codec.encode_response(**values)
+            self.assertEqual(
+                codec.encode_response_start(
+                    values['msisdn'], values['sessionid']) +
+                codec.encode_response_end(
+                    values['appid'], values['type'], values['msg']),
+                body)
+            if self.byte_identical:
+                self.assertEqual(body, encode_response_dom(**values))
+            expected = dict(
+                (field, unicode(value).encode('utf-8'))
+                for field, value in values.iteritems() if value)
+            self.assertEqual(codec.decode_request(body), expected)
+
+    def test_encode_charset(self):
+        codec = self.get_codec()
+        values = dict(TestEncodeResponse.defaults, msg=u'Thrëë')
+        body = codec.encode_response(charset='iso-8859-1', **values)
+        self.assertTrue(body.startswith(
+            '<?xml version="1.0" encoding="iso-8859-1"?><ussdresp>'))
+        self.assertTrue('<msg>Thr\xeb\xeb</msg>' in body)
+        self.assertEqual(
+            codec.decode_request(body)['msg'], 'Thr\xc3\xab\xc3\xab')
+        self.assertRaises(
+            EncodeError, codec.encode_response, charset='iso-8859-1',
+            **dict(values, msg=u'Дякую'))
+
+    def test_encode_invalid_characters(self):
+        codec = self.get_codec()
+        for char in [u'\x00', u'\x0b', u'\ufffe']:
+            self.assertRaises(
+                EncodeError, codec.encode_response,
+                **dict(TestEncodeResponse.defaults, msg=u'bad %s' % (char,)))
+
+    def test_variant_schema(self):
+        codec = self.codec_class(
+            root='ussd', tags={'sessionid': 'session_id', 'msg': 'text'})
+        body = codec.encode_response(**TestEncodeResponse.defaults)
+        self.assertTrue(body.startswith(
+            '<?xml version="1.0" encoding="utf-8"?><ussd><msisdn>'))
+        self.assertTrue(body.endswith('</text></ussd>'))
+        self.assertTrue(
+            '<session_id>test_session_id</session_id>' in body)
+        self.assertEqual(codec.decode_request(body)['sessionid'],
+                         'test_session_id')
+        self.assertEqual(
+            codec.decode_request(
+                '<ussd><session_id>1</session_id><text>hi</text>'
+                '<msg>x</msg></ussd>'),
+            {'sessionid': '1', 'msg': 'hi'})
+
+    def test_invalid_schema(self):
+        self.assertRaises(ValueError, self.codec_class, tags={'foo': 'bar'})
+        self.assertRaises(ValueError, self.codec_class, tags={'msg': 'type'})
+
+
+class TestXmlCodec(CodecConformanceMixin, VumiTestCase):
+    codec_class = XmlCodec
+
+
+class TestDomXmlCodec(CodecConformanceMixin, VumiTestCase):
+    codec_class = DomXmlCodec
+
+
+class TestLxmlXmlCodec(CodecConformanceMixin, VumiTestCase):
+    codec_class = LxmlXmlCodec
+    # lxml doesn't escape quotes in text.
+    byte_identical = False
+
+    if lxml_etree is None:
+        skip = 'lxml is not installed.'
+
+
+class TestGetCodec(VumiTestCase):
+
+    def test_builtin(self):
+        codec = get_codec('dom', {'root': 'ussd'})
+        self.assertTrue(isinstance(codec, DomXmlCodec))
+        self.assertEqual(codec.root, 'ussd')
+        self.assertTrue(isinstance(get_codec('xml'), XmlCodec))
+
+    def test_class_path(self):
+        self.assertTrue(isinstance(
+            get_codec('vxblastsms.codec.DomXmlCodec'), DomXmlCodec))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, get_codec, 'nope')
+        self.assertRaises(ValueError, get_codec, 'vxblastsms.codec.nope')
+        self.assertRaises(ValueError, get_codec, 'vxblastsms.codec.ENCODING')
+        self.assertRaises(ValueError, get_codec, 'xml', {'foo': 'bar'})
@@ -0,0 +1,73 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.dedupe import DedupeIndex
+
+
+class TestDedupeIndex(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.index = DedupeIndex(2, 10, self.clock)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('key'), None)
+        self.index.add('key', 'req-1')
+        seen = self.index.lookup('key')
+        self.assertEqual(seen.request_id, 'req-1')
+        self.assertEqual(seen.response, None)
+        self.assertEqual(self.index.get_stats(), {
+            'size': 1,
+            'hits': 1,
+            'misses': 1,
+            'hit_rate': 0.5,
+            'evictions': 0,
+        })
+
+    def test_complete(self):
+        self.index.add('key', 'req-1')
+        self.index.lookup('key').waiting.append('req-2')
+        self.assertEqual(
+            self.index.complete('key', 'req-1', ('body', 200)), ['req-2'])
+        seen = self.index.lookup('key')
+        self.assertEqual(seen.response, ('body', 200))
+        self.assertEqual(seen.waiting, [])
+
+    def test_complete_other_request(self):
+        self.index.add('key', 'req-1')
+        self.assertEqual(
+            self.index.complete('key', 'req-2', ('body', 200)), [])
+        self.assertEqual(self.index.lookup('key').response, None)
+
+    def test_discard(self):
+        self.index.add('key', 'req-1')
+        self.index.discard('key', 'req-2')
+        self.assertEqual(len(self.index), 1)
+        self.index.discard('key', 'req-1')
+        self.assertEqual(len(self.index), 0)
+
+    def test_discard_answered(self):
+        self.index.add('key', 'req-1')
+        self.index.complete('key', 'req-1', ('body', 200))
+        self.index.discard('key', 'req-1')
+        self.assertEqual(len(self.index), 1)
+
+    def test_expire(self):
+        self.index.add('key', 'req-1')
+        self.clock.advance(1.5)
+        # The window restarts when the reply is sent.
+        self.index.complete('key', 'req-1', ('body', 200))
+        self.clock.advance(1.5)
+        self.index.expire()
+        self.assertEqual(len(self.index), 1)
+        self.clock.advance(0.5)
+        self.index.expire()
+        self.assertEqual(len(self.index), 0)
+
+    def test_max_size(self):
+        index = DedupeIndex(2, 2, self.clock)
+        for i in range(3):
+            index.add(i, 'req-%d' % (i,))
+        self.assertEqual(index.lookup(0), None)
+        self.assertEqual(index.get_stats()['evictions'], 1)
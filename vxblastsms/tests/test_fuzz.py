@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+Randomised tests of the XML request and reply paths.
+
+The cases come from a seeded random number generator, so a failure can be
+reproduced by setting ``VXBLASTSMS_FUZZ_SEED`` to the seed in its message.
+``VXBLASTSMS_FUZZ_ITERATIONS`` sets how many cases each test tries.
+"""
+import os
+import random
+import sys
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.httprpc.tests.helpers import HttpRpcTransportHelper
+
+from vxblastsms.codec import (
+    CODECS, GSM7_BASIC_CHARS, GSM7_EXTENSION_CHARS, REQUEST_FIELDS,
+    DecodeError, EncodeError, RequestTooLarge, XmlCodec, encode_response_dom)
+from vxblastsms.responseconfig import ResponseSettings
+from vxblastsms.ussd import BlastSMSUssdTransport
+
+
+SEED = int(os.environ.get('VXBLASTSMS_FUZZ_SEED', '1476748800'))
+ITERATIONS = int(os.environ.get('VXBLASTSMS_FUZZ_ITERATIONS', '200'))
+
+# Characters that may appear in XML text. Carriage returns are left out,
+# because parsers turn them into newlines.
+ALPHABETS = [
+    u'abcdefghijklmnopqrstuvwxyz0123456789 ',
+    u'*#.,:;!?-_()[]{}^~|\\/\t\n',
+    u'&<>"\'',
+    u'àéñßØΔΣдя谢شكر€¤',
+]
+if sys.maxunicode > 0xffff:
+    ALPHABETS.append(u'\U0001f600\U00010348')
+
+# Characters that can't be sent in XML 1.0.
+INVALID_CHARS = u'\x00\x01\x08\x0b\x0c\x1f\ufffe\uffff'
+
+WHITESPACE = (u'', u'', u' ', u'\n', u'\n  ', u'\t')
+
+
+def random_text(rng, max_length, min_length=0, alphabets=ALPHABETS):
+    alphabet = u''.join(rng.sample(alphabets, rng.randint(1, len(alphabets))))
+    return u''.join(
+        rng.choice(alphabet)
+        for _ in xrange(rng.randint(min_length, max_length)))
+
+
+def random_request_values(rng):
+    """The fields of a valid request, with missing ones empty."""
+    return {
+        'msisdn': u''.join(
+            rng.choice(u'0123456789') for _ in xrange(rng.randint(5, 15))),
+        'shortcode': u'*120*%d#' % (rng.randint(1, 99999),),
+        'sessionid': random_text(rng, 40, min_length=1),
+        'type': rng.choice(u'1234'),
+        'msg': random_text(rng, 300) if rng.random() < 0.8 else u'',
+        'appid': random_text(rng, 20) if rng.random() < 0.5 else u'',
+    }
+
+
+def encode_chunk(rng, chunk):
+    style = rng.choice(('escape', 'reference', 'cdata', 'comment'))
+    if style == 'cdata' and u']]>' not in chunk:
+        return u'<![CDATA[%s]]>' % (chunk,)
+    if style == 'reference':
+        return u''.join(
+            (u'&#%d;' if rng.random() < 0.5 else u'&#x%x;') % (ord(char),)
+            for char in chunk)
+    text = (chunk.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+            .replace(u'>', u'&gt;'))
+    if style == 'comment':
+        text += u'<!-- - -->'
+    return text
+
+
+def encode_text(rng, text):
+    """Write ``text`` as XML, in randomly sized and escaped chunks."""
+    parts = []
+    while text:
+        size = rng.randint(1, len(text))
+        parts.append(encode_chunk(rng, text[:size]))
+        text = text[size:]
+    return u''.join(parts)
+
+
+def make_request_body(rng, values):
+    fields = list(REQUEST_FIELDS)
+    rng.shuffle(fields)
+    parts = []
+    if rng.random() < 0.8:
+        parts.append(u'<?xml version="1.0" encoding="utf-8"?>')
+    parts.append(u'<ussdresp>')
+    for field in fields:
+        parts.append(rng.choice(WHITESPACE))
+        value = values[field]
+        if value:
+            attributes = u' lang="en"' if rng.random() < 0.1 else u''
+            parts.append(u'<%s%s>%s</%s>' % (
+                field, attributes, encode_text(rng, value), field))
+        elif rng.random() < 0.5:
+            parts.append(rng.choice((u'<%s/>', u'<%s></%s>')).replace(
+                u'%s', field))
+    parts.append(rng.choice(WHITESPACE))
+    parts.append(u'</ussdresp>')
+    return u''.join(parts).encode('utf-8')
+
+
+def expected_request_data(values):
+    return dict(
+        (field, value.encode('utf-8'))
+        for field, value in values.iteritems() if value)
+
+
+def mutate(rng, body):
+    """Break ``body`` in one of a number of ways."""
+    position = rng.randint(0, len(body))
+    mutation = rng.choice((
+        'truncate', 'byte', 'invalid_char', 'delete', 'nest', 'doctype',
+        'repeat', 'tag'))
+    if mutation == 'truncate':
+        return body[:position]
+    if mutation == 'byte':
+        return body[:position] + chr(rng.randrange(256)) + body[position:]
+    if mutation == 'invalid_char':
+        char = rng.choice(INVALID_CHARS).encode('utf-8')
+        return body[:position] + char + body[position:]
+    if mutation == 'delete':
+        return body[:position] + body[position + 1:]
+    if mutation == 'nest':
+        return body.replace('</msisdn>', '<b>1</b></msisdn>')
+    if mutation == 'doctype':
+        doctype = '<!DOCTYPE ussdresp [<!ENTITY e "Ni!">]>'
+        end = body.find('?>') + 2
+        if body.startswith('<?xml') and end > 1:
+            return body[:end] + doctype + body[end:].replace(
+                '</type>', '&e;</type>')
+        return doctype + body
+    if mutation == 'repeat':
+        return body + body[:position]
+    return body[:position] + rng.choice(('<', '>', '</', '&', ']]>')) + (
+        body[position:])
+
+
+def decode_all(codecs, body):
+    """
+    Decode ``body`` with each codec, giving :class:`DecodeError` for the
+    codecs that rejected it. Any other exception is a bug.
+    """
+    results = []
+    for codec in codecs:
+        try:
+            results.append(codec.decode_request(body))
+        except DecodeError:
+            results.append(DecodeError)
+    return results
+
+
+def normalise_newlines(text):
+    return text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+
+
+class FakeRequest(object):
+    """Just enough of a request to decode its body."""
+
+    def __init__(self, body):
+        self.content = StringIO(body)
+
+
+class TestDecodeFuzz(VumiTestCase):
+
+    def setUp(self):
+        self.rng = random.Random(SEED)
+        self.codecs = [codec_class() for _, codec_class in sorted(
+            CODECS.iteritems())]
+
+    def case(self, iteration, body):
+        return 'seed %d, case %d: %r' % (SEED, iteration, body)
+
+    def test_round_trip(self):
+        for iteration in xrange(ITERATIONS):
+            values = random_request_values(self.rng)
+            body = make_request_body(self.rng, values)
+            expected = expected_request_data(values)
+            case = self.case(iteration, body)
+            for codec in self.codecs:
+                self.assertEqual(codec.decode_request(body), expected, case)
+                self.assertEqual(
+                    codec.decode_request(StringIO(body), len(body)),
+                    expected, case)
+                stop_fields = set(self.rng.sample(
+                    REQUEST_FIELDS, self.rng.randint(1, len(REQUEST_FIELDS))))
+                decoded = codec.decode_request(body, None, stop_fields)
+                for field in stop_fields:
+                    self.assertEqual(
+                        decoded.get(field), expected.get(field), case)
+
+    def test_too_large(self):
+        codec = XmlCodec()
+        for iteration in xrange(ITERATIONS):
+            body = make_request_body(
+                self.rng, random_request_values(self.rng))
+            max_size = self.rng.randint(len(body) // 2, len(body) * 2)
+            case = self.case(iteration, body)
+            if len(body) > max_size:
+                self.assertRaises(
+                    RequestTooLarge, codec.decode_request, StringIO(body),
+                    max_size)
+            else:
+                self.assertEqual(
+                    codec.decode_request(StringIO(body), max_size),
+                    codec.decode_request(body), case)
+
+    def test_invalid_bodies(self):
+        """
+        Broken bodies are only ever rejected with :class:`DecodeError`,
+        and the streaming decoder agrees with the DOM reference about them.
+
+        expat doesn't check the bytes of markup the streaming decoder
+        ignores, such as comments, so they are only compared for bodies
+        that are valid UTF-8.
+        """
+        xml_codec = XmlCodec()
+        dom_codec = CODECS['dom']()
+        for iteration in xrange(ITERATIONS):
+            body = make_request_body(
+                self.rng, random_request_values(self.rng))
+            for _ in xrange(self.rng.randint(1, 3)):
+                body = mutate(self.rng, body)
+            case = self.case(iteration, body)
+            results = decode_all(self.codecs, body)
+            try:
+                body.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+            else:
+                self.assertEqual(
+                    decode_all([xml_codec], body),
+                    decode_all([dom_codec], body), case)
+            for result in results:
+                if result is not DecodeError:
+                    self.assertTrue(isinstance(result, dict), case)
+
+
+class TestTransportFuzz(VumiTestCase):
+
+    def setUp(self):
+        self.rng = random.Random(SEED)
+        self.tx_helper = self.add_helper(
+            HttpRpcTransportHelper(BlastSMSUssdTransport))
+
+    def get_transport(self, config={}):
+        defaults = {
+            'app_id': 'test_config_app_id',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+        }
+        defaults.update(config)
+        return self.tx_helper.get_transport(defaults)
+
+    def case(self, iteration, value):
+        return 'seed %d, case %d: %r' % (SEED, iteration, value)
+
+    def assert_requests_round_trip(self, transport):
+        for iteration in xrange(ITERATIONS):
+            values = random_request_values(self.rng)
+            body = make_request_body(self.rng, values)
+            case = self.case(iteration, body)
+            request_data = transport.get_request_data_dict(
+                FakeRequest(body))
+            self.assertEqual(
+                request_data, expected_request_data(values), case)
+            self.assertEqual(
+                transport.get_field_values(request_data),
+                dict((field, value or None)
+                     for field, value in values.iteritems()),
+                case)
+
+            broken = mutate(self.rng, body)
+            try:
+                transport.get_request_data_dict(FakeRequest(broken))
+            except DecodeError:
+                pass
+
+    @inlineCallbacks
+    def test_requests_strict(self):
+        transport = yield self.get_transport()
+        self.assert_requests_round_trip(transport)
+
+    @inlineCallbacks
+    def test_requests_permissive(self):
+        transport = yield self.get_transport(
+            {'validation_mode': 'permissive'})
+        self.assert_requests_round_trip(transport)
+
+    def random_reply_content(self):
+        content = random_text(self.rng, 300, min_length=1)
+        if self.rng.random() < 0.2:
+            position = self.rng.randint(0, len(content))
+            content = (content[:position] +
+                       self.rng.choice((u'\r', u'\r\n', u'\n\r')) +
+                       content[position:])
+        if self.rng.random() < 0.1:
+            position = self.rng.randint(0, len(content))
+            content = (content[:position] +
+                       self.rng.choice(INVALID_CHARS) + content[position:])
+        return content
+
+    def can_send(self, encoding, text):
+        if encoding == 'iso-8859-1':
+            return all(ord(char) < 256 for char in text)
+        if encoding == 'gsm7':
+            return all(
+                char in GSM7_BASIC_CHARS or char in GSM7_EXTENSION_CHARS
+                for char in text)
+        return True
+
+    @inlineCallbacks
+    def test_replies(self):
+        """
+        Replies are refused with :class:`EncodeError` or decode back to
+        what was sent, truncated and with newlines normalised. UTF-8
+        replies are the same bytes as the DOM reference encoder's.
+        """
+        transport = yield self.get_transport()
+        codec = XmlCodec()
+        for iteration in xrange(ITERATIONS):
+            content = self.random_reply_content()
+            encoding = self.rng.choice(('utf-8', 'iso-8859-1', 'gsm7'))
+            settings = ResponseSettings(
+                app_id=u'test_config_app_id', encoding=encoding,
+                max_reply_length=self.rng.choice((None, 1, 50, 182)))
+            msisdn = u'27%09d' % (self.rng.randrange(10 ** 9),)
+            sessionid = random_text(
+                self.rng, 40, min_length=1, alphabets=ALPHABETS[:3])
+            session_event = self.rng.choice((
+                TransportUserMessage.SESSION_RESUME,
+                TransportUserMessage.SESSION_CLOSE))
+            case = self.case(iteration, (content, encoding))
+
+            if not self.can_send(encoding, content):
+                self.assertRaises(
+                    EncodeError, transport.generate_body, msisdn, sessionid,
+                    None, 'id', content, session_event, settings)
+                continue
+            text = settings.encoding.prepare(
+                content, settings.max_reply_length)[0]
+            if any(char in INVALID_CHARS for char in text):
+                self.assertRaises(
+                    EncodeError, transport.generate_body, msisdn, sessionid,
+                    None, 'id', content, session_event, settings)
+                continue
+
+            body = transport.generate_body(
+                msisdn, sessionid, None, 'id', content, session_event,
+                settings)
+            reply_type = (
+                '3' if session_event == TransportUserMessage.SESSION_CLOSE
+                else '2')
+            expected = {
+                'msisdn': msisdn.encode('utf-8'),
+                'sessionid': normalise_newlines(sessionid).encode('utf-8'),
+                'appid': 'test_config_app_id',
+                'type': reply_type,
+            }
+            if text:
+                # Truncating to one septet can leave nothing.
+                expected['msg'] = normalise_newlines(text).encode('utf-8')
+            self.assertEqual(codec.decode_request(body), expected, case)
+            if settings.encoding.charset == 'utf-8':
+                self.assertEqual(body, encode_response_dom(
+                    msisdn, sessionid, u'test_config_app_id', reply_type,
+                    text), case)
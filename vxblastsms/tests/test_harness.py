@@ -0,0 +1,65 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.benchmark import make_request_body
+from vxblastsms.harness import (
+    HarnessRequest, TransportHarness, send_all, summarise_results)
+
+
+class TestHarnessRequest(VumiTestCase):
+
+    def test_finish(self):
+        request = HarnessRequest('<ussdresp/>')
+        self.assertEqual(request.content.read(), '<ussdresp/>')
+        d = request.notifyFinish()
+        request.setResponseCode(400)
+        request.setHeader('Content-Type', 'text/xml')
+        request.write('Ni!')
+        self.assertFalse(d.called)
+        request.finish()
+        self.assertTrue(d.called)
+        self.assertTrue(request.notifyFinish().called)
+        self.assertEqual(request.responseCode, 400)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-type'),
+            ['text/xml'])
+        self.assertEqual(request.written, ['Ni!'])
+
+
+class TestTransportHarness(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.harness = TransportHarness()
+        yield self.harness.start()
+        self.add_cleanup(self.harness.stop)
+
+    @inlineCallbacks
+    def test_request(self):
+        code, body, latency = yield self.harness.request(
+            make_request_body(msg='Ni!'))
+        self.assertEqual(code, 200)
+        self.assertTrue('<msg>Ni!</msg>' in body)
+        self.assertTrue(latency >= 0)
+
+    @inlineCallbacks
+    def test_send_all(self):
+        bodies = [make_request_body(sessionid=str(i)) for i in range(5)]
+        results = yield send_all(self.harness, bodies, 2)
+        summary = summarise_results(results, 1.0)
+        self.assertEqual(summary['requests'], 5)
+        self.assertEqual(summary['errors'], 0)
+        self.assertEqual(summary['status_codes'], {'200': 5})
+        self.assertEqual(summary['throughput_rps'], 5.0)
+
+    @inlineCallbacks
+    def test_send_all_bodies_error(self):
+        def bodies():
+            for i in range(3):
+                yield make_request_body(sessionid=str(i))
+            raise ValueError('Invalid record on line 4')
+
+        err = yield self.assertFailure(
+            send_all(self.harness, bodies(), 2), ValueError)
+        self.assertEqual(str(err), 'Invalid record on line 4')
@@ -0,0 +1,59 @@
+import json
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.journeys import OTHER_SHORTCODES, JourneyAggregator
+
+
+class TestJourneyAggregator(VumiTestCase):
+
+    def test_record_step(self):
+        journeys = JourneyAggregator(max_steps=2)
+        journeys.record_step('*120#', 1, 0.2)
+        journeys.record_step('*120#', 1, 0.4)
+        journeys.record_step('*120#', 3, 0.1)
+        journeys.record_step('*120#', 7, 0.1)
+        latencies = journeys.get_stats()['*120#']['step_latencies']
+        self.assertEqual(sorted(latencies), ['1', '3+'])
+        self.assertEqual(latencies['1']['count'], 2)
+        self.assertEqual(latencies['1']['max'], 0.4)
+        self.assertEqual(latencies['3+']['count'], 2)
+
+    def test_record_end(self):
+        journeys = JourneyAggregator(max_steps=3)
+        journeys.record_end('*120#', 2, 'user_release', 12.0)
+        journeys.record_end('*120#', 5, 'app_close', 40.0)
+        journeys.record_end('*121#', 1, 'expired', 3.0)
+        stats = journeys.get_stats()
+        self.assertEqual(stats['*120#']['sessions'], 2)
+        self.assertEqual(
+            stats['*120#']['ends'], {'user_release': 1, 'app_close': 1})
+        self.assertEqual(stats['*120#']['steps']['buckets'], {
+            '1': 0, '2': 1, '3': 0, '+Inf': 1})
+        self.assertEqual(stats['*120#']['durations']['max'], 40.0)
+        self.assertEqual(stats['*121#']['ends'], {'expired': 1})
+
+    def test_max_shortcodes(self):
+        journeys = JourneyAggregator(max_shortcodes=1)
+        journeys.record_end('*120#', 1, 'expired', 1.0)
+        journeys.record_end('*121#', 1, 'expired', 1.0)
+        journeys.record_end('*122#', 1, 'expired', 1.0)
+        journeys.record_step('*120#', 1, 0.1)
+        stats = journeys.get_stats()
+        self.assertEqual(sorted(stats), ['*120#', OTHER_SHORTCODES])
+        self.assertEqual(stats['*120#']['sessions'], 1)
+        self.assertEqual(stats[OTHER_SHORTCODES]['sessions'], 2)
+
+    def test_flush(self):
+        path = self.mktemp()
+        journeys = JourneyAggregator()
+        journeys.record_end('*120#', 1, 'expired', 1.0)
+        report = journeys.flush(path)
+        self.assertEqual(report['shortcodes']['*120#']['sessions'], 1)
+        self.assertEqual(journeys.get_stats(), {})
+        journeys.flush(path)
+        with open(path) as f:
+            reports = [json.loads(line) for line in f]
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[0]['shortcodes'], report['shortcodes'])
+        self.assertEqual(reports[1]['shortcodes'], {})
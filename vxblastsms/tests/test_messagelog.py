@@ -0,0 +1,83 @@
+import logging
+
+from twisted.python.log import textFromEventDict
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.tests.utils import LogCatcher
+
+from vxblastsms.messagelog import MessageLogger, redact_msisdn
+
+
+class TestRedactMsisdn(VumiTestCase):
+
+    def test_redact_msisdn(self):
+        self.assertEqual(redact_msisdn('27123456789'), '********789')
+
+    def test_redact_short_msisdn(self):
+        self.assertEqual(redact_msisdn('12345'), '*****')
+
+    def test_redact_none(self):
+        self.assertEqual(redact_msisdn(None), None)
+
+
+class TestMessageLogger(VumiTestCase):
+
+    def logged(self, func, *args):
+        with LogCatcher() as lc:
+            func(*args)
+        return [textFromEventDict(event) for event in lc.logs]
+
+    def test_inbound(self):
+        logger = MessageLogger()
+        self.assertEqual(
+            self.logged(logger.inbound, '27123456789', '*120#', 'sid'),
+            ['BlastSMSUssdTransport receiving inbound message from '
+             '27123456789 to *120#.'])
+
+    def test_inbound_redacted(self):
+        logger = MessageLogger(redact=True)
+        self.assertEqual(
+            self.logged(logger.inbound, '27123456789', '*120#', 'sid'),
+            ['BlastSMSUssdTransport receiving inbound message from '
+             '********789 to *120#.'])
+
+    def test_outbound(self):
+        logger = MessageLogger()
+        self.assertEqual(
+            self.logged(logger.outbound, '27123456789', 'sid', '<msg/>'),
+            ["BlastSMSUssdTransport outbound message with content: "
+             "'<msg/>'"])
+
+    def test_outbound_redacted(self):
+        logger = MessageLogger(redact=True)
+        [line] = self.logged(
+            logger.outbound, '27123456789', 'sid', '<msg>secret</msg>')
+        self.assertEqual(
+            line,
+            'BlastSMSUssdTransport outbound message to ********789 of 17 '
+            'bytes.')
+
+    def test_outbound_sampled(self):
+        logger = MessageLogger(body_sample_rate=3)
+        lines = []
+        for _ in range(7):
+            lines.extend(self.logged(
+                logger.outbound, '27123456789', 'sid', '<msg/>'))
+        self.assertEqual(len(lines), 2)
+
+    def test_rejected(self):
+        logger = MessageLogger()
+        self.assertEqual(
+            self.logged(logger.rejected, 'invalid_xml', 'syntax error'),
+            ['BlastSMSUssdTransport rejected inbound message: invalid_xml '
+             'syntax error'])
+
+    def test_level_gating(self):
+        logger = MessageLogger(logging.WARNING)
+        self.assertEqual(
+            self.logged(logger.inbound, '27123456789', '*120#', 'sid'), [])
+        self.assertEqual(
+            self.logged(logger.outbound, '27123456789', 'sid', '<msg/>'), [])
+        self.assertEqual(
+            self.logged(logger.rejected, 'invalid_xml', 'syntax error'), [])
+        self.assertEqual(logger.bodies_seen, 0)
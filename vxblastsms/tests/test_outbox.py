@@ -0,0 +1,150 @@
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.tests.utils import LogCatcher
+
+from vxblastsms.outbox import EventOutbox
+
+
+class TestEventOutbox(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.published = []
+        self.pending = []
+        self.calls = []
+
+    def publish(self, **event):
+        self.published.append(event)
+
+    def publish_later(self, **event):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+    def mk_outbox(self, publish=None, **kw):
+        kw.setdefault('flush_interval', 1)
+        return EventOutbox(
+            publish or self.publish, self.clock,
+            on_full=lambda: self.calls.append('full'),
+            on_drained=lambda: self.calls.append('drained'), **kw)
+
+    def test_flush_interval(self):
+        outbox = self.mk_outbox()
+        outbox.put(event_type='ack')
+        outbox.put(event_type='nack')
+        self.assertEqual(self.published, [])
+        self.assertEqual(outbox.depth(), 2)
+        self.clock.advance(1)
+        self.assertEqual(
+            self.published, [{'event_type': 'ack'}, {'event_type': 'nack'}])
+        self.assertEqual(outbox.depth(), 0)
+        self.assertEqual(outbox.get_stats(), {
+            'queued': 0,
+            'in_flight': 0,
+            'published': 2,
+            'errors': 0,
+            'dropped': 0,
+        })
+
+    def test_flush_batch_size(self):
+        outbox = self.mk_outbox(batch_size=2)
+        outbox.put(event_type='ack')
+        outbox.put(event_type='ack')
+        self.clock.advance(0)
+        self.assertEqual(len(self.published), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_max_in_flight(self):
+        outbox = self.mk_outbox(self.publish_later, max_in_flight=2)
+        for _ in range(3):
+            outbox.put(event_type='ack')
+        self.clock.advance(1)
+        self.assertEqual(len(self.pending), 2)
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox.in_flight, 2)
+
+        self.pending[0].callback(None)
+        self.clock.advance(0)
+        self.assertEqual(len(self.pending), 3)
+        self.assertEqual(len(outbox), 0)
+
+    def test_backpressure(self):
+        outbox = self.mk_outbox(
+            self.publish_later, max_size=4, high_water=3, low_water=1)
+        outbox.put(event_type='ack')
+        outbox.put(event_type='ack')
+        self.assertEqual(self.calls, [])
+        outbox.put(event_type='ack')
+        self.assertEqual(self.calls, ['full'])
+        self.assertTrue(outbox.full)
+
+        self.clock.advance(1)
+        self.pending[0].callback(None)
+        self.assertEqual(self.calls, ['full'])
+        self.pending[1].callback(None)
+        self.assertEqual(self.calls, ['full', 'drained'])
+        self.assertFalse(outbox.full)
+
+    def test_drop_when_full(self):
+        outbox = self.mk_outbox(max_size=2)
+        self.assertTrue(outbox.put(event_type='ack'))
+        self.assertTrue(outbox.put(event_type='ack'))
+        self.assertFalse(outbox.put(event_type='ack'))
+        self.assertEqual(outbox.get_stats()['dropped'], 1)
+
+    def test_drop_logging(self):
+        outbox = self.mk_outbox(max_size=1)
+        with LogCatcher(message='Event outbox') as lc:
+            outbox.put(event_type='ack')
+            outbox.put(event_type='ack')
+            outbox.put(event_type='ack')
+            self.clock.advance(1)
+            outbox.put(event_type='ack')
+            outbox.put(event_type='ack')
+        self.assertEqual(lc.messages(), [
+            'Event outbox full, dropping events. 0 dropped so far.',
+            'Event outbox has room again, 2 events dropped so far.',
+            'Event outbox full, dropping events. 2 dropped so far.',
+        ])
+        self.assertEqual(outbox.dropped, 3)
+
+    def test_publish_error(self):
+        outbox = self.mk_outbox(lambda **event: fail(ValueError('Oops')))
+        outbox.put(event_type='ack')
+        self.clock.advance(1)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(outbox.get_stats()['errors'], 1)
+        self.assertEqual(outbox.depth(), 0)
+
+    def test_drain(self):
+        outbox = self.mk_outbox(self.publish_later)
+        outbox.put(event_type='ack')
+        d = outbox.drain()
+        self.assertEqual(len(self.pending), 1)
+        self.assertFalse(d.called)
+        self.pending[0].callback(None)
+        self.assertTrue(d.called)
+
+    def test_drain_empty(self):
+        outbox = self.mk_outbox()
+        self.assertTrue(outbox.drain().called)
+
+    def test_stop_while_full(self):
+        outbox = self.mk_outbox(
+            self.publish_later, max_size=4, high_water=1, low_water=0)
+        outbox.put(event_type='ack')
+        self.assertEqual(self.calls, ['full'])
+        outbox.stop()
+        d = outbox.drain()
+        self.pending[0].callback(None)
+        self.assertTrue(d.called)
+        self.assertFalse(outbox.full)
+        self.assertEqual(self.calls, ['full'])
+
+    def test_stop(self):
+        outbox = self.mk_outbox()
+        outbox.put(event_type='ack')
+        outbox.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,155 @@
+import json
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms import profiling
+from vxblastsms.profiling import CallProfiler
+
+
+class TestCallProfiler(VumiTestCase):
+
+    def test_wrap(self):
+        profiler = CallProfiler(sample_rate=2)
+        calls = []
+
+        def func(value):
+            """Does things."""
+            calls.append(value)
+            return [value]
+
+        profiled = profiler.wrap('func', func)
+        self.assertEqual(profiled.__name__, 'func')
+        self.assertEqual(profiled.__doc__, 'Does things.')
+        for i in range(5):
+            self.assertEqual(profiled(i), [i])
+        self.assertEqual(calls, range(5))
+
+        stats = profiler.calls['func'].get_stats()
+        self.assertEqual(stats['calls'], 5)
+        self.assertEqual(stats['sampled'], 2)
+        self.assertTrue(stats['max_ms'] >= stats['mean_ms'] >= 0)
+        self.assertEqual(
+            stats['estimated_total_ms'], stats['mean_ms'] * 5)
+
+    def test_wrap_exception(self):
+        profiler = CallProfiler(sample_rate=1)
+
+        def func():
+            raise ValueError()
+
+        self.assertRaises(ValueError, profiler.wrap('func', func))
+        self.assertEqual(profiler.calls['func'].sampled, 1)
+
+    def test_dump(self):
+        profiler = CallProfiler(sample_rate=1)
+        profiled = profiler.wrap('func', lambda: None)
+        profiled()
+        path = self.mktemp()
+        report = profiler.dump(path)
+        self.assertEqual(report['calls']['func']['calls'], 1)
+        self.assertEqual(profiler.calls['func'].calls, 0)
+
+        profiled()
+        profiler.dump(path)
+        with open(path) as f:
+            reports = [json.loads(line) for line in f]
+        self.assertEqual(
+            [r['calls']['func']['calls'] for r in reports], [1, 1])
+
+    def test_memory_without_tracemalloc(self):
+        self.patch(profiling, 'tracemalloc', None)
+        self.assertEqual(CallProfiler().snapshot_memory(), None)
+
+    def test_memory_object_counts(self):
+        self.patch(profiling, 'tracemalloc', None)
+        profiler = CallProfiler(memory_top=3, count_objects=True)
+        memory = profiler.snapshot_memory()
+        self.assertEqual(memory['source'], 'gc')
+        self.assertEqual(len(memory['top']), 3)
+
+        self.kept = [ProfiledThing() for _ in range(1000)]
+        memory = profiler.snapshot_memory()
+        self.assertEqual(memory['top'][0]['type'], 'ProfiledThing')
+        self.assertEqual(memory['top'][0]['count_diff'], 1000)
+
+    def test_memory_tracemalloc(self):
+        fake = FakeTracemalloc()
+        self.patch(profiling, 'tracemalloc', fake)
+        profiler = CallProfiler(memory_top=1, count_objects=True)
+        memory = profiler.snapshot_memory()
+        self.assertEqual(memory, {
+            'source': 'tracemalloc',
+            'top': [{
+                'where': 'profiling.py:1', 'size': 100, 'size_diff': 100,
+                'count': 2, 'count_diff': 2,
+            }],
+        })
+
+        memory = profiler.snapshot_memory()
+        self.assertEqual(fake.compared, [(1, 0)])
+        self.assertEqual(memory['top'], [{
+            'where': 'profiling.py:1', 'size': 150, 'size_diff': 50,
+            'count': 3, 'count_diff': 1,
+        }])
+
+    def test_memory_tracemalloc_not_tracing(self):
+        fake = FakeTracemalloc()
+        fake.tracing = False
+        self.patch(profiling, 'tracemalloc', fake)
+        self.assertEqual(CallProfiler().snapshot_memory(), None)
+
+
+class ProfiledThing(object):
+    pass
+
+
+class FakeStatistic(object):
+
+    def __init__(self, traceback, size, count, previous=None):
+        self.traceback = traceback
+        self.size = size
+        self.count = count
+        if previous is not None:
+            self.size_diff = size - previous.size
+            self.count_diff = count - previous.count
+
+
+class FakeTracemalloc(object):
+    """
+    Just enough of :mod:`tracemalloc` for :class:`CallProfiler`, whose
+    snapshots grow one line's allocations by 50 bytes and an object each.
+    """
+
+    def __init__(self):
+        self.tracing = True
+        self.snapshots = 0
+        self.compared = []
+        tracemalloc = self
+
+        class Snapshot(object):
+            def __init__(self, number):
+                self.number = number
+
+            def statistics(self, key_type):
+                assert key_type == 'lineno'
+                return [FakeStatistic(
+                    'profiling.py:1', 100 + 50 * self.number,
+                    2 + self.number)]
+
+            def compare_to(self, old, key_type):
+                tracemalloc.compared.append((self.number, old.number))
+                [previous] = old.statistics(key_type)
+                [current] = self.statistics(key_type)
+                return [FakeStatistic(
+                    current.traceback, current.size, current.count,
+                    previous)]
+
+        self.Snapshot = Snapshot
+
+    def is_tracing(self):
+        return self.tracing
+
+    def take_snapshot(self):
+        snapshot = self.Snapshot(self.snapshots)
+        self.snapshots += 1
+        return snapshot
@@ -0,0 +1,56 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.ratelimit import RateLimiter
+
+
+class TestRateLimiter(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_burst(self):
+        limiter = RateLimiter(1, 3, self.clock)
+        self.assertEqual(
+            [limiter.allow('a') for _ in range(4)],
+            [True, True, True, False])
+        self.assertTrue(limiter.allow('b'))
+        self.assertEqual(limiter.get_stats(), {
+            'keys': 2,
+            'limited': 1,
+            'evicted': 0,
+        })
+
+    def test_refill(self):
+        limiter = RateLimiter(2, 2, self.clock)
+        limiter.allow('a')
+        limiter.allow('a')
+        self.assertFalse(limiter.allow('a'))
+        self.clock.advance(0.5)
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+        self.clock.advance(10)
+        self.assertTrue(limiter.allow('a'))
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+
+    def test_expire_idle_keys(self):
+        limiter = RateLimiter(1, 5, self.clock)
+        limiter.allow('a')
+        self.clock.advance(4)
+        limiter.allow('b')
+        limiter.expire()
+        self.assertEqual(len(limiter), 2)
+        self.clock.advance(1)
+        limiter.expire()
+        self.assertEqual(len(limiter), 1)
+
+    def test_max_keys(self):
+        limiter = RateLimiter(1, 1, self.clock, max_keys=2)
+        for key in 'abc':
+            limiter.allow(key)
+        self.assertEqual(len(limiter), 2)
+        self.assertEqual(limiter.get_stats()['evicted'], 1)
+        # Forgetting a key only ever lets it through.
+        self.assertTrue(limiter.allow('a'))
@@ -0,0 +1,167 @@
+import json
+import os
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.benchmark import make_request_body
+from vxblastsms.harness import TransportHarness
+from vxblastsms.replay import (
+    parse_args, read_capture, replay, run_replay, send_timed)
+
+
+def make_capture(records):
+    return ''.join(
+        json.dumps({'timestamp': timestamp, 'body': body}) + '\n'
+        for timestamp, body in records)
+
+
+class FakeHarness(object):
+    """Records when each request is sent and answers it straight away."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+
+    def request(self, body):
+        self.sent.append((self.clock.seconds(), body))
+        return succeed((200, body, 0.0))
+
+
+class TestReadCapture(VumiTestCase):
+
+    def test_read_capture(self):
+        capture = StringIO(make_capture([
+            (10.5, u'<ussdresp><msg>\xe9</msg></ussdresp>'),
+        ]) + '\n')
+        self.assertEqual(list(read_capture(capture)), [
+            (10.5, '<ussdresp><msg>\xc3\xa9</msg></ussdresp>'),
+        ])
+
+    def test_read_capture_invalid(self):
+        capture = StringIO(make_capture([(1, 'a')]) + '{"body": "b"}\n')
+        records = read_capture(capture)
+        self.assertEqual(next(records), (1, 'a'))
+        err = self.assertRaises(ValueError, next, records)
+        self.assertTrue('line 2' in str(err))
+
+
+class TestSendTimed(VumiTestCase):
+
+    def test_send_timed(self):
+        clock = Clock()
+        clock.advance(100)
+        harness = FakeHarness(clock)
+        d = send_timed(
+            harness, [(50, 'a'), (51, 'b'), (51, 'c'), (55, 'd')], 2, clock)
+        self.assertEqual(harness.sent, [(100, 'a')])
+        clock.advance(0.5)
+        self.assertEqual(harness.sent[1:], [(100.5, 'b'), (100.5, 'c')])
+        self.assertFalse(d.called)
+        clock.advance(2)
+        self.assertEqual(harness.sent[3:], [(102.5, 'd')])
+        results, max_lag = self.successResultOf(d)
+        self.assertEqual([body for _, body, _ in results], list('abcd'))
+        self.assertEqual(max_lag, 0)
+
+    def test_send_timed_empty(self):
+        clock = Clock()
+        results, max_lag = self.successResultOf(
+            send_timed(FakeHarness(clock), [], 1, clock))
+        self.assertEqual(results, [])
+
+    def test_send_timed_invalid_record(self):
+        clock = Clock()
+        harness = FakeHarness(clock)
+        capture = StringIO(make_capture([(0, 'a'), (1, 'b')]) + '{}\n')
+        d = send_timed(harness, read_capture(capture), 1, clock)
+        clock.advance(1)
+        self.assertEqual([body for _, body in harness.sent], ['a', 'b'])
+        err = self.failureResultOf(d, ValueError)
+        self.assertTrue('line 3' in str(err.value))
+
+
+class TestReplay(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.harness = TransportHarness()
+        yield self.harness.start()
+        self.add_cleanup(self.harness.stop)
+
+    def make_records(self):
+        return [
+            (0, make_request_body(type='1', msg=None)),
+            (0.001, make_request_body(msg='1')),
+            (0.002, '<ussdresp>'),
+            (0.003, make_request_body(type='3', msg=None)),
+        ]
+
+    @inlineCallbacks
+    def test_replay_fast(self):
+        result = yield replay(self.harness, self.make_records())
+        self.assertEqual(result['requests'], 4)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(result['status_codes'], {'200': 3, '400': 1})
+        self.assertEqual(result['concurrency'], 100)
+        self.assertEqual(result['max_lag_ms'], None)
+        self.assertEqual(
+            result['transport']['rejections'], {'invalid_xml': 1})
+        self.assertEqual(
+            sorted(result['latency_ms']), ['max', 'p50', 'p99', 'p999'])
+
+    @inlineCallbacks
+    def test_replay_timed(self):
+        result = yield replay(self.harness, self.make_records(), speed=1)
+        self.assertEqual(result['requests'], 4)
+        self.assertEqual(result['speed'], 1)
+        self.assertEqual(result['concurrency'], None)
+        self.assertTrue(result['max_lag_ms'] >= 0)
+
+    @inlineCallbacks
+    def test_replay_invalid_record(self):
+        capture = StringIO(make_capture(self.make_records()) + '{}\n')
+        err = yield self.assertFailure(
+            replay(self.harness, read_capture(capture), concurrency=1),
+            ValueError)
+        self.assertTrue('line 5' in str(err))
+
+
+class TestRunReplay(VumiTestCase):
+
+    def test_parse_args(self):
+        args = parse_args(['capture.jsonl'])
+        self.assertEqual(args.capture, 'capture.jsonl')
+        self.assertEqual(args.speed, None)
+        self.assertEqual(args.concurrency, 100)
+
+    @inlineCallbacks
+    def test_run_replay(self):
+        capture_path = self.mktemp()
+        with open(capture_path, 'w') as f:
+            f.write(make_capture([(0, make_request_body(type='3'))]))
+        config_path = self.mktemp()
+        with open(config_path, 'w') as f:
+            f.write('app_id: replayed\n')
+        output_path = self.mktemp()
+        yield run_replay(None, parse_args([
+            capture_path, '--config', config_path, '--output', output_path]))
+        with open(output_path) as f:
+            result = json.load(f)
+        self.assertEqual(result['requests'], 1)
+        self.assertEqual(result['errors'], 0)
+
+    @inlineCallbacks
+    def test_run_replay_invalid_capture(self):
+        capture_path = self.mktemp()
+        with open(capture_path, 'w') as f:
+            f.write(make_capture([(0, make_request_body(type='3'))]))
+            f.write('not json\n')
+        output_path = self.mktemp()
+        args = parse_args([capture_path, '--output', output_path])
+        err = yield self.assertFailure(run_replay(None, args), SystemExit)
+        self.assertTrue('line 2' in str(err.code))
+        self.assertFalse(os.path.exists(output_path))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.codec import EncodeError, encode_response, get_reply_encoding
+from vxblastsms.replycache import ReplyCache
+
+
+class TestReplyCache(VumiTestCase):
+
+    defaults = {
+        'msisdn': '27123456789',
+        'sessionid': '1234',
+        'appid': 'app',
+        'type': '2',
+        'msg': u'Menu & more\n1. Ni!',
+    }
+
+    def test_encode(self):
+        cache = ReplyCache()
+        for msisdn in ['27123456789', '27000000000']:
+            values = dict(self.defaults, msisdn=msisdn)
+            self.assertEqual(cache.encode(**values), encode_response(**values))
+        stats = cache.get_stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertTrue(stats['bytes'] > 0)
+
+    def test_key(self):
+        cache = ReplyCache()
+        for field, value in [('appid', 'other'), ('type', '3'),
+                             ('msg', u'Bye')]:
+            values = dict(self.defaults, **{field: value})
+            self.assertEqual(cache.encode(**values), encode_response(**values))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.hits, 0)
+
+    def test_max_size(self):
+        cache = ReplyCache(max_size=2)
+        for msg in [u'a', u'b', u'a', u'c']:
+            cache.encode(**dict(self.defaults, msg=msg))
+        # b was the least recently used.
+        cache.encode(**dict(self.defaults, msg=u'a'))
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 2)
+
+    def test_max_bytes(self):
+        cache = ReplyCache(max_bytes=2000)
+        cache.encode(**dict(self.defaults, msg=u'a'))
+        small_bytes = cache.bytes
+        cache.encode(**dict(self.defaults, msg=u'x' * 3000))
+        self.assertEqual(cache.bytes, small_bytes)
+        self.assertEqual(len(cache), 1)
+
+        for i in range(100):
+            cache.encode(**dict(self.defaults, msg=u'%d' % (i,)))
+        self.assertTrue(cache.bytes <= 2000)
+        self.assertTrue(cache.evictions > 0)
+        self.assertEqual(len(cache), cache.get_stats()['size'])
+
+    def test_disabled(self):
+        cache = ReplyCache(max_size=0)
+        self.assertEqual(
+            cache.encode(**self.defaults), encode_response(**self.defaults))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_encode_error(self):
+        cache = ReplyCache()
+        self.assertRaises(
+            ValueError, cache.encode, **dict(self.defaults, msg=u'\x00'))
+        self.assertEqual(len(cache), 0)
+
+    def test_encoding(self):
+        cache = ReplyCache()
+        latin1 = get_reply_encoding('iso-8859-1')
+        values = dict(self.defaults, msg=u'Thrëë')
+        self.assertEqual(
+            cache.encode(encoding=latin1, **values),
+            encode_response(charset='iso-8859-1', **values))
+        self.assertEqual(cache.encode(**values), encode_response(**values))
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(
+            EncodeError, cache.encode, encoding=latin1,
+            **dict(self.defaults, msg=u'Дякую'))
+        self.assertEqual(len(cache), 2)
+
+    def test_truncate(self):
+        cache = ReplyCache()
+        values = dict(self.defaults, msg=u'x' * 200)
+        for _ in range(2):
+            self.assertEqual(
+                cache.encode(max_length=182, **values),
+                encode_response(**dict(values, msg=u'x' * 182)))
+        self.assertEqual(cache.get_stats()['truncated'], 2)
+        self.assertEqual(cache.encode(**values), encode_response(**values))
+        self.assertEqual(cache.get_stats()['truncated'], 2)
@@ -0,0 +1,160 @@
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.responseconfig import (
+    ResponseConfigIndex, ResponseSettings, config_key, load_shortcodes_file)
+
+
+class TestResponseSettings(VumiTestCase):
+
+    def test_replace(self):
+        settings = ResponseSettings(app_id='app', reply_deadline=5)
+        replaced = settings.replace({'reply_deadline': 1})
+        self.assertEqual(replaced.app_id, 'app')
+        self.assertEqual(replaced.reply_deadline, 1)
+        self.assertEqual(settings.reply_deadline, 5)
+
+    def test_replace_unknown_setting(self):
+        settings = ResponseSettings()
+        self.assertRaises(ValueError, settings.replace, {'colour': 'blue'})
+
+    def test_encoding(self):
+        settings = ResponseSettings()
+        self.assertEqual(settings.encoding.name, 'utf-8')
+        self.assertEqual(settings.max_reply_length, 182)
+        replaced = settings.replace({'encoding': 'gsm7'})
+        self.assertEqual(replaced.encoding.name, 'gsm7')
+        self.assertEqual(
+            replaced.replace({'app_id': 'app'}).encoding.name, 'gsm7')
+
+    def test_invalid_encoding(self):
+        self.assertRaises(ValueError, ResponseSettings, encoding='ebcdic')
+        self.assertRaises(ValueError, ResponseSettings, max_reply_length=0)
+        self.assertRaises(
+            ValueError, ResponseSettings, encoding='iso-8859-1',
+            busy_message=u'\u0417\u0430\u043d\u044f\u0442\u043e')
+
+    def test_invalid_types(self):
+        self.assertRaises(ValueError, ResponseSettings, reply_deadline='5s')
+        self.assertRaises(ValueError, ResponseSettings, reply_deadline=-1)
+        self.assertRaises(ValueError, ResponseSettings, reply_deadline=True)
+        self.assertRaises(
+            ValueError, ResponseSettings, max_reply_length='100')
+        self.assertRaises(ValueError, ResponseSettings, max_reply_length=1.5)
+        self.assertRaises(ValueError, ResponseSettings, close_message=12)
+        self.assertRaises(ValueError, ResponseSettings().replace, None)
+        settings = ResponseSettings(reply_deadline=2.5, max_reply_length=100)
+        self.assertEqual(settings.reply_deadline, 2.5)
+        self.assertEqual(settings.max_reply_length, 100)
+
+
+class TestResponseConfigIndex(VumiTestCase):
+
+    def setUp(self):
+        self.default = ResponseSettings(app_id='default')
+        self.index = ResponseConfigIndex(self.default, {
+            '*120#': {
+                'app_id': 'shortcode',
+                'apps': {
+                    'special': {'close_message': 'Bye!'},
+                },
+            },
+        })
+
+    def test_lookup_default(self):
+        self.assertTrue(self.index.lookup('*121#') is self.default)
+        self.assertTrue(self.index.lookup('*121#', 'special') is self.default)
+
+    def test_lookup_shortcode(self):
+        settings = self.index.lookup('*120#')
+        self.assertEqual(settings.app_id, 'shortcode')
+        self.assertEqual(settings.close_message, None)
+        self.assertTrue(self.index.lookup('*120#', 'other') is settings)
+
+    def test_lookup_app(self):
+        settings = self.index.lookup('*120#', 'special')
+        self.assertEqual(settings.app_id, 'shortcode')
+        self.assertEqual(settings.close_message, 'Bye!')
+
+    def test_len(self):
+        self.assertEqual(len(self.index), 2)
+
+    def test_unknown_setting(self):
+        self.assertRaises(
+            ValueError, ResponseConfigIndex, self.default,
+            {'*120#': {'colour': 'blue'}})
+
+    def test_overrides_not_a_mapping(self):
+        for shortcodes in [
+                {'*120#': None},
+                {'*120#': ['app_id', 'shortcode']},
+                {'*120#': {'apps': ['special']}},
+                {'*120#': {'apps': {'special': 'Bye!'}}},
+                {'*120#': {'reply_deadline': '5s'}}]:
+            self.assertRaises(
+                ValueError, ResponseConfigIndex, self.default, shortcodes)
+
+    def test_numeric_keys(self):
+        index = ResponseConfigIndex(self.default, {
+            8864: {'app_id': 'shortcode', 'apps': {12: {'app_id': 'app'}}},
+        })
+        self.assertEqual(index.lookup(u'8864').app_id, 'shortcode')
+        self.assertEqual(index.lookup(u'8864', u'12').app_id, 'app')
+
+    def test_duplicate_keys(self):
+        self.assertRaises(
+            ValueError, ResponseConfigIndex, self.default,
+            {8864: {}, '8864': {}})
+
+
+class TestConfigKey(VumiTestCase):
+
+    def test_config_key(self):
+        self.assertEqual(config_key('*120#'), u'*120#')
+        self.assertEqual(config_key(u'*120#'), u'*120#')
+        self.assertEqual(config_key(8864), u'8864')
+        self.assertTrue(isinstance(config_key(8864), unicode))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, config_key, True)
+        self.assertRaises(ValueError, config_key, 1.5)
+        self.assertRaises(ValueError, config_key, None)
+
+
+class TestLoadShortcodesFile(VumiTestCase):
+
+    def write_file(self, content):
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_load(self):
+        path = self.write_file(
+            'shortcodes:\n'
+            '  "*120#":\n'
+            '    app_id: file\n')
+        self.assertEqual(
+            load_shortcodes_file(path), {'*120#': {'app_id': 'file'}})
+
+    def test_load_numeric_shortcode(self):
+        path = self.write_file(
+            'shortcodes:\n'
+            '  8864:\n'
+            '    app_id: file\n')
+        index = ResponseConfigIndex(
+            ResponseSettings(), load_shortcodes_file(path))
+        self.assertEqual(index.lookup(u'8864').app_id, 'file')
+
+    def test_load_empty(self):
+        self.assertEqual(load_shortcodes_file(self.write_file('')), {})
+
+    def test_load_invalid_yaml(self):
+        path = self.write_file('shortcodes: [')
+        self.assertRaises(ValueError, load_shortcodes_file, path)
+
+    def test_load_not_a_mapping(self):
+        path = self.write_file('shortcodes: [1, 2]')
+        self.assertRaises(ValueError, load_shortcodes_file, path)
+
+    def test_load_missing(self):
+        self.assertRaises(IOError, load_shortcodes_file, self.mktemp())
@@ -0,0 +1,31 @@
+import socket
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.reuseport import listen_reuse_port
+
+
+class TestListenReusePort(VumiTestCase):
+
+    def listen(self, port):
+        listening_port = listen_reuse_port(
+            reactor, port, ServerFactory(), interface='127.0.0.1')
+        self.add_cleanup(listening_port.stopListening)
+        return listening_port
+
+    def test_shared_port(self):
+        first = self.listen(0)
+        port = first.getHost().port
+        second = self.listen(port)
+        self.assertEqual(second.getHost().port, port)
+
+    def test_port_in_use_without_reuse_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.add_cleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        self.assertRaises(
+            socket.error, self.listen, sock.getsockname()[1])
@@ -0,0 +1,106 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.sessions import SessionTable
+
+
+class TestSessionTable(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sessions = SessionTable(60, 2, self.clock)
+
+    def test_open(self):
+        self.clock.advance(3)
+        session = self.sessions.open('s1', '2712', '*120#')
+        self.assertEqual(session.sessionid, 's1')
+        self.assertEqual(session.msisdn, '2712')
+        self.assertEqual(session.shortcode, '*120#')
+        self.assertEqual(session.started_at, 3)
+        self.assertTrue('s1' in self.sessions)
+        self.assertEqual(self.sessions.get('s1'), session)
+
+    def test_resume(self):
+        session = self.sessions.open('s1', '2712', '*120#')
+        self.assertEqual(self.sessions.resume('s1', '2712', '*120#'), session)
+        self.assertEqual(self.sessions.opened, 1)
+        self.assertEqual(session.steps, 2)
+
+    def test_resume_unknown(self):
+        session = self.sessions.resume('s1', '2712', '*120#')
+        self.assertEqual(self.sessions.get('s1'), session)
+        self.assertEqual(session.steps, 1)
+        self.assertEqual(self.sessions.opened, 1)
+
+    def test_close(self):
+        session = self.sessions.open('s1', '2712', '*120#')
+        self.assertEqual(self.sessions.close('s1'), session)
+        self.assertEqual(self.sessions.close('s1'), None)
+        self.assertEqual(len(self.sessions), 0)
+        self.assertEqual(self.sessions.closed, 1)
+
+    def test_expire(self):
+        s1 = self.sessions.open('s1', '2712', '*120#')
+        self.clock.advance(30)
+        self.sessions.open('s2', '2713', '*120#')
+        self.clock.advance(30)
+        self.assertEqual(self.sessions.expire(), [s1])
+        self.assertEqual(len(self.sessions), 1)
+
+    def test_max_sessions(self):
+        self.sessions.open('s1', '2712', '*120#')
+        self.sessions.open('s2', '2713', '*120#')
+        self.sessions.open('s3', '2714', '*120#')
+        self.assertFalse('s1' in self.sessions)
+        self.assertEqual(self.sessions.get_stats(), {
+            'active': 2,
+            'opened': 3,
+            'closed': 0,
+            'expired': 0,
+            'evicted': 1,
+        })
+
+    def test_on_end(self):
+        ended = []
+        sessions = SessionTable(
+            60, 1, self.clock,
+            lambda session, reason: ended.append((session, reason)))
+        s1 = sessions.open('s1', '2712', '*120#')
+        sessions.close('s1', 'user_release')
+        sessions.close('s1', 'user_release')
+        s2 = sessions.open('s2', '2713', '*120#')
+        s3 = sessions.open('s3', '2714', '*120#')
+        self.clock.advance(60)
+        sessions.expire()
+        self.assertEqual(ended, [
+            (s1, 'user_release'), (s2, 'evicted'), (s3, 'expired')])
+
+    def test_save_and_load(self):
+        path = self.mktemp()
+        s1 = self.sessions.open('s1', '2712', '*120#')
+        self.clock.advance(10)
+        s2 = self.sessions.open('s2', '2713', '*121#')
+        self.sessions.resume('s2', '2713', '*121#')
+        self.assertEqual(self.sessions.save(path), 2)
+
+        self.clock.advance(55)
+        sessions = SessionTable(60, 2, self.clock)
+        self.assertEqual(sessions.load(path), 1)
+        self.assertFalse('s1' in sessions)
+        session = sessions.get('s2')
+        self.assertEqual(
+            (session.sessionid, session.msisdn, session.shortcode,
+             session.started_at, session.steps),
+            (s2.sessionid, s2.msisdn, s2.shortcode, 10, 2))
+        self.clock.advance(5)
+        self.assertEqual(sessions.expire(), [session])
+        self.assertEqual(s1.steps, 1)
+
+    def test_load_invalid(self):
+        path = self.mktemp()
+        self.assertRaises(IOError, self.sessions.load, path)
+        for content in ['nope', '[]', '{"sessions": [[1, 2]]}']:
+            with open(path, 'w') as f:
+                f.write(content)
+            self.assertRaises(ValueError, self.sessions.load, path)
@@ -0,0 +1,115 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.stats import (
+    Histogram, LatencyRecorder, RollingCounter, RollingHistogram)
+
+
+class TestHistogram(VumiTestCase):
+
+    def test_record(self):
+        histogram = Histogram([0.1, 1.0])
+        for value in [0.05, 0.1, 0.5, 2.0, 3.0]:
+            histogram.record(value)
+        self.assertEqual(histogram.get_stats(), {
+            'count': 5,
+            'sum': 5.65,
+            'max': 3.0,
+            'buckets': {'0.1': 2, '1.0': 1, '+Inf': 2},
+        })
+
+    def test_empty(self):
+        self.assertEqual(Histogram([1.0]).get_stats(), {
+            'count': 0,
+            'sum': 0.0,
+            'max': 0.0,
+            'buckets': {'1.0': 0, '+Inf': 0},
+        })
+
+
+class TestLatencyRecorder(VumiTestCase):
+
+    def test_record(self):
+        latency = LatencyRecorder(['parse', 'publish'], buckets=[1.0])
+        latency.record('parse', 0.5)
+        stats = latency.get_stats()
+        self.assertEqual(sorted(stats), ['parse', 'publish'])
+        self.assertEqual(stats['parse']['count'], 1)
+        self.assertEqual(stats['publish']['count'], 0)
+        self.assertRaises(KeyError, latency.record, 'other', 1)
+
+
+class TestRollingCounter(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_add(self):
+        counter = RollingCounter(10, self.clock, slots=10)
+        counter.add()
+        self.clock.advance(5)
+        counter.add(2)
+        self.assertEqual(counter.get_count(), 3)
+        self.assertEqual(counter.get_rate(), 0.3)
+
+    def test_window(self):
+        counter = RollingCounter(10, self.clock, slots=10)
+        counter.add()
+        self.clock.advance(5)
+        counter.add(2)
+        self.clock.advance(5)
+        self.assertEqual(counter.get_count(), 2)
+        self.clock.advance(5)
+        self.assertEqual(counter.get_count(), 0)
+
+    def test_idle_longer_than_window(self):
+        counter = RollingCounter(10, self.clock, slots=10)
+        counter.add()
+        self.clock.advance(100)
+        counter.add()
+        self.assertEqual(counter.get_count(), 1)
+        self.assertEqual(sum(counter.counts), 1)
+
+
+class TestRollingHistogram(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_record(self):
+        histogram = RollingHistogram(
+            10, self.clock, slots=10, buckets=[0.1, 1.0])
+        for value in [0.05, 0.05, 0.5, 2.0]:
+            histogram.record(value)
+        self.assertEqual(histogram.get_stats(), {
+            'count': 4,
+            'rate': 0.4,
+            'mean': 0.65,
+            'p50': 0.1,
+            'p99': 2.0,
+            'max': 2.0,
+        })
+
+    def test_window(self):
+        histogram = RollingHistogram(
+            10, self.clock, slots=10, buckets=[0.1, 1.0])
+        histogram.record(2.0)
+        self.clock.advance(5)
+        histogram.record(0.05)
+        self.clock.advance(5)
+        stats = histogram.get_stats()
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['max'], 0.05)
+        self.assertEqual(stats['p99'], 0.05)
+        self.assertEqual(histogram.bucket_counts, [1, 0, 0])
+
+    def test_empty(self):
+        self.assertEqual(RollingHistogram(10, self.clock).get_stats(), {
+            'count': 0,
+            'rate': 0.0,
+            'mean': None,
+            'p50': None,
+            'p99': None,
+            'max': 0.0,
+        })
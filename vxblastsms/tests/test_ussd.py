@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 import json
+import os
+import signal
 from xml.etree.ElementTree import Element, SubElement, tostring
 from xml.dom import minidom
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+from twisted.python.log import textFromEventDict
 
+from vumi.config import ConfigError
 from vumi.message import TransportUserMessage
-from vumi.tests.helpers import VumiTestCase
+from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.tests.utils import LogCatcher
+from vumi.utils import http_request_full
 from vumi.transports.httprpc.tests.helpers import HttpRpcTransportHelper
 
 from vxblastsms.ussd import BlastSMSUssdTransport
@@ -284,6 +291,288 @@ class TestBlastSMSUssdTransport(VumiTestCase):
             sorted(body['unexpected_parameter']),
             ['unexp_p1', 'unexp_p2'])
 
+    @inlineCallbacks
+    def test_request_too_large(self):
+        yield self.get_transport({'max_request_size': 100})
+
+        inbound_xml = self.make_inbound_xml_string(msg='x' * 100)
+        response = yield self.tx_helper.mk_request(
+            _data=inbound_xml, _method='POST')
+
+        self.assertEqual(response.code, 413)
+        self.assertEqual(
+            json.loads(response.delivered_body),
+            {'request_too_large': 'Request body exceeds 100 bytes.'})
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+    @inlineCallbacks
+    def test_request_with_invalid_xml(self):
+        yield self.get_transport()
+
+        inbound_xml = self.make_inbound_xml_string()
+        response = yield self.tx_helper.mk_request(
+            _data=inbound_xml[:-5], _method='POST')
+
+        self.assertEqual(response.code, 400)
+        self.assertEqual(
+            json.loads(response.delivered_body).keys(), ['invalid_xml'])
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+    @inlineCallbacks
+    def test_inbound_unicode(self):
+        yield self.get_transport()
+        content = u"Thrëë, my lord."
+
+        inbound_xml = self.make_inbound_xml_string(msg=content)
+        d = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], content)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ok'))
+        yield d
+
+    @inlineCallbacks
+    def test_permissive_ignores_trailing_fields(self):
+        yield self.get_transport({'validation_mode': 'permissive'})
+
+        inbound_xml = self.make_inbound_xml_string(msg='1', appid='app')
+        bogus_xml = inbound_xml.replace(
+            '</ussdresp>', '<unexp_p1>blah</unexp_p1></ussdresp>')
+        d = self.tx_helper.mk_request(_data=bogus_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], '1')
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ok'))
+        yield d
+
+    @inlineCallbacks
+    def test_inbound_release(self):
+        transport = yield self.get_transport()
+        transport.sessions.open('test_session_id', '273334444', '*1234#')
+
+        inbound_xml = self.make_inbound_xml_string(type='3')
+        response = yield self.tx_helper.mk_request(
+            _data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        self.assert_inbound_message(
+            msg,
+            session_event=TransportUserMessage.SESSION_CLOSE,
+            content=None,
+        )
+        self.assertEqual(
+            response.delivered_body,
+            '<?xml version="1.0" encoding="utf-8"?><ussdresp>'
+            '<msisdn>273334444</msisdn><sessionid>test_session_id</sessionid>'
+            '<appid>test_config_app_id</appid><type>3</type><msg/>'
+            '</ussdresp>')
+        self.assertFalse('test_session_id' in transport.sessions)
+
+    @inlineCallbacks
+    def test_inbound_timeout(self):
+        transport = yield self.get_transport()
+
+        inbound_xml = self.make_inbound_xml_string(type='4')
+        response = yield self.tx_helper.mk_request(
+            _data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        self.assert_inbound_message(
+            msg,
+            session_event=TransportUserMessage.SESSION_CLOSE,
+            content=None,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(transport.sessions), 0)
+
+    @inlineCallbacks
+    def test_session_tracking(self):
+        transport = yield self.get_transport()
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1'), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertTrue('test_session_id' in transport.sessions)
+
+        self.tx_helper.dispatch_outbound(
+            msg.reply('Goodbye', continue_session=False))
+        yield d
+        self.assertFalse('test_session_id' in transport.sessions)
+
+        health = json.loads(transport.get_health_response())
+        self.assertEqual(health['pending_requests'], 0)
+        self.assertEqual(health['sessions'], {
+            'active': 0,
+            'opened': 1,
+            'closed': 1,
+            'expired': 0,
+            'evicted': 0,
+        })
+
+    @inlineCallbacks
+    def test_session_expiry(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({'session_timeout': 30})
+        transport.sessions.open('test_session_id', '273334444', '*1234#')
+
+        clock.advance(31)
+        self.assertEqual(len(transport.sessions), 0)
+        self.assertEqual(transport.sessions.get_stats()['expired'], 1)
+
+    @inlineCallbacks
+    def test_reply_without_transport_metadata(self):
+        transport = yield self.get_transport()
+
+        inbound_xml = self.make_inbound_xml_string(appid='provided_app_id')
+        d = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        reply = msg.reply('Ni!')
+        reply['transport_metadata'] = {}
+        reply['to_addr'] = 'someone else'
+        self.tx_helper.dispatch_outbound(reply)
+        response = yield d
+
+        self.assert_outbound_message(
+            response.delivered_body,
+            'provided_app_id',  # appid
+            'test_config_app_id',  # config app id
+            'test_session_id',
+            'Ni!',
+            self.defaults['msisdn'],
+        )
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_ack(ack, reply)
+        self.assertEqual(
+            transport.get_request_context(msg['message_id']), None)
+
+    @inlineCallbacks
+    def test_latency_stats(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport()
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(0.3)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+        latency = json.loads(transport.get_health_response())['latency']
+        self.assertEqual(
+            sorted(latency),
+            ['app', 'generate', 'parse', 'publish', 'round_trip'])
+        for stage in ['app', 'round_trip']:
+            self.assertEqual(latency[stage]['count'], 1)
+            self.assertEqual(latency[stage]['max'], 0.3)
+            self.assertEqual(latency[stage]['buckets']['0.5'], 1)
+        for stage in ['parse', 'publish', 'generate']:
+            self.assertEqual(latency[stage]['count'], 1)
+            self.assertEqual(latency[stage]['max'], 0)
+
+    @inlineCallbacks
+    def test_reply_deadline(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'reply_deadline': 2,
+            'deadline_message': 'Too slow!',
+        })
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1'), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(1.9)
+        self.assertNotEqual(
+            transport.get_request_context(msg['message_id']), None)
+        clock.advance(0.1)
+        response = yield d
+
+        self.assert_outbound_message(
+            response.delivered_body,
+            None,  # appid
+            'test_config_app_id',  # config app id
+            'test_session_id',
+            'Too slow!',
+            self.defaults['msisdn'],
+            continue_session=False,
+        )
+        self.assertFalse('test_session_id' in transport.sessions)
+        self.assertEqual(
+            json.loads(transport.get_health_response())['deadline_replies'],
+            1)
+
+        reply = msg.reply('Ni!')
+        yield self.tx_helper.dispatch_outbound(reply)
+        clock.advance(transport.event_flush_interval)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, reply, "Reply deadline exceeded.")
+
+    @inlineCallbacks
+    def test_shortcode_reply_deadline(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        yield self.get_transport({
+            'reply_deadline': 5,
+            'shortcode_reply_deadlines': {'*1234#': 1},
+        })
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(shortcode='*1234#'),
+            _method='POST')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(1)
+        response = yield d
+        self.assertTrue('<type>3</type>' in response.delivered_body)
+
+    @inlineCallbacks
+    def test_shortcode_reply_deadline_overridden(self):
+        transport = yield self.get_transport({
+            'shortcode_reply_deadlines': {'*1234#': 1, '*1235#': 2},
+            'shortcodes': {'*1234#': {'reply_deadline': 3}},
+        })
+        response_config = transport.response_config
+        self.assertEqual(
+            response_config.lookup(u'*1234#').reply_deadline, 3)
+        self.assertEqual(
+            response_config.lookup(u'*1235#').reply_deadline, 2)
+
+    def test_invalid_shortcode_reply_deadline(self):
+        for deadline in ['5s', True, 0]:
+            transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+                'transport_name': 'sphex',
+                'web_path': '/api/blastSMS/ussd/',
+                'web_port': '0',
+                'shortcode_reply_deadlines': {'*1234#': deadline},
+                'shortcodes': {'*1234#': {'reply_deadline': 3}},
+            })
+            self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_reply_before_deadline(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({'reply_deadline': 2})
+        delayed_calls = len(clock.getDelayedCalls())
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(len(clock.getDelayedCalls()), delayed_calls + 1)
+
+        reply = msg.reply('Ni!')
+        self.tx_helper.dispatch_outbound(reply)
+        yield d
+        clock.advance(transport.event_flush_interval)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_ack(ack, reply)
+        self.assertEqual(len(clock.getDelayedCalls()), delayed_calls)
+        self.assertEqual(
+            json.loads(transport.get_health_response())['deadline_replies'],
+            0)
+
     @inlineCallbacks
     def test_no_reply_to_in_response(self):
         yield self.get_transport()
@@ -388,3 +677,1118 @@ class TestBlastSMSUssdTransport(VumiTestCase):
 
         [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
         self.assert_ack(ack, reply)
+
+    @inlineCallbacks
+    def test_reply_routed_to_owning_process(self):
+        # Two transport processes sharing a transport name. Replies are
+        # consumed by whichever process gets them first, so a reply can
+        # arrive at a process that isn't holding the HTTP request.
+        other = yield self.get_transport({
+            'reply_routing': True,
+            'reply_route': 'Process-B',
+        })
+        owner = yield self.get_transport({
+            'reply_routing': True,
+            'reply_route': 'Process-A',
+        })
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(
+            msg['transport_metadata']['reply_route'], 'process-a')
+
+        reply = msg.reply('Ni!')
+        yield other.handle_outbound_message(reply)
+        response = yield d
+
+        self.assert_outbound_message(
+            response.delivered_body,
+            None,  # appid
+            'test_config_app_id',  # config app id
+            'test_session_id',
+            'Ni!',
+            self.defaults['msisdn'],
+            continue_session=True,
+        )
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_ack(ack, reply)
+        self.assertEqual(other.get_stats()['forwarded_replies'], 1)
+        self.assertEqual(owner.get_stats()['forwarded_replies'], 0)
+
+    @inlineCallbacks
+    def test_reply_routing_disabled(self):
+        yield self.get_transport()
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertFalse('reply_route' in msg['transport_metadata'])
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    @inlineCallbacks
+    def test_reply_for_unknown_route_after_timeout(self):
+        transport = yield self.get_transport({
+            'reply_routing': True,
+            'reply_route': 'process-a',
+        })
+        reply = self.tx_helper.make_outbound(
+            'Ni!', in_reply_to='unknown',
+            transport_metadata={'reply_route': 'process-a'})
+        yield transport.handle_outbound_message(reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, reply, "Response to http request failed.")
+        self.assertEqual(transport.get_stats()['forwarded_replies'], 0)
+
+    @inlineCallbacks
+    def test_forwarded_reply_not_published(self):
+        transport = yield self.get_transport({
+            'reply_routing': True,
+            'reply_route': 'process-a',
+        })
+
+        class BrokenPublisher(object):
+            def publish_message(self, message):
+                raise IOError('Channel closed.')
+
+        transport.reply_route_publishers['process-b'] = BrokenPublisher()
+        reply = self.tx_helper.make_outbound(
+            'Ni!', in_reply_to='unknown',
+            transport_metadata={'reply_route': 'process-b'})
+        yield transport.handle_outbound_message(reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, reply, "Response to http request failed.")
+        self.assertEqual(transport.get_stats()['forwarded_replies'], 0)
+
+    def test_reply_routing_requires_route(self):
+        transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+            'transport_name': 'sphex',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+            'reply_routing': True,
+        })
+        self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_web_reuse_port(self):
+        # The kernel may hand the request to either process, and the reply
+        # to either of them too.
+        first = yield self.get_transport({
+            'web_reuse_port': True,
+            'reply_routing': True,
+            'reply_route': 'process-a',
+        })
+        port = first.web_resource.getHost().port
+        second = yield self.get_transport({
+            'web_reuse_port': True,
+            'web_port': port,
+            'reply_routing': True,
+            'reply_route': 'process-b',
+        })
+        self.assertEqual(second.web_resource.getHost().port, port)
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_web_reuse_port_per_process_warning(self):
+        with LogCatcher(message='only apply') as lc:
+            yield self.get_transport({
+                'web_reuse_port': True,
+                'dedupe_window': 5,
+                'msisdn_rate': 1,
+            })
+        self.assertEqual(lc.messages(), [
+            'dedupe_window, msisdn_rate only apply to the requests each '
+            'process sharing the port gets.'])
+
+    @inlineCallbacks
+    def test_message_log_redacted(self):
+        yield self.get_transport({'message_log_redact': True})
+        with LogCatcher() as lc:
+            d = self.tx_helper.mk_request(
+                _data=self.make_inbound_xml_string(msg='secret'),
+                _method='POST')
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            self.tx_helper.dispatch_outbound(msg.reply('Also secret'))
+            yield d
+        logs = '\n'.join(textFromEventDict(event) for event in lc.logs)
+        self.assertTrue('******444' in logs)
+        self.assertFalse(self.defaults['msisdn'] in logs)
+        self.assertFalse('secret' in logs)
+
+    @inlineCallbacks
+    def test_message_log_level(self):
+        yield self.get_transport({'message_log_level': 'warning'})
+        with LogCatcher(message='BlastSMSUssdTransport') as lc:
+            d = self.tx_helper.mk_request(
+                _data=self.make_inbound_xml_string(), _method='POST')
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+            yield d
+        self.assertEqual(lc.logs, [])
+
+    def test_invalid_message_log_level(self):
+        transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+            'transport_name': 'sphex',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+            'message_log_level': 'chatty',
+        })
+        self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_shortcode_settings(self):
+        yield self.get_transport({
+            'shortcodes': {
+                self.defaults['shortcode']: {
+                    'app_id': 'shortcode_app_id',
+                    'close_message': 'Goodbye.',
+                },
+            },
+        })
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body,
+            None,  # appid
+            'shortcode_app_id',
+            'test_session_id',
+            'Ni!',
+            self.defaults['msisdn'],
+            continue_session=True,
+        )
+
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3'), _method='POST')
+        self.assert_outbound_message(
+            response.delivered_body,
+            None,  # appid
+            'shortcode_app_id',
+            'test_session_id',
+            'Goodbye.',
+            self.defaults['msisdn'],
+            continue_session=False,
+        )
+
+    @inlineCallbacks
+    def test_numeric_shortcode_settings(self):
+        yield self.get_transport({
+            'shortcodes': {
+                int(self.defaults['shortcode']): {
+                    'close_message': 'Goodbye.',
+                },
+            },
+            'shortcode_reply_deadlines': {
+                int(self.defaults['shortcode']): 5,
+            },
+        })
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3'), _method='POST')
+        self.assertTrue('<msg>Goodbye.</msg>' in response.delivered_body)
+
+    @inlineCallbacks
+    def test_app_settings(self):
+        yield self.get_transport({
+            'shortcodes': {
+                self.defaults['shortcode']: {
+                    'apps': {'test_app_id': {'close_message': 'Goodbye.'}},
+                },
+            },
+        })
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3', appid='test_app_id'),
+            _method='POST')
+        self.assertTrue('<msg>Goodbye.</msg>' in response.delivered_body)
+
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3', appid='other'),
+            _method='POST')
+        self.assertTrue('<msg/>' in response.delivered_body)
+
+    def test_invalid_shortcode_settings(self):
+        for shortcodes in [
+                {'*120#': None},
+                {'*120#': {'apps': ['special']}},
+                {'*120#': {'reply_deadline': '5s'}},
+                {'*120#': {'max_reply_length': '100'}}]:
+            transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+                'transport_name': 'sphex',
+                'web_path': '/api/blastSMS/ussd/',
+                'web_port': '0',
+                'shortcodes': shortcodes,
+            })
+            self.assertRaises(ConfigError, transport._validate_config)
+
+    def write_shortcodes_file(self, path, app_id):
+        with open(path, 'w') as f:
+            # The shortcode is left unquoted, so YAML loads it as a number.
+            f.write('shortcodes:\n  %s:\n    app_id: %s\n' % (
+                self.defaults['shortcode'], app_id))
+
+    @inlineCallbacks
+    def release(self):
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3'), _method='POST')
+        returnValue(response.delivered_body)
+
+    @inlineCallbacks
+    def test_shortcodes_file_reload_on_sighup(self):
+        path = self.mktemp()
+        self.write_shortcodes_file(path, 'before')
+        transport = yield self.get_transport({'shortcodes_file': path})
+        body = yield self.release()
+        self.assertTrue('<appid>before</appid>' in body)
+
+        self.write_shortcodes_file(path, 'after')
+        reloaded = Deferred()
+        self.patch(
+            transport, 'reload_response_config',
+            lambda: reloaded.callback(
+                BlastSMSUssdTransport.reload_response_config(transport)))
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.assertTrue((yield reloaded))
+        body = yield self.release()
+        self.assertTrue('<appid>after</appid>' in body)
+
+    @inlineCallbacks
+    def test_shortcodes_file_invalid_reload(self):
+        path = self.mktemp()
+        self.write_shortcodes_file(path, 'before')
+        transport = yield self.get_transport({'shortcodes_file': path})
+        with open(path, 'w') as f:
+            f.write('shortcodes: [')
+        self.assertFalse(transport.reload_response_config())
+        body = yield self.release()
+        self.assertTrue('<appid>before</appid>' in body)
+
+        with open(path, 'w') as f:
+            f.write('shortcodes:\n  "%s":\n' % (self.defaults['shortcode'],))
+        self.assertFalse(transport.reload_response_config())
+        body = yield self.release()
+        self.assertTrue('<appid>before</appid>' in body)
+
+    def test_shortcodes_file_missing(self):
+        transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+            'transport_name': 'sphex',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+            'shortcodes_file': self.mktemp(),
+        })
+        self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_rejection_stats(self):
+        transport = yield self.get_transport({'max_request_size': 200})
+        yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(msisdn=None), _method='POST')
+        yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(msisdn=None), _method='POST')
+        yield self.tx_helper.mk_request(_data='<ussd', _method='POST')
+        yield self.tx_helper.mk_request(_data='x' * 300, _method='POST')
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+        self.assertEqual(transport.get_stats()['rejections'], {
+            'missing_parameter': 2,
+            'invalid_xml': 1,
+            'request_too_large': 1,
+        })
+
+    @inlineCallbacks
+    def test_event_backpressure(self):
+        transport = yield self.get_transport({'event_queue_size': 4})
+        paused = []
+        self.patch(transport, 'pause_connectors', lambda: paused.append(1))
+        # Events are only published once the batch interval has passed.
+        for i in range(2):
+            transport.queue_ack('message-%d' % (i,))
+        self.assertEqual(paused, [1])
+        self.assertEqual(transport.get_stats()['events']['queued'], 2)
+
+        events = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assertEqual(
+            [event['user_message_id'] for event in events],
+            ['message-0', 'message-1'])
+        self.assertEqual(transport.get_stats()['events']['queued'], 0)
+        self.assertFalse(transport.outbox.full)
+
+    def assert_busy_reply(self, response, sessionid='test_session_id'):
+        self.assertEqual(response.code, 200)
+        self.assert_outbound_message(
+            response.delivered_body,
+            None,  # appid
+            'test_config_app_id',  # config app id
+            sessionid,
+            'Busy!',
+            self.defaults['msisdn'],
+            continue_session=False,
+        )
+
+    @inlineCallbacks
+    def test_msisdn_rate_limit(self):
+        transport = yield self.get_transport({
+            'msisdn_rate': 0.1,
+            'msisdn_burst': 1,
+            'busy_message': 'Busy!',
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1'), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='other'),
+            _method='POST')
+        self.assert_busy_reply(response, 'other')
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 1)
+        self.assertEqual(
+            transport.get_stats()['shed_requests'], {'msisdn_rate': 1})
+
+        # The end of a session is never limited.
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3', sessionid='other'),
+            _method='POST')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 2)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    @inlineCallbacks
+    def test_shortcode_rate_limit(self):
+        transport = yield self.get_transport({
+            'shortcode_rate': 0.1,
+            'shortcode_burst': 1,
+            'busy_message': 'Busy!',
+        })
+        # The end of a session doesn't use up the shortcode's allowance.
+        yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3'), _method='POST')
+
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1'), _method='POST')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+        # Existing sessions carry on.
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='2'), _method='POST')
+        [_, _, msg] = yield self.tx_helper.wait_for_dispatched_inbound(3)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1', sessionid='new'),
+            _method='POST')
+        self.assert_busy_reply(response, 'new')
+        self.assertEqual(
+            transport.get_stats()['shed_requests'], {'shortcode_rate': 1})
+
+    @inlineCallbacks
+    def test_max_open_requests(self):
+        transport = yield self.get_transport({
+            'max_open_requests': 1,
+            'busy_message': 'Busy!',
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='other'),
+            _method='POST')
+        self.assert_busy_reply(response, 'other')
+        self.assertEqual(
+            transport.get_stats()['shed_requests'], {'open_requests': 1})
+        self.assertFalse('other' in transport.sessions)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    def test_invalid_rate_limit(self):
+        transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+            'transport_name': 'sphex',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+            'msisdn_rate': 0,
+        })
+        self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_retry_while_pending(self):
+        transport = yield self.get_transport({'dedupe_window': 10})
+        inbound_xml = self.make_inbound_xml_string(msg='1')
+        d1 = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        d2 = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        yield self.tx_helper.kick_delivery()
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 1)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response1 = yield d1
+        response2 = yield d2
+        self.assertTrue('<msg>Ni!</msg>' in response1.delivered_body)
+        self.assertEqual(response2.delivered_body, response1.delivered_body)
+        self.assertEqual(response2.code, 200)
+        self.assertEqual(transport.get_stats()['dedupe'], {
+            'size': 1,
+            'hits': 1,
+            'misses': 1,
+            'hit_rate': 0.5,
+            'evictions': 0,
+        })
+
+    @inlineCallbacks
+    def test_retry_after_reply(self):
+        yield self.get_transport({'dedupe_window': 10})
+        inbound_xml = self.make_inbound_xml_string(msg='1')
+        d = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response1 = yield d
+
+        response2 = yield self.tx_helper.mk_request(
+            _data=inbound_xml, _method='POST')
+        self.assertEqual(response2.delivered_body, response1.delivered_body)
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 1)
+
+        # Other input in the same session isn't a retry.
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(msg='2'), _method='POST')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(msg['content'], '2')
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    @inlineCallbacks
+    def test_retry_after_window(self):
+        transport = yield self.get_transport({'dedupe_window': 10})
+        clock = Clock()
+        self.patch(transport.dedupe._requests, 'clock', clock)
+        inbound_xml = self.make_inbound_xml_string(msg='1')
+        d = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+        clock.advance(10)
+        transport.dedupe.expire()
+        d = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    @inlineCallbacks
+    def test_retry_of_timed_out_request(self):
+        transport = yield self.get_transport({'dedupe_window': 10})
+        inbound_xml = self.make_inbound_xml_string(msg='1')
+        d = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        transport.close_request(msg['message_id'])
+        response = yield d
+        self.assertEqual(response.code, transport.request_timeout_status_code)
+        self.assertEqual(len(transport.dedupe), 0)
+
+        # The retry is handled like a new request.
+        d = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assertTrue('<msg>Ni!</msg>' in response.delivered_body)
+
+    @inlineCallbacks
+    def test_retries_not_detected_by_default(self):
+        transport = yield self.get_transport()
+        inbound_xml = self.make_inbound_xml_string(msg='1')
+        d1 = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        d2 = self.tx_helper.mk_request(_data=inbound_xml, _method='POST')
+        msgs = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        for msg in msgs:
+            self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d1
+        yield d2
+        self.assertEqual(transport.get_stats()['dedupe'], None)
+
+    @inlineCallbacks
+    def test_reply_cache(self):
+        transport = yield self.get_transport()
+        for sessionid in ['session-1', 'session-2']:
+            d = self.tx_helper.mk_request(
+                _data=self.make_inbound_xml_string(sessionid=sessionid),
+                _method='POST')
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            self.tx_helper.clear_dispatched_inbound()
+            self.tx_helper.dispatch_outbound(msg.reply('Menu'))
+            response = yield d
+            self.assert_outbound_message(
+                response.delivered_body,
+                None,  # appid
+                'test_config_app_id',  # config app id
+                sessionid,
+                'Menu',
+                self.defaults['msisdn'],
+            )
+        stats = transport.get_stats()['reply_cache']
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def get_status_url(self, transport, path):
+        return 'http://127.0.0.1:%d/%s' % (
+            transport.web_resource.getHost().port, path)
+
+    @inlineCallbacks
+    def test_status(self):
+        transport = yield self.get_transport({'status_path': '/status'})
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        response = yield http_request_full(
+            self.get_status_url(transport, 'status'), method='GET')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'),
+            ['application/json'])
+        status = json.loads(response.delivered_body)
+        self.assertEqual(status['open_requests'], 1)
+        self.assertEqual(status['sessions'], 1)
+        self.assertEqual(status['window'], 60)
+        self.assertEqual(status['requests_per_second'], 1 / 60.0)
+        self.assertEqual(status['replies']['count'], 0)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        status = transport.get_status()
+        self.assertEqual(status['open_requests'], 0)
+        self.assertEqual(status['replies']['count'], 1)
+
+    @inlineCallbacks
+    def test_status_disabled(self):
+        transport = yield self.get_transport()
+        response = yield http_request_full(
+            self.get_status_url(transport, 'status'), method='GET')
+        self.assertEqual(response.code, 404)
+
+    @inlineCallbacks
+    def test_unencodable_reply(self):
+        transport = yield self.get_transport({'encoding': 'gsm7'})
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        bad_reply = msg.reply(u'\U0001f600', continue_session=False)
+        self.tx_helper.dispatch_outbound(bad_reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertTrue(
+            nack['nack_reason'].startswith("Reply can't be encoded."))
+        self.assertEqual(len(transport._requests), 1)
+        self.assertTrue(self.defaults['sessionid'] in transport.sessions)
+
+        self.tx_helper.dispatch_outbound(msg.reply(u'Ni! \u20ac5'))
+        response = yield d
+        self.assertTrue(
+            '<msg>Ni! \xe2\x82\xac5</msg>' in response.delivered_body)
+
+    @inlineCallbacks
+    def test_reply_truncated(self):
+        yield self.get_transport({
+            'shortcodes': {
+                self.defaults['shortcode']: {'max_reply_length': 5},
+            },
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('We are the Knights'))
+        response = yield d
+        self.assertTrue('<msg>We ar</msg>' in response.delivered_body)
+
+    @inlineCallbacks
+    def test_latin1_reply(self):
+        yield self.get_transport({'encoding': 'iso-8859-1'})
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply(u'Thr\xeb\xeb'))
+        response = yield d
+        self.assertTrue(response.delivered_body.startswith(
+            '<?xml version="1.0" encoding="iso-8859-1"?>'))
+        self.assertTrue('<msg>Thr\xeb\xeb</msg>' in response.delivered_body)
+
+    @inlineCallbacks
+    def test_release_shortcode_encoding(self):
+        yield self.get_transport({
+            'encoding': 'gsm7',
+            'shortcodes': {
+                self.defaults['shortcode']: {
+                    'encoding': 'iso-8859-1',
+                    'close_message': u'Adi\xf3s',
+                },
+            },
+        })
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='3'), _method='POST')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.delivered_body.startswith(
+            '<?xml version="1.0" encoding="iso-8859-1"?>'))
+        self.assertTrue('<msg>Adi\xf3s</msg>' in response.delivered_body)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['session_event'], 'close')
+
+    def test_invalid_encoding(self):
+        transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+            'transport_name': 'sphex',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+            'encoding': 'ebcdic',
+        })
+        self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_profiling(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        path = self.mktemp()
+        transport = yield self.get_transport({
+            'profile_file': path,
+            'profile_interval': 10,
+            'profile_sample_rate': 1,
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+        self.assertFalse(os.path.exists(path))
+        clock.advance(10)
+        with open(path) as f:
+            [report] = [json.loads(line) for line in f]
+        self.assertEqual(
+            sorted(report['calls']), sorted(transport.PROFILED_METHODS))
+        for stats in report['calls'].itervalues():
+            self.assertEqual(stats['calls'], 1)
+            self.assertEqual(stats['sampled'], 1)
+        # Without tracemalloc, counting objects has to be asked for.
+        self.assertEqual(report['memory'], None)
+
+    @inlineCallbacks
+    def test_codec_variant(self):
+        yield self.get_transport({
+            'codec_options': {
+                'root': 'ussd',
+                'tags': {'sessionid': 'session_id', 'msg': 'text'},
+            },
+        })
+        body = (
+            '<ussd><msisdn>273334444</msisdn><shortcode>8864</shortcode>'
+            '<session_id>abc</session_id><type>1</type><text>hi</text>'
+            '</ussd>')
+        d = self.tx_helper.mk_request(_data=body, _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], 'hi')
+        self.assertEqual(msg['transport_metadata']['sessionid'], 'abc')
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assertTrue(response.delivered_body.endswith(
+            '<session_id>abc</session_id><appid>test_config_app_id</appid>'
+            '<type>2</type><text>Ni!</text></ussd>'))
+
+    def test_invalid_codec(self):
+        for config in [{'codec': 'ebcdic'},
+                       {'codec_options': {'tags': {'foo': 'bar'}}}]:
+            transport = WorkerHelper.get_worker_raw(
+                BlastSMSUssdTransport, dict({
+                    'transport_name': 'sphex',
+                    'web_path': '/api/blastSMS/ussd/',
+                    'web_port': '0',
+                }, **config))
+            self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_drain(self):
+        path = self.mktemp()
+        transport = yield self.get_transport({
+            'busy_message': 'Busy!',
+            'session_snapshot_file': path,
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1'), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        drained = transport.start_drain()
+        self.assertFalse(drained.called)
+
+        response = yield http_request_full(
+            self.get_status_url(transport, 'health'), method='GET')
+        self.assertEqual(response.code, 503)
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='new', type='1'),
+            _method='POST')
+        self.assert_busy_reply(response, 'new')
+        # Requests of unknown types would start sessions too.
+        response = yield self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='odd', type='9'),
+            _method='POST')
+        self.assert_busy_reply(response, 'odd')
+        self.assertFalse(drained.called)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        yield drained
+        with open(path) as f:
+            [session] = json.load(f)['sessions']
+        self.assertEqual(session[0], 'test_session_id')
+
+        # Sessions in progress are still served.
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(msg='1'), _method='POST')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        yield transport.start_drain()
+        stats = transport.get_stats()
+        self.assertTrue(stats['draining'])
+        self.assertEqual(stats['shed_requests'], {'draining': 2})
+
+    @inlineCallbacks
+    def test_drain_signal(self):
+        transport = yield self.get_transport({'drain_signal': 'sigusr2'})
+        self.assertEqual(
+            signal.getsignal(signal.SIGUSR2), transport.handle_drain_signal)
+        started = Deferred()
+        self.patch(
+            transport, 'start_drain',
+            lambda: started.callback(
+                BlastSMSUssdTransport.start_drain(transport).called))
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue((yield started))
+        self.assertTrue(transport.draining)
+        self.assertTrue(transport.get_status()['draining'])
+
+    def test_invalid_drain_signal(self):
+        for name in ('SIGNOPE', 'SIG_IGN', 'NSIG'):
+            transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+                'transport_name': 'sphex',
+                'web_path': '/api/blastSMS/ussd/',
+                'web_port': '0',
+                'drain_signal': name,
+            })
+            self.assertRaises(ConfigError, transport._validate_config)
+
+    def test_reserved_drain_signal(self):
+        path = self.mktemp()
+        open(path, 'w').close()
+        for config in ({'drain_signal': 'SIGKILL'},
+                       {'drain_signal': 'SIGSTOP'},
+                       {'drain_signal': 'SIGUSR1'},
+                       {'drain_signal': 'SIGHUP', 'shortcodes_file': path}):
+            config.update({
+                'transport_name': 'sphex',
+                'web_path': '/api/blastSMS/ussd/',
+                'web_port': '0',
+            })
+            transport = WorkerHelper.get_worker_raw(
+                BlastSMSUssdTransport, config)
+            self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_session_snapshot(self):
+        path = self.mktemp()
+        transport = yield self.get_transport({'session_snapshot_file': path})
+        self.assertEqual(transport.get_stats()['restored_sessions'], 0)
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1'), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        yield self.tx_helper.cleanup_worker(transport)
+
+        transport = yield self.get_transport({'session_snapshot_file': path})
+        self.assertEqual(transport.get_stats()['restored_sessions'], 1)
+        self.assertTrue('test_session_id' in transport.sessions)
+
+    @inlineCallbacks
+    def test_session_snapshot_invalid(self):
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write('not json')
+        with LogCatcher() as lc:
+            transport = yield self.get_transport({
+                'session_snapshot_file': path,
+            })
+        self.assertEqual(transport.restored_sessions, 0)
+        self.assertTrue(any(
+            'Failed to load sessions' in textFromEventDict(log)
+            for log in lc.logs))
+
+    @inlineCallbacks
+    def get_coalescing_transport(self, config={}):
+        self.clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: self.clock)
+        config = dict({'coalesce_window': 0.5}, **config)
+        transport = yield self.get_transport(config)
+        returnValue(transport)
+
+    @inlineCallbacks
+    def assert_events(self, *expected):
+        self.clock.advance(0.01)
+        events = yield self.tx_helper.wait_for_dispatched_events(
+            len(expected))
+        for event, (reply, event_type) in zip(events, expected):
+            self.assertEqual(event['event_type'], event_type)
+            self.assertEqual(event['user_message_id'], reply['message_id'])
+
+    @inlineCallbacks
+    def test_coalesce_replies(self):
+        transport = yield self.get_coalescing_transport()
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply1 = msg.reply('Hello.')
+        reply2 = msg.reply('1. Ni!')
+        yield self.tx_helper.dispatch_outbound(reply1)
+        yield self.tx_helper.dispatch_outbound(reply2)
+        self.assertEqual(len(transport._requests), 1)
+        self.clock.advance(0.5)
+        response = yield d
+        self.assertTrue(
+            '<type>2</type><msg>Hello.\n1. Ni!</msg>' in
+            response.delivered_body)
+        yield self.assert_events((reply1, 'ack'), (reply2, 'ack'))
+        self.assertEqual(transport.get_stats()['coalesced_replies'], {
+            'merged': 1, 'messages': 2, 'truncated': 0})
+
+    @inlineCallbacks
+    def test_coalesce_single_reply(self):
+        transport = yield self.get_coalescing_transport()
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply('Ni!')
+        yield self.tx_helper.dispatch_outbound(reply)
+        self.clock.advance(0.5)
+        response = yield d
+        self.assertTrue('<msg>Ni!</msg>' in response.delivered_body)
+        yield self.assert_events((reply, 'ack'))
+        self.assertEqual(
+            transport.get_stats()['coalesced_replies']['merged'], 0)
+
+    @inlineCallbacks
+    def test_coalesce_session_close(self):
+        transport = yield self.get_coalescing_transport({
+            'coalesce_separator': ' ',
+            'max_reply_length': 10,
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply1 = msg.reply('Thanks.')
+        reply2 = msg.reply('Goodbye!', continue_session=False)
+        yield self.tx_helper.dispatch_outbound(reply1)
+        yield self.tx_helper.dispatch_outbound(reply2)
+        response = yield d
+        self.assertTrue(
+            '<type>3</type><msg>Thanks. Go</msg>' in response.delivered_body)
+        self.assertFalse('test_session_id' in transport.sessions)
+        yield self.assert_events((reply1, 'ack'), (reply2, 'ack'))
+        self.assertEqual(transport.get_stats()['coalesced_replies'], {
+            'merged': 1, 'messages': 2, 'truncated': 1})
+
+    @inlineCallbacks
+    def test_coalesce_after_window(self):
+        yield self.get_coalescing_transport()
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply1 = msg.reply('Ni!')
+        reply2 = msg.reply('Ni!')
+        yield self.tx_helper.dispatch_outbound(reply1)
+        self.clock.advance(0.5)
+        yield d
+        yield self.tx_helper.dispatch_outbound(reply2)
+        yield self.assert_events(
+            (reply1, 'ack'), (reply2, 'nack'))
+
+    @inlineCallbacks
+    def test_coalesce_until_deadline(self):
+        yield self.get_coalescing_transport({
+            'coalesce_window': 5,
+            'reply_deadline': 2,
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply('Ni!')
+        yield self.tx_helper.dispatch_outbound(reply)
+        self.clock.advance(2)
+        response = yield d
+        self.assertTrue('<msg>Ni!</msg>' in response.delivered_body)
+        yield self.assert_events((reply, 'ack'))
+
+    @inlineCallbacks
+    def test_coalesced_replies_of_evicted_request(self):
+        transport = yield self.get_coalescing_transport({
+            'max_pending_requests': 1,
+        })
+        d1 = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply('Ni!')
+        yield self.tx_helper.dispatch_outbound(reply)
+        d2 = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='other'),
+            _method='POST')
+        yield d1
+        yield self.assert_events((reply, 'nack'))
+        self.assertEqual(
+            transport.get_stats()['orphaned_replies'], {'evicted': 1})
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        yield self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        self.clock.advance(0.5)
+        yield d2
+
+    def test_invalid_coalesce_window(self):
+        transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+            'transport_name': 'sphex',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+            'coalesce_window': 0,
+        })
+        self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_journeys(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        path = self.mktemp()
+        yield self.get_transport({
+            'journey_file': path,
+            'journey_flush_interval': 60,
+        })
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(type='1'), _method='POST')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(0.5)
+        self.tx_helper.dispatch_outbound(msg.reply('Menu'))
+        yield d
+        clock.advance(10)
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(msg='1'), _method='POST')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        clock.advance(2)
+        self.tx_helper.dispatch_outbound(
+            msg.reply('Bye', continue_session=False))
+        yield d
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='other', type='1'),
+            _method='POST')
+        [_, _, msg] = yield self.tx_helper.wait_for_dispatched_inbound(3)
+        self.tx_helper.dispatch_outbound(msg.reply('Menu'))
+        yield d
+        d = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='other', type='3'),
+            _method='POST')
+        yield d
+
+        clock.advance(47.5)
+        with open(path) as f:
+            [report] = [json.loads(line) for line in f]
+        stats = report['shortcodes'][self.defaults['shortcode']]
+        self.assertEqual(stats['ends'], {'app_close': 1, 'user_release': 1})
+        self.assertEqual(stats['steps']['buckets']['1'], 1)
+        self.assertEqual(stats['steps']['buckets']['2'], 1)
+        self.assertEqual(stats['durations']['max'], 12.5)
+        self.assertEqual(stats['step_latencies']['1']['count'], 2)
+        self.assertEqual(stats['step_latencies']['1']['max'], 0.5)
+        self.assertEqual(stats['step_latencies']['2']['max'], 2)
+
+    def test_invalid_journey_settings(self):
+        transport = WorkerHelper.get_worker_raw(BlastSMSUssdTransport, {
+            'transport_name': 'sphex',
+            'web_path': '/api/blastSMS/ussd/',
+            'web_port': '0',
+            'journey_file': 'journeys.json',
+            'journey_max_steps': 0,
+        })
+        self.assertRaises(ConfigError, transport._validate_config)
+
+    @inlineCallbacks
+    def test_max_pending_requests(self):
+        transport = yield self.get_transport({
+            'max_pending_requests': 1,
+            'deadline_message': 'Too slow!',
+        })
+        d1 = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        [msg1] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        d2 = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='other'),
+            _method='POST')
+        response = yield d1
+        self.assert_outbound_message(
+            response.delivered_body,
+            None,  # appid
+            'test_config_app_id',  # config app id
+            'test_session_id',
+            'Too slow!',
+            self.defaults['msisdn'],
+            continue_session=False,
+        )
+        self.assertFalse('test_session_id' in transport.sessions)
+        self.assertEqual(len(transport._requests), 1)
+
+        [_, msg2] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        late_reply = msg1.reply('Ni!')
+        self.tx_helper.dispatch_outbound(late_reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, late_reply, transport.EVICTED_ERROR)
+
+        self.tx_helper.dispatch_outbound(msg2.reply('Ni!'))
+        yield d2
+        stats = transport.get_stats()
+        self.assertEqual(stats['evicted_requests'], 1)
+        self.assertEqual(stats['orphaned_replies'], {'evicted': 1})
+
+    @inlineCallbacks
+    def test_orphaned_reply(self):
+        transport = yield self.get_transport()
+        msg = self.tx_helper.make_inbound('Ni!')
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(
+            transport.get_stats()['orphaned_replies'], {'unknown': 1})
+
+    @inlineCallbacks
+    def test_request_timeout_in_arrival_order(self):
+        clock = Clock()
+        self.patch(BlastSMSUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({'request_timeout': 10})
+        d1 = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(), _method='POST')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(5)
+        d2 = self.tx_helper.mk_request(
+            _data=self.make_inbound_xml_string(sessionid='other'),
+            _method='POST')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(transport.get_status()['oldest_request_age'], 5)
+
+        clock.advance(6)
+        transport.manually_close_requests()
+        response = yield d1
+        self.assertEqual(response.code, transport.request_timeout_status_code)
+        self.assertEqual(list(transport._requests), [msg['message_id']])
+        self.assertEqual(transport.get_status()['oldest_request_age'], 6)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d2
+        self.assertEqual(transport.get_status()['oldest_request_age'], None)
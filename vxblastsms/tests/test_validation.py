@@ -0,0 +1,67 @@
+import json
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxblastsms.validation import RequestValidator
+
+
+class TestRequestValidator(VumiTestCase):
+
+    def mk_validator(self, **kw):
+        return RequestValidator(['msisdn', 'type'], ['msg'], **kw)
+
+    def test_valid(self):
+        validator = self.mk_validator()
+        self.assertEqual(
+            validator.validate({'msisdn': '1', 'type': '1', 'msg': 'a'}),
+            None)
+        self.assertEqual(validator.validate({'msisdn': '1', 'type': '1'}),
+                         None)
+        self.assertEqual(validator.get_stats(), {})
+
+    def test_missing(self):
+        validator = self.mk_validator()
+        body = validator.validate({'msg': 'a'})
+        self.assertEqual(
+            json.loads(body), {'missing_parameter': ['msisdn', 'type']})
+        self.assertEqual(validator.get_stats(), {'missing_parameter': 1})
+
+    def test_unexpected(self):
+        validator = self.mk_validator()
+        body = validator.validate(
+            {'msisdn': '1', 'type': '1', 'foo': 'a', 'bar': 'b'})
+        self.assertEqual(
+            json.loads(body), {'unexpected_parameter': ['bar', 'foo']})
+        self.assertEqual(validator.get_stats(), {'unexpected_parameter': 1})
+
+    def test_unexpected_not_strict(self):
+        validator = self.mk_validator(strict=False)
+        self.assertEqual(
+            validator.validate({'msisdn': '1', 'type': '1', 'foo': 'a'}),
+            None)
+
+    def test_error_bodies_cached(self):
+        validator = self.mk_validator()
+        first = validator.validate({'foo': 'a'})
+        second = validator.validate({'foo': 'b'})
+        self.assertTrue(first is second)
+        self.assertEqual(validator.get_stats(), {
+            'missing_parameter': 2,
+            'unexpected_parameter': 2,
+        })
+
+    def test_error_bodies_bounded(self):
+        validator = self.mk_validator(max_error_bodies=1)
+        validator.validate({'foo': 'a'})
+        body = validator.validate({'bar': 'a'})
+        self.assertEqual(json.loads(body), {
+            'missing_parameter': ['msisdn', 'type'],
+            'unexpected_parameter': ['bar'],
+        })
+        self.assertEqual(len(validator._error_bodies), 1)
+
+    def test_count_rejection(self):
+        validator = self.mk_validator()
+        validator.count_rejection('invalid_xml')
+        validator.count_rejection('invalid_xml')
+        self.assertEqual(validator.get_stats(), {'invalid_xml': 2})
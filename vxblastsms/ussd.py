@@ -1,21 +1,329 @@
 import json
-from xml.etree.ElementTree import Element, SubElement, tostring
-from xml.etree import ElementTree
-from xml.dom import minidom
+import os
+import signal
+from collections import OrderedDict
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
 from twisted.web import http
+from twisted.web.resource import Resource
 
 from vumi.message import TransportUserMessage
 from vumi.transports.httprpc import HttpRpcTransport
-from vumi.config import ConfigText
+from vumi.transports.httprpc.httprpc import HttpRpcHealthResource
+from vumi.config import (
+    ConfigBool, ConfigDict, ConfigError, ConfigFloat, ConfigInt, ConfigText)
+from vumi.utils import build_web_site
 from vumi import log
 
+from vxblastsms.codec import (
+    MAX_USSD_LENGTH, DecodeError, EncodeError, RequestTooLarge,
+    get_codec)
+from vxblastsms.cache import TimedCache
+from vxblastsms.dedupe import DedupeIndex
+from vxblastsms.journeys import JourneyAggregator
+from vxblastsms.messagelog import LOG_LEVELS, MessageLogger
+from vxblastsms.outbox import EventOutbox
+from vxblastsms.profiling import CallProfiler
+from vxblastsms.ratelimit import RateLimiter
+from vxblastsms.replycache import ReplyCache
+from vxblastsms.responseconfig import (
+    ResponseConfigIndex, ResponseSettings, check_overrides, check_positive,
+    config_key, load_shortcodes_file)
+from vxblastsms.reuseport import listen_reuse_port
+from vxblastsms.sessions import SessionTable
+from vxblastsms.stats import LatencyRecorder, RollingCounter, RollingHistogram
+from vxblastsms.validation import RequestValidator
+
 
 class BlastSMSUssdTransportConfig(HttpRpcTransport.CONFIG_CLASS):
     app_id = ConfigText(
         'App identifying string',
         required=False, static=True)
+    max_request_size = ConfigInt(
+        'Maximum size in bytes of an inbound request body. Larger requests '
+        'are rejected without being parsed.',
+        default=8192, static=True)
+    session_timeout = ConfigInt(
+        'Seconds after which a session without any traffic is forgotten.',
+        default=600, static=True)
+    max_sessions = ConfigInt(
+        'Maximum number of sessions to keep track of. When this is exceeded '
+        'the least recently active session is forgotten.',
+        default=100000, static=True)
+    reply_deadline = ConfigFloat(
+        'Seconds to wait for the application to reply before ending the '
+        'session with `deadline_message`. If unset, we wait until the '
+        'request times out.',
+        required=False, static=True)
+    shortcode_reply_deadlines = ConfigDict(
+        'Mapping of shortcode to the `reply_deadline` to use for it. This '
+        'is shorthand for setting `reply_deadline` in `shortcodes`, which '
+        'wins when a shortcode has a deadline in both.',
+        default={}, static=True)
+    deadline_message = ConfigText(
+        'Message sent when the application misses the reply deadline.',
+        default='Sorry, the service is not available right now. '
+                'Please try again later.',
+        static=True)
+    shortcodes = ConfigDict(
+        'Mapping of shortcode to settings overriding `app_id`, '
+        '`reply_deadline`, `deadline_message`, `close_message`, '
+        '`busy_message`, `encoding` and `max_reply_length` for '
+        'requests to it. A shortcode\'s `apps` setting maps appids to '
+        'settings overriding the shortcode\'s.',
+        default={}, static=True)
+    shortcodes_file = ConfigText(
+        'Path to a YAML file with a `shortcodes` mapping in the same format '
+        'as the `shortcodes` config, overriding it. The file is read again '
+        'when the transport receives SIGHUP.',
+        required=False, static=True)
+    close_message = ConfigText(
+        'Message sent in reply to BlastSMS ending a session.',
+        required=False, static=True)
+    msisdn_rate = ConfigFloat(
+        'Requests per second allowed from each msisdn. Requests beyond this '
+        'end the session with `busy_message`. If unset, msisdns are not '
+        'rate limited. With `web_reuse_port`, each process limits only the '
+        'requests it gets, so an msisdn may make this many per process.',
+        required=False, static=True)
+    msisdn_burst = ConfigInt(
+        'Number of requests an msisdn may make in a burst above '
+        '`msisdn_rate`.',
+        default=10, static=True)
+    shortcode_rate = ConfigFloat(
+        'New sessions per second allowed for each shortcode. New sessions '
+        'beyond this are ended with `busy_message`. If unset, shortcodes '
+        'are not rate limited. With `web_reuse_port`, each process limits '
+        'only the requests it gets.',
+        required=False, static=True)
+    shortcode_burst = ConfigInt(
+        'Number of new sessions a shortcode may get in a burst above '
+        '`shortcode_rate`.',
+        default=100, static=True)
+    max_open_requests = ConfigInt(
+        'Maximum number of requests waiting for a reply. Requests beyond '
+        'this end the session with `busy_message`. If unset, there is no '
+        'limit.',
+        required=False, static=True)
+    max_pending_requests = ConfigInt(
+        'Hard limit on the number of HTTP requests held open. When it is '
+        'reached, the oldest request is ended with `deadline_message` to '
+        'make room, whether or not the application has replied. Unlike '
+        '`max_open_requests`, this applies to every request.',
+        default=100000, static=True)
+    busy_message = ConfigText(
+        'Message sent when a request is refused because of a rate limit.',
+        default='The service is busy right now. Please try again later.',
+        static=True)
+    status_path = ConfigText(
+        'Path on the web server to serve live stats on, as JSON. If unset, '
+        'they are not served.',
+        required=False, static=True)
+    status_window = ConfigInt(
+        'Seconds over which the live stats count requests and replies.',
+        default=60, static=True)
+    encoding = ConfigText(
+        'How replies are encoded: utf-8, iso-8859-1, or gsm7 for UTF-8 '
+        'replies restricted to the GSM 03.38 alphabet. Replies with '
+        'characters the encoding lacks are nacked. Can be set per '
+        'shortcode and app in `shortcodes`.',
+        default='utf-8', static=True)
+    max_reply_length = ConfigInt(
+        'Replies longer than this are truncated. Lengths are counted in '
+        'characters, or in GSM 03.38 septets with the gsm7 encoding. Can '
+        'be set per shortcode and app in `shortcodes`.',
+        default=MAX_USSD_LENGTH, static=True)
+    web_reuse_port = ConfigBool(
+        'Listen on `web_port` with SO_REUSEPORT so that several transport '
+        'processes can share the port. Requires Linux 3.9 or later. Each '
+        'process keeps its own session table, and the requests of a '
+        'session may reach any of them. A process that gets a resume for a '
+        'session it didn\'t open counts a new session, and the one that '
+        'opened it counts it as expired once `session_timeout` passes '
+        'unless the release reaches it too, so session and journey stats '
+        'are only approximate.',
+        default=False, static=True)
+    reply_routing = ConfigBool(
+        'Route replies to the transport process holding the HTTP request '
+        'they are for. This must be enabled when more than one process '
+        'shares a `transport_name`.',
+        default=False, static=True)
+    reply_route = ConfigText(
+        'Name identifying this transport process for `reply_routing`, '
+        'which requires it. It must be unique among the processes sharing '
+        'a `transport_name` and stay the same when the process restarts, '
+        'because replies are forwarded to it through a durable queue named '
+        'after it. Replies for requests a process no longer holds are '
+        'nacked when it gets them. The queues of routes that are retired '
+        'have to be deleted from the broker.',
+        required=False, static=True)
+    dedupe_window = ConfigFloat(
+        'Seconds for which a request with the same sessionid, type and msg '
+        'as an earlier one is treated as a retry by BlastSMS. Retries are '
+        'given the reply to the earlier request instead of being passed on '
+        'to the application. This should be shorter than subscribers take '
+        'to answer a menu, since they might give the same answer twice. If '
+        'unset, retries are not detected. With `web_reuse_port`, each '
+        'process only remembers its own requests, so a retry that reaches '
+        'a different process is passed on to the application again.',
+        required=False, static=True)
+    max_dedupe_requests = ConfigInt(
+        'Maximum number of requests to remember for detecting retries.',
+        default=100000, static=True)
+    coalesce_window = ConfigFloat(
+        'Seconds to wait after the first reply to a request for more '
+        'replies to it from the application. Replies that arrive within the '
+        'window are joined with `coalesce_separator` and sent as one, '
+        'truncated to the maximum reply length, instead of all but the '
+        'first being nacked. Every reply that doesn\'t end the session is '
+        'delayed by the window. If unset, replies are sent straight away.',
+        required=False, static=True)
+    coalesce_separator = ConfigText(
+        'Text put between replies joined within `coalesce_window`.',
+        default='\n', static=True)
+    reply_cache_size = ConfigInt(
+        'Number of recent replies whose content, type and appid are kept '
+        'encoded, so that sending the same reply to another subscriber '
+        'only needs their msisdn and sessionid encoded. 0 disables the '
+        'cache.',
+        default=1000, static=True)
+    reply_cache_max_bytes = ConfigInt(
+        'Approximate maximum memory in bytes used by the reply cache.',
+        default=10 * 1024 * 1024, static=True)
+    event_queue_size = ConfigInt(
+        'Maximum number of acks and nacks waiting to be published. We stop '
+        'consuming outbound messages when half of this is reached, until '
+        'the queue is down to a quarter.',
+        default=10000, static=True)
+    event_batch_size = ConfigInt(
+        'Number of queued acks and nacks that triggers publishing them '
+        'immediately.',
+        default=100, static=True)
+    event_flush_interval = ConfigFloat(
+        'Seconds to wait for a batch of acks and nacks to fill up before '
+        'publishing it.',
+        default=0.01, static=True)
+    message_log_level = ConfigText(
+        'Level to log inbound and outbound messages at, one of %s. Messages '
+        'are logged at `info`, so a higher level turns message logging off.'
+        % (', '.join(sorted(LOG_LEVELS)),),
+        default='info', static=True)
+    message_log_sample_rate = ConfigInt(
+        'Log only one in every N outbound message bodies.',
+        default=1, static=True)
+    message_log_redact = ConfigBool(
+        'Mask msisdns and leave message content out of the message logs.',
+        default=False, static=True)
+    profile_file = ConfigText(
+        'File to append profiles of request handling to, as lines of JSON. '
+        'If unset, request handling is not profiled.',
+        required=False, static=True)
+    profile_interval = ConfigFloat(
+        'Seconds between profiles written to `profile_file`.',
+        default=60, static=True)
+    profile_sample_rate = ConfigInt(
+        'Profile one in this many calls of each profiled method.',
+        default=100, static=True)
+    profile_object_counts = ConfigBool(
+        'Report which types of object grew in each profile when tracemalloc '
+        'isn\'t tracing. This walks every object the garbage collector '
+        'tracks, which blocks the reactor for as long as it takes in a '
+        'large process.',
+        default=False, static=True)
+    codec = ConfigText(
+        'Wire format of requests and replies: `xml`, `dom`, `lxml` or the '
+        'dotted path of a `vxblastsms.codec.WireCodec` subclass. `xml` is '
+        'the fastest, `dom` the original implementation and `lxml` needs '
+        'lxml to be installed.',
+        default='xml', static=True)
+    codec_options = ConfigDict(
+        'Keyword arguments for the codec. The XML codecs accept `root`, the '
+        'root element of replies, and `tags`, a mapping of field names to '
+        'the tags used for them, for aggregators whose format differs from '
+        'BlastSMS\'s.',
+        default={}, static=True)
+    drain_signal = ConfigText(
+        'Name of a signal, such as SIGUSR2, that puts the transport in drain '
+        'mode before a restart. While draining, new sessions get the busy '
+        'message and the health check fails, but requests in sessions that '
+        'are already in progress are still served. SIGKILL and SIGSTOP '
+        'can\'t be caught, and SIGUSR1 can\'t be used because twistd '
+        'rotates its log file on it, nor can SIGHUP with `shortcodes_file`. '
+        'If unset, the transport can\'t be drained.',
+        required=False, static=True)
+    session_snapshot_file = ConfigText(
+        'File that the active sessions are saved to once the transport has '
+        'drained and when it stops, and loaded from when it starts, so that '
+        'a restarted transport keeps track of the sessions in progress.',
+        required=False, static=True)
+    journey_file = ConfigText(
+        'File to append per-shortcode statistics about sessions to, as '
+        'lines of JSON: how sessions ended, how many steps they took, how '
+        'long they lasted and how long each step took to answer. If unset, '
+        'these statistics are not kept.',
+        required=False, static=True)
+    journey_flush_interval = ConfigFloat(
+        'Seconds between the statistics written to `journey_file`.',
+        default=60, static=True)
+    journey_max_steps = ConfigInt(
+        'Number of steps into a session that step latencies are kept '
+        'separately for. Later steps are counted together.',
+        default=20, static=True)
+
+
+class BlastSMSStatusResource(Resource):
+    isLeaf = True
+
+    def __init__(self, transport):
+        self.transport = transport
+        Resource.__init__(self)
+
+    def render_GET(self, request):
+        request.setResponseCode(http.OK)
+        request.setHeader('Content-Type', 'application/json')
+        request.do_not_log = True
+        return self.transport.get_status_response()
+
+
+class BlastSMSHealthResource(HttpRpcHealthResource):
+    """Fails the health check while draining, so we get no new traffic."""
+
+    def render_GET(self, request):
+        body = HttpRpcHealthResource.render_GET(self, request)
+        if self.transport.draining:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        return body
+
+
+class InboundContext(object):
+    """
+    What we need to know about an inbound request to reply to it.
+
+    This is stored with the pending HTTP request, so it goes away when the
+    request is finished or times out.
+    """
+    __slots__ = ('msisdn', 'sessionid', 'appid', 'settings', 'received_at',
+                 'published_at', 'deadline_call', 'dedupe_key', 'shortcode',
+                 'step', 'coalesced', 'coalesce_call')
+
+    def __init__(self, msisdn, sessionid, appid, settings, received_at,
+                 shortcode=None):
+        self.msisdn = msisdn
+        self.sessionid = sessionid
+        self.appid = appid
+        self.settings = settings
+        self.received_at = received_at
+        self.published_at = None
+        self.deadline_call = None
+        self.dedupe_key = None
+        self.shortcode = shortcode
+        # Which step of its session the request is, if it needs a reply.
+        self.step = None
+        # Replies held while waiting for more, see `coalesce_window`.
+        self.coalesced = None
+        self.coalesce_call = None
 
 
 class BlastSMSUssdTransport(HttpRpcTransport):
@@ -38,92 +346,879 @@ class BlastSMSUssdTransport(HttpRpcTransport):
     RESPONSE_FAILURE_ERROR = "Response to http request failed."
     NOT_REPLY_ERROR = "Outbound message is not a reply"
     NO_CONTENT_ERROR = "Outbound message has no content."
+    DEADLINE_EXCEEDED_ERROR = "Reply deadline exceeded."
+    EVICTED_ERROR = "Request ended to make room for newer ones."
+    ENCODING_ERROR = "Reply can't be encoded."
+
+    # How many requests that missed their reply deadline we remember, so
+    # that late replies to them can be told apart from other failures.
+    MAX_EXPIRED_REQUESTS = 10000
+
+    # Why we might have stopped waiting for a reply to a request, and what
+    # we nack late replies to it with.
+    EXPIRY_NACK_REASONS = {
+        'deadline_exceeded': DEADLINE_EXCEEDED_ERROR,
+        'evicted': EVICTED_ERROR,
+    }
+
+    # How many other transport processes we forward replies to.
+    MAX_REPLY_ROUTES = 1000
+
+    # How many msisdns and shortcodes we keep rate limiting state for.
+    MAX_RATE_LIMITED_KEYS = 100000
+
+    # Methods that are profiled when `profile_file` is set.
+    PROFILED_METHODS = (
+        'handle_raw_inbound_message',
+        'generate_body',
+        'handle_outbound_message',
+    )
+
+    # Stages of the USSD round trip we keep latency histograms for.
+    LATENCY_STAGES = (
+        'parse',  # decoding and validating the inbound request
+        'publish',  # publishing the inbound message
+        'app',  # from publishing until the application's reply arrives
+        'generate',  # generating the reply body
+        'round_trip',  # from receiving the request to finishing it
+    )
 
     CONFIG_CLASS = BlastSMSUssdTransportConfig
 
-    def get_field_values(self, request_data, expected_fields,
-                         ignored_fields=frozenset()):
-        values = {}
-        errors = {}
+    def validate_config(self):
+        super(BlastSMSUssdTransport, self).validate_config()
+        config = self.get_static_config()
+        self.max_request_size = config.max_request_size
+        self.session_timeout = config.session_timeout
+        self.max_sessions = config.max_sessions
+        self.shortcodes_file = config.shortcodes_file
+        try:
+            self.response_config = self.load_response_config()
+        except (IOError, ValueError) as e:
+            raise ConfigError('Invalid shortcode settings: %s' % (e,))
+        self.status_path = config.status_path
+        if self.status_path is not None:
+            self.status_path = self.status_path.lstrip('/')
+        self.status_window = config.status_window
+        if self.status_window <= 0:
+            raise ConfigError('status_window must be positive.')
+        self.web_reuse_port = config.web_reuse_port
+        self.reply_routing = config.reply_routing
+        self.reply_route = config.reply_route
+        if self.reply_routing and not self.reply_route:
+            # A name that changed on every restart would leave a durable
+            # queue behind on the broker each time.
+            raise ConfigError('reply_routing requires a reply_route.')
+        if self.reply_route is not None:
+            # vumi refuses routing keys that aren't all lower case.
+            self.reply_route = self.reply_route.lower()
+        if config.message_log_level not in LOG_LEVELS:
+            raise ConfigError('Invalid message log level: %s' % (
+                config.message_log_level,))
+        if config.message_log_sample_rate < 1:
+            raise ConfigError('Invalid message log sample rate: %s' % (
+                config.message_log_sample_rate,))
+        for name in ('msisdn', 'shortcode'):
+            rate = getattr(config, '%s_rate' % (name,))
+            burst = getattr(config, '%s_burst' % (name,))
+            if rate is not None and (rate <= 0 or burst < 1):
+                raise ConfigError(
+                    'Invalid %s rate limit: %s requests per second with '
+                    'bursts of %s.' % (name, rate, burst))
+        self.msisdn_rate = config.msisdn_rate
+        self.msisdn_burst = config.msisdn_burst
+        self.shortcode_rate = config.shortcode_rate
+        self.shortcode_burst = config.shortcode_burst
+        self.max_open_requests = config.max_open_requests
+        self.max_pending_requests = config.max_pending_requests
+        if self.max_pending_requests < 1:
+            raise ConfigError('max_pending_requests must be positive.')
+        self.coalesce_window = config.coalesce_window
+        if self.coalesce_window is not None and self.coalesce_window <= 0:
+            raise ConfigError('coalesce_window must be positive.')
+        self.coalesce_separator = config.coalesce_separator
+        self.dedupe_window = config.dedupe_window
+        self.max_dedupe_requests = config.max_dedupe_requests
+        self.reply_cache_size = config.reply_cache_size
+        self.reply_cache_max_bytes = config.reply_cache_max_bytes
+        self.event_queue_size = config.event_queue_size
+        self.event_batch_size = config.event_batch_size
+        self.event_flush_interval = config.event_flush_interval
+        self.message_log = MessageLogger(
+            LOG_LEVELS[config.message_log_level],
+            config.message_log_sample_rate,
+            config.message_log_redact)
+        self.profile_file = config.profile_file
+        self.profile_interval = config.profile_interval
+        if config.profile_sample_rate < 1 or self.profile_interval <= 0:
+            raise ConfigError('Invalid profiling settings.')
+        self.profiler = None
+        if self.profile_file is not None:
+            # The outbound handler is registered before setup_transport,
+            # so the profiled methods have to be in place by now.
+            self.profiler = CallProfiler(
+                config.profile_sample_rate,
+                count_objects=config.profile_object_counts)
+            for name in self.PROFILED_METHODS:
+                setattr(self, name, self.profiler.wrap(
+                    name, getattr(self, name)))
+        try:
+            self.codec = get_codec(config.codec, config.codec_options)
+        except ValueError as e:
+            raise ConfigError('Invalid codec: %s' % (e,))
+        self.drain_signal = None
+        if config.drain_signal is not None:
+            name = config.drain_signal.upper()
+            if name.startswith('SIG') and not name.startswith('SIG_'):
+                self.drain_signal = getattr(signal, name, None)
+            if not isinstance(self.drain_signal, int):
+                raise ConfigError('Unknown drain signal: %s' % (
+                    config.drain_signal,))
+            if self.drain_signal in (signal.SIGKILL, signal.SIGSTOP):
+                raise ConfigError(
+                    '%s can\'t be caught and can\'t be the drain signal.' % (
+                        name,))
+            if self.drain_signal == signal.SIGUSR1:
+                raise ConfigError(
+                    'SIGUSR1 rotates twistd\'s log file and can\'t be the '
+                    'drain signal.')
+            if (self.drain_signal == signal.SIGHUP and
+                    self.shortcodes_file is not None):
+                raise ConfigError(
+                    'SIGHUP reloads shortcodes_file and can\'t be the drain '
+                    'signal too.')
+        self.session_snapshot_file = config.session_snapshot_file
+        self.journey_file = config.journey_file
+        self.journey_flush_interval = config.journey_flush_interval
+        self.journey_max_steps = config.journey_max_steps
+        if self.journey_flush_interval <= 0 or self.journey_max_steps < 1:
+            raise ConfigError('Invalid journey settings.')
 
-        for field in request_data:
-            if field not in (expected_fields | ignored_fields):
-                if self._validation_mode == self.STRICT_MODE:
-                    errors.setdefault('unexpected_parameter', []).append(field)
-            else:
-                values[field] = (
-                    request_data[field].decode(self.ENCODING))
-        for field in expected_fields:
-            if field not in values:
-                errors.setdefault('missing_parameter', []).append(field)
+    @inlineCallbacks
+    def setup_transport(self):
+        yield super(BlastSMSUssdTransport, self).setup_transport()
+        if self.web_reuse_port:
+            per_process = [
+                name for name in ('dedupe_window', 'msisdn_rate',
+                                  'shortcode_rate')
+                if getattr(self, name) is not None]
+            if per_process:
+                log.warning(
+                    '%s only apply to the requests each process sharing '
+                    'the port gets.' % (', '.join(per_process),))
+        # Requests are kept in the order they arrived, so that the oldest
+        # can be found without looking at the others.
+        self._requests = OrderedDict()
+        self.evicted_requests = 0
+        self.orphaned_replies = {}
+        self.journeys = None
+        on_session_end = None
+        if self.journey_file is not None:
+            self.journeys = JourneyAggregator(self.journey_max_steps)
+            on_session_end = self.record_session_end
+        self.sessions = SessionTable(
+            self.session_timeout, self.max_sessions, self.clock,
+            on_session_end)
+        self.restored_sessions = 0
+        if self.session_snapshot_file is not None:
+            self.restore_sessions()
+        self.draining = False
+        self.drained = False
+        self.drain_waiters = []
+        self.expired_requests = TimedCache(
+            self.request_timeout, self.MAX_EXPIRED_REQUESTS, self.clock)
+        self.deadline_replies = 0
+        self.coalesced_replies = {'merged': 0, 'messages': 0, 'truncated': 0}
+        self.latency = LatencyRecorder(self.LATENCY_STAGES)
+        self.recent_requests = RollingCounter(self.status_window, self.clock)
+        self.recent_replies = RollingHistogram(self.status_window, self.clock)
+        self.outbox = EventOutbox(
+            self.publish_event, self.clock,
+            max_size=self.event_queue_size,
+            batch_size=self.event_batch_size,
+            flush_interval=self.event_flush_interval,
+            on_full=self.pause_outbound,
+            on_drained=self.unpause_outbound)
+        self.msisdn_limiter = None
+        if self.msisdn_rate is not None:
+            self.msisdn_limiter = RateLimiter(
+                self.msisdn_rate, self.msisdn_burst, self.clock,
+                self.MAX_RATE_LIMITED_KEYS)
+        self.shortcode_limiter = None
+        if self.shortcode_rate is not None:
+            self.shortcode_limiter = RateLimiter(
+                self.shortcode_rate, self.shortcode_burst, self.clock,
+                self.MAX_RATE_LIMITED_KEYS)
+        self.dedupe = None
+        if self.dedupe_window is not None:
+            self.dedupe = DedupeIndex(
+                self.dedupe_window, self.max_dedupe_requests, self.clock)
+        self.state_gc = LoopingCall(self.expire_state)
+        self.state_gc.clock = self.clock
+        self.state_gc.start(self.gc_requests_interval)
+        self.profile_dump = None
+        if self.profiler is not None:
+            self.profile_dump = LoopingCall(self.dump_profile)
+            self.profile_dump.clock = self.clock
+            self.profile_dump.start(self.profile_interval, now=False)
+        self.journey_flush = None
+        if self.journeys is not None:
+            self.journey_flush = LoopingCall(self.flush_journeys)
+            self.journey_flush.clock = self.clock
+            self.journey_flush.start(self.journey_flush_interval, now=False)
+        self.reply_cache = ReplyCache(
+            self.reply_cache_size, self.reply_cache_max_bytes, self.codec)
+        self.shed_requests = {}
+        self.validator = RequestValidator(
+            self.EXPECTED_FIELDS, self.OPTIONAL_FIELDS,
+            strict=self._validation_mode == self.STRICT_MODE)
+        self.forwarded_replies = 0
+        self.reply_route_publishers = {}
+        self.reply_route_consumer = None
+        if self.reply_routing:
+            self.reply_route_consumer = yield self.consume(
+                self.get_reply_route_key(self.reply_route),
+                self.handle_outbound_message,
+                message_class=TransportUserMessage)
+        self.previous_sighup_handler = None
+        if self.shortcodes_file is not None:
+            self.previous_sighup_handler = signal.signal(
+                signal.SIGHUP, self.handle_sighup)
+        self.previous_drain_handler = None
+        if self.drain_signal is not None:
+            self.previous_drain_handler = signal.signal(
+                self.drain_signal, self.handle_drain_signal)
 
-        return values, errors
+    @inlineCallbacks
+    def teardown_transport(self):
+        if self.state_gc.running:
+            self.state_gc.stop()
+        if self.profile_dump is not None and self.profile_dump.running:
+            self.profile_dump.stop()
+            self.dump_profile()
+        if self.journey_flush is not None and self.journey_flush.running:
+            self.journey_flush.stop()
+            self.flush_journeys()
+        if self.reply_route_consumer is not None:
+            yield self.reply_route_consumer.stop()
+        if self.previous_sighup_handler is not None:
+            signal.signal(signal.SIGHUP, self.previous_sighup_handler)
+        if self.previous_drain_handler is not None:
+            signal.signal(self.drain_signal, self.previous_drain_handler)
+        # The connectors have been paused for teardown, so the outbox is
+        # stopped before draining to keep it from unpausing them, and again
+        # afterwards to cancel any flush scheduled meanwhile.
+        self.outbox.stop()
+        yield self.outbox.drain()
+        self.outbox.stop()
+        for request_id in self._requests.keys():
+            self.cancel_reply_deadline(request_id)
+            self.cancel_coalescing(request_id)
+        if self.session_snapshot_file is not None:
+            self.save_sessions()
+        yield super(BlastSMSUssdTransport, self).teardown_transport()
 
-    def get_optional_field_values(self, request_data,
-                                  optional_fields=frozenset()):
-        values = {}
+    def dump_profile(self):
+        try:
+            self.profiler.dump(self.profile_file)
+        except IOError as e:
+            log.warning('Failed to write profile to %s: %s' % (
+                self.profile_file, e))
 
-        for field in optional_fields:
-            if field in request_data:
-                raw_value = request_data[field]
-                values[field] = raw_value.decode(self.ENCODING)
-            else:
-                values[field] = None
+    def record_session_end(self, session, reason):
+        self.journeys.record_end(
+            session.shortcode, session.steps, reason,
+            self.clock.seconds() - session.started_at)
 
-        return values
+    def flush_journeys(self):
+        try:
+            self.journeys.flush(self.journey_file)
+        except IOError as e:
+            log.warning('Failed to write journeys to %s: %s' % (
+                self.journey_file, e))
 
-    def get_request_data_dict(self, request):
-        req_content = request.content.read()
-        req_data = {}
+    def pause_outbound(self):
+        log.warning(
+            'Too many acks and nacks waiting to be published, pausing '
+            'outbound messages.')
+        self.pause_connectors()
+        if self.reply_route_consumer is not None:
+            self.reply_route_consumer.pause()
+
+    def unpause_outbound(self):
+        log.info('Resuming outbound messages.')
+        self.unpause_connectors()
+        if self.reply_route_consumer is not None:
+            self.reply_route_consumer.unpause()
+
+    def queue_ack(self, message_id):
+        """
+        Queue an ack for publishing. We don't wait for acks and nacks to be
+        published because if a message store is used, that waits for Riak
+        and responding to USSD messages is time critical.
+        """
+        self.outbox.put(
+            user_message_id=message_id, sent_message_id=message_id,
+            event_type='ack')
+
+    def queue_nack(self, message_id, reason):
+        """Queue a nack for publishing. See :meth:`queue_ack`."""
+        self.outbox.put(
+            user_message_id=message_id, nack_reason=reason,
+            event_type='nack')
+
+    def start_web_resources(self, resources, port, site_class=None):
+        resources = [
+            (BlastSMSHealthResource(self), path)
+            if isinstance(resource, HttpRpcHealthResource)
+            else (resource, path)
+            for resource, path in resources]
+        if self.status_path is not None:
+            resources = resources + [
+                (BlastSMSStatusResource(self), self.status_path)]
+        if not self.web_reuse_port:
+            return super(BlastSMSUssdTransport, self).start_web_resources(
+                resources, port, site_class=site_class)
+        resources = dict((path, resource) for resource, path in resources)
+        site_factory = build_web_site(resources, site_class=site_class)
+        return listen_reuse_port(reactor, port, site_factory)
+
+    def load_response_config(self):
+        """
+        Resolve the response settings for every configured shortcode from
+        the static config and the shortcodes file.
+        """
+        config = self.get_static_config()
+        default = ResponseSettings(
+            app_id=config.app_id,
+            reply_deadline=config.reply_deadline,
+            deadline_message=config.deadline_message,
+            close_message=config.close_message,
+            busy_message=config.busy_message,
+            encoding=config.encoding,
+            max_reply_length=config.max_reply_length)
+
+        # shortcode_reply_deadlines is folded into the shortcodes config,
+        # which takes precedence, and the shortcodes file replaces both.
+        shortcodes = {}
+        for shortcode, deadline in (
+                config.shortcode_reply_deadlines.iteritems()):
+            shortcode = config_key(shortcode)
+            check_positive(
+                'reply_deadline for %s' % (shortcode,), deadline,
+                (int, long, float))
+            shortcodes[shortcode] = {'reply_deadline': deadline}
+        for shortcode, overrides in config.shortcodes.iteritems():
+            shortcode = config_key(shortcode)
+            check_overrides(shortcode, overrides)
+            shortcodes.setdefault(shortcode, {}).update(overrides)
+        if self.shortcodes_file is not None:
+            for shortcode, overrides in load_shortcodes_file(
+                    self.shortcodes_file).iteritems():
+                shortcodes[config_key(shortcode)] = overrides
+        return ResponseConfigIndex(default, shortcodes)
+
+    def reload_response_config(self):
+        """
+        Read the shortcodes file again. The new settings are used for
+        requests received from now on. If they are invalid, we keep the
+        current ones.
+        """
+        try:
+            response_config = self.load_response_config()
+        except (IOError, ValueError) as e:
+            log.warning('Not reloading shortcode settings: %s' % (e,))
+            return False
+        self.response_config = response_config
+        log.info('Reloaded shortcode settings from %s.' % (
+            self.shortcodes_file,))
+        return True
+
+    def handle_sighup(self, signum, frame):
+        reactor.callFromThread(self.reload_response_config)
+
+    def handle_drain_signal(self, signum, frame):
+        reactor.callFromThread(self.start_drain)
+
+    def start_drain(self):
+        """
+        Stop taking new sessions, and wait for the open requests to be
+        finished. Returns a Deferred that fires once none are open.
+        """
+        if not self.draining:
+            log.info('Draining: turning away new sessions and waiting for '
+                     '%d open requests.' % (len(self._requests),))
+            self.draining = True
+        d = Deferred()
+        self.drain_waiters.append(d)
+        self.check_drained()
+        return d
+
+    def check_drained(self):
+        if not self.draining or self._requests:
+            return
+        if not self.drained:
+            self.drained = True
+            log.info('Drained, no requests are open.')
+            if self.session_snapshot_file is not None:
+                self.save_sessions()
+        waiters, self.drain_waiters = self.drain_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def save_sessions(self):
+        try:
+            saved = self.sessions.save(self.session_snapshot_file)
+        except (IOError, OSError) as e:
+            log.warning('Failed to save sessions to %s: %s' % (
+                self.session_snapshot_file, e))
+        else:
+            log.info('Saved %d sessions to %s.' % (
+                saved, self.session_snapshot_file))
+
+    def restore_sessions(self):
+        if not os.path.exists(self.session_snapshot_file):
+            return
+        try:
+            self.restored_sessions = self.sessions.load(
+                self.session_snapshot_file)
+        except (IOError, ValueError) as e:
+            log.warning('Failed to load sessions from %s: %s' % (
+                self.session_snapshot_file, e))
+        else:
+            log.info('Loaded %d sessions from %s.' % (
+                self.restored_sessions, self.session_snapshot_file))
+
+    def expire_state(self):
+        self.sessions.expire()
+        self.expired_requests.expire()
+        if self.msisdn_limiter is not None:
+            self.msisdn_limiter.expire()
+        if self.shortcode_limiter is not None:
+            self.shortcode_limiter.expire()
+        if self.dedupe is not None:
+            self.dedupe.expire()
+
+    def get_stats(self):
+        return {
+            'pending_requests': len(self._requests),
+            'oldest_pending_request_age': self.get_oldest_request_age(),
+            'evicted_requests': self.evicted_requests,
+            'orphaned_replies': dict(self.orphaned_replies),
+            'sessions': self.sessions.get_stats(),
+            'restored_sessions': self.restored_sessions,
+            'draining': self.draining,
+            'latency': self.latency.get_stats(),
+            'deadline_replies': self.deadline_replies,
+            'coalesced_replies': dict(self.coalesced_replies),
+            'forwarded_replies': self.forwarded_replies,
+            'rejections': self.validator.get_stats(),
+            'events': self.outbox.get_stats(),
+            'shed_requests': dict(self.shed_requests),
+            'reply_cache': self.reply_cache.get_stats(),
+            'dedupe': (
+                self.dedupe.get_stats() if self.dedupe is not None else None),
+        }
+
+    def get_health_response(self):
+        return json.dumps(self.get_stats())
+
+    def get_status(self):
+        """
+        Live stats that are cheap to collect, for monitoring. Rates and
+        latencies cover the last ``status_window`` seconds.
+        """
+        return {
+            'open_requests': len(self._requests),
+            'oldest_request_age': self.get_oldest_request_age(),
+            'sessions': len(self.sessions),
+            'draining': self.draining,
+            'window': self.status_window,
+            'requests_per_second': self.recent_requests.get_rate(),
+            'replies': self.recent_replies.get_stats(),
+        }
+
+    def get_status_response(self):
+        return json.dumps(self.get_status())
+
+    def record_response_time(self, time):
+        self.latency.record('round_trip', time)
+        self.recent_replies.record(time)
+
+    def on_good_response_time(self, message_id, time):
+        self.record_response_time(time)
+
+    def on_degraded_response_time(self, message_id, time):
+        self.record_response_time(time)
+
+    def on_down_response_time(self, message_id, time):
+        self.record_response_time(time)
+
+    def set_request_context(self, request_id, context):
+        if request_id in self._requests:
+            self._requests[request_id]['context'] = context
 
-        root = ElementTree.fromstring(req_content)
-        for subel in root:
-            if subel.text is not None:
-                req_data[subel.tag] = subel.text
+    def get_request_context(self, request_id):
+        request_data = self._requests.get(request_id)
+        if request_data is not None:
+            return request_data.get('context')
 
-        return req_data
+    def set_request(self, request_id, request_object, timestamp=None):
+        if len(self._requests) >= self.max_pending_requests:
+            self.evict_oldest_request()
+        super(BlastSMSUssdTransport, self).set_request(
+            request_id, request_object, timestamp)
+
+    def get_oldest_request_age(self):
+        for request_data in self._requests.itervalues():
+            return self.clock.seconds() - request_data['timestamp']
+        return None
+
+    def evict_oldest_request(self):
+        """
+        End the oldest open request to make room for a new one.
+        """
+        request_id = next(iter(self._requests))
+        self.evicted_requests += 1
+        log.warning(
+            'Too many open requests, ending the request from %s.' % (
+                self.get_request_to_addr(request_id),))
+        self.expired_requests.set(request_id, 'evicted')
+        context = self.get_request_context(request_id)
+        if context is None:
+            self.close_request(request_id)
+        else:
+            self.sessions.close(context.sessionid, 'request_evicted')
+            self.finish_request(request_id, self.generate_body(
+                context.msisdn, context.sessionid, context.appid, request_id,
+                context.settings.deadline_message,
+                TransportUserMessage.SESSION_CLOSE, context.settings))
+        if request_id in self._requests:
+            # Finishing it failed, but we need the room regardless.
+            self.remove_request(request_id)
+
+    def manually_close_requests(self):
+        """
+        Time out requests that have been open for longer than
+        `request_timeout`. Requests are kept in the order they arrived, so
+        we stop looking at the first one that hasn't timed out.
+        """
+        now = self.clock.seconds()
+        timed_out = []
+        for request_id, request_data in self._requests.iteritems():
+            response_time = now - request_data['timestamp']
+            if response_time <= self.request_timeout:
+                break
+            timed_out.append((request_id, response_time))
+        for request_id, response_time in timed_out:
+            self.on_timeout(request_id, response_time)
+            self.close_request(request_id)
+
+    def count_orphaned_reply(self, reason):
+        self.orphaned_replies[reason] = (
+            self.orphaned_replies.get(reason, 0) + 1)
+
+    def nack_orphaned_reply(self, request_id, message_id):
+        """Nack a reply to a request we've stopped waiting for."""
+        reason = self.expired_requests.get(request_id)
+        if reason is not None:
+            self.count_orphaned_reply(reason)
+            self.queue_nack(message_id, self.EXPIRY_NACK_REASONS[reason])
+        else:
+            self.count_orphaned_reply('unknown')
+            self.queue_nack(message_id, self.RESPONSE_FAILURE_ERROR)
+
+    def finish_request(self, request_id, data, code=200, headers={}):
+        context = self.get_request_context(request_id)
+        if (context is not None and context.step is not None and
+                self.journeys is not None):
+            self.journeys.record_step(
+                context.shortcode, context.step,
+                self.clock.seconds() - context.received_at)
+            context.step = None
+        if context is not None and context.dedupe_key is not None:
+            # Retries of this request get the same reply.
+            waiting = self.dedupe.complete(
+                context.dedupe_key, request_id, (data, code))
+            context.dedupe_key = None
+            for waiting_id in waiting:
+                super(BlastSMSUssdTransport, self).finish_request(
+                    waiting_id, data, code=code, headers=headers)
+        return super(BlastSMSUssdTransport, self).finish_request(
+            request_id, data, code=code, headers=headers)
+
+    def forget_request(self, request_id):
+        """
+        Stop treating requests like ``request_id`` as retries, because it
+        went away without a reply.
+        """
+        context = self.get_request_context(request_id)
+        if context is not None and context.dedupe_key is not None:
+            self.dedupe.discard(context.dedupe_key, request_id)
+            context.dedupe_key = None
+
+    def close_request(self, request_id):
+        # The timeout response isn't a reply retries should get.
+        self.forget_request(request_id)
+        super(BlastSMSUssdTransport, self).close_request(request_id)
+
+    def remove_request(self, request_id):
+        self.cancel_reply_deadline(request_id)
+        self.drop_coalesced(request_id)
+        self.forget_request(request_id)
+        super(BlastSMSUssdTransport, self).remove_request(request_id)
+        self.check_drained()
+
+    def handle_retry(self, message_id, dedupe_key):
+        """
+        Answer a request if it is a retry of a recent one. Returns ``True``
+        if it was.
+        """
+        seen = self.dedupe.lookup(dedupe_key)
+        if seen is None:
+            return False
+        if seen.response is not None:
+            body, code = seen.response
+            self.finish_request(message_id, body, code=code)
+        else:
+            seen.waiting.append(message_id)
+        return True
+
+    def start_reply_deadline(self, request_id, context):
+        deadline = context.settings.reply_deadline
+        if deadline is not None:
+            context.deadline_call = self.clock.callLater(
+                deadline, self.miss_reply_deadline, request_id)
+
+    def cancel_reply_deadline(self, request_id):
+        context = self.get_request_context(request_id)
+        if context is not None and context.deadline_call is not None:
+            if context.deadline_call.active():
+                context.deadline_call.cancel()
+            context.deadline_call = None
+
+    def miss_reply_deadline(self, request_id):
+        """
+        End the session on the application's behalf because it didn't
+        reply in time.
+        """
+        context = self.get_request_context(request_id)
+        if context is None:
+            return
+        context.deadline_call = None
+        if context.coalesced:
+            # The application has replied, it just isn't done yet.
+            self.flush_coalesced(request_id)
+            return
+        log.warning(
+            'Application missed the reply deadline for %s, ending the '
+            'session.' % (self.get_request_to_addr(request_id),))
+        self.sessions.close(context.sessionid, 'deadline')
+        self.expired_requests.set(request_id, 'deadline_exceeded')
+        self.deadline_replies += 1
+        self.finish_request(request_id, self.generate_body(
+            context.msisdn, context.sessionid, context.appid, request_id,
+            context.settings.deadline_message,
+            TransportUserMessage.SESSION_CLOSE, context.settings))
+
+    def get_reply_route_key(self, route):
+        return '%s.outbound.%s' % (self.transport_name, route)
+
+    def get_reply_route(self, message):
+        """
+        Return the route of the transport process holding the request
+        ``message`` is a reply to, or ``None`` if it isn't known.
+        """
+        if self.reply_routing:
+            return message['transport_metadata'].get('reply_route')
 
     @inlineCallbacks
+    def forward_reply(self, route, message):
+        """
+        Send a reply to the transport process holding the request it is
+        for. Returns ``False`` if we are forwarding to too many processes
+        already or the reply couldn't be published.
+        """
+        publisher = self.reply_route_publishers.get(route)
+        if publisher is None:
+            if len(self.reply_route_publishers) >= self.MAX_REPLY_ROUTES:
+                returnValue(False)
+            publisher = yield self.publish_to(self.get_reply_route_key(route))
+            publisher = self.reply_route_publishers.setdefault(
+                route, publisher)
+        try:
+            yield publisher.publish_message(message)
+        except Exception as e:
+            log.warning('Could not forward reply %s to %s: %s' % (
+                message['message_id'], route, e))
+            returnValue(False)
+        self.forwarded_replies += 1
+        returnValue(True)
+
+    def get_request_data_dict(self, request):
+        if self._validation_mode == self.PERMISSIVE_MODE:
+            # Nothing after the fields we know about can affect the request.
+            stop_fields = self.validator.known_fields
+        else:
+            # Strict validation has to see every field to report unexpected
+            # ones.
+            stop_fields = None
+
+        return self.codec.decode_request(
+            request.content, self.max_request_size, stop_fields)
+
+    def get_field_values(self, request_data):
+        """
+        Decode the fields of a valid request. Optional fields that are
+        missing are ``None``.
+        """
+        values = dict.fromkeys(self.OPTIONAL_FIELDS)
+        for field in self.validator.known_fields:
+            if field in request_data:
+                values[field] = request_data[field].decode(self.ENCODING)
+        return values
+
     def handle_raw_inbound_message(self, message_id, request):
-        request_data = self.get_request_data_dict(request)
+        """
+        Decode and validate a request. Invalid requests are rejected before
+        we do anything else with them.
+        """
+        received_at = self.clock.seconds()
+        self.recent_requests.add()
+        try:
+            request_data = self.get_request_data_dict(request)
+        except DecodeError as e:
+            if isinstance(e, RequestTooLarge):
+                code = http.REQUEST_ENTITY_TOO_LARGE
+            else:
+                code = http.BAD_REQUEST
+            self.validator.count_rejection(e.reason)
+            self.message_log.rejected(e.reason, e.detail)
+            self.finish_request(
+                message_id, json.dumps({e.reason: e.detail}), code=code)
+            return
 
-        values, errors = self.get_field_values(
-            request_data,
-            self.EXPECTED_FIELDS,
-            self.OPTIONAL_FIELDS,  # pass this in for error checking
-        )
+        error_body = self.validator.validate(request_data)
+        if error_body is not None:
+            self.message_log.rejected('invalid_fields', error_body)
+            self.finish_request(
+                message_id, error_body, code=http.BAD_REQUEST)
+            return
 
-        optional_values = self.get_optional_field_values(
-            request_data,
-            self.OPTIONAL_FIELDS
-        )
+        values = self.get_field_values(request_data)
+        dedupe_key = None
+        if self.dedupe is not None:
+            dedupe_key = (values['sessionid'], values['type'], values['msg'])
+            if self.handle_retry(message_id, dedupe_key):
+                return
 
-        if errors:
-            log.info('Unhappy incoming message: %s ' % (errors,))
-            yield self.finish_request(
-                message_id, json.dumps(errors), code=http.BAD_REQUEST
-            )
+        reason = self.get_shed_reason(values)
+        if reason is not None:
+            self.shed_request(message_id, values, reason)
             return
 
-        if values['type'] == self.REQUEST_TYPE['response']:  # resume session
+        return self.handle_inbound_request(
+            message_id, values, received_at, dedupe_key)
+
+    def get_shed_reason(self, values):
+        """
+        Check the rate limits for a request. Returns ``None`` if the request
+        is allowed and the name of the limit it exceeds otherwise.
+
+        The ends of sessions are always allowed. So are requests in
+        existing sessions unless the msisdn or the transport is over its
+        limit, so that sessions aren't cut short by busy shortcodes. New
+        sessions are turned away while draining, including those started by
+        requests of unknown types, which we treat as new sessions.
+        """
+        request_type = values['type']
+        if request_type in (self.REQUEST_TYPE['release'],
+                            self.REQUEST_TYPE['timeout']):
+            return None
+        if self.draining and request_type != self.REQUEST_TYPE['response']:
+            return 'draining'
+        # The request being checked is already open.
+        if (self.max_open_requests is not None and
+                len(self._requests) > self.max_open_requests):
+            return 'open_requests'
+        if (self.msisdn_limiter is not None and
+                not self.msisdn_limiter.allow(values['msisdn'])):
+            return 'msisdn_rate'
+        if (self.shortcode_limiter is not None and
+                request_type != self.REQUEST_TYPE['response'] and
+                not self.shortcode_limiter.allow(values['shortcode'])):
+            return 'shortcode_rate'
+        return None
+
+    def shed_request(self, message_id, values, reason):
+        """
+        End the session with the busy message instead of passing the
+        request on to the application.
+        """
+        self.shed_requests[reason] = self.shed_requests.get(reason, 0) + 1
+        settings = self.response_config.lookup(
+            values['shortcode'], values['appid'])
+        appid = values['appid']
+        if appid is None:
+            appid = settings.app_id
+        self.sessions.close(values['sessionid'], 'busy')
+        self.finish_request(message_id, self.generate_body(
+            values['msisdn'], values['sessionid'], appid, message_id,
+            settings.busy_message, TransportUserMessage.SESSION_CLOSE,
+            settings))
+
+    @inlineCallbacks
+    def handle_inbound_request(self, message_id, values, received_at,
+                               dedupe_key=None):
+        appid = values['appid']
+        settings = self.response_config.lookup(values['shortcode'], appid)
+        if appid is None:
+            appid = settings.app_id
+        context = InboundContext(
+            values['msisdn'], values['sessionid'], appid, settings,
+            received_at, values['shortcode'])
+        self.set_request_context(message_id, context)
+        if dedupe_key is not None:
+            self.dedupe.add(dedupe_key, message_id)
+            context.dedupe_key = dedupe_key
+
+        request_type = values['type']
+        if request_type == self.REQUEST_TYPE['response']:  # resume session
             session_event = TransportUserMessage.SESSION_RESUME
-        elif values['type'] == self.REQUEST_TYPE['request']:  # new session
-            session_event = TransportUserMessage.SESSION_NEW
-        else:
-            # TODO #4: handle self.REQUEST_TYPE['release'] and
-            # self.REQUEST_TYPE['timeout'].
-            # Default to new session for now.
+            session = self.sessions.resume(
+                values['sessionid'], values['msisdn'], values['shortcode'])
+            context.step = session.steps
+        elif request_type in (self.REQUEST_TYPE['release'],
+                              self.REQUEST_TYPE['timeout']):
+            session_event = TransportUserMessage.SESSION_CLOSE
+            if request_type == self.REQUEST_TYPE['release']:
+                self.sessions.close(values['sessionid'], 'user_release')
+            else:
+                self.sessions.close(values['sessionid'], 'user_timeout')
+            # BlastSMS doesn't expect any content in reply to the end of a
+            # session so we don't wait for the application.
+            self.finish_request(message_id, self.generate_body(
+                values['msisdn'], values['sessionid'], appid, message_id,
+                settings.close_message, session_event, settings))
+        else:  # new session
             session_event = TransportUserMessage.SESSION_NEW
+            session = self.sessions.open(
+                values['sessionid'], values['msisdn'], values['shortcode'])
+            context.step = session.steps
 
-        if optional_values['msg'] is not None:
-            content = optional_values['msg']
+        if session_event != TransportUserMessage.SESSION_CLOSE:
+            self.start_reply_deadline(message_id, context)
+
+        if values['msg'] is not None:
+            content = values['msg']
         else:
             content = None
 
-        log.info(
-            'BlastSMSUssdTransport receiving inbound message from %s to '
-            '%s.' % (values['msisdn'], values['shortcode']))
+        self.message_log.inbound(
+            values['msisdn'], values['shortcode'], values['sessionid'])
 
+        publish_start = self.clock.seconds()
+        self.latency.record('parse', publish_start - received_at)
         yield self.publish_message(
             message_id=message_id,
             content=content,
@@ -132,47 +1227,37 @@ class BlastSMSUssdTransport(HttpRpcTransport):
             session_event=session_event,
             transport_type=self.TRANSPORT_TYPE,
             transport_name=self.TRANSPORT_NAME,
-            transport_metadata={
-                'sessionid': values['sessionid'],
-                'appid': optional_values['appid'],
-            },
+            transport_metadata=self.get_transport_metadata(values),
         )
+        context.published_at = self.clock.seconds()
+        self.latency.record('publish', context.published_at - publish_start)
 
-    def generate_body(self, msisdn, sessionid, appid, in_reply_to,
-                      reply_content, session_event):
-
-        e_ussdresp = Element('ussdresp')
-
-        se_msisdn = SubElement(e_ussdresp, 'msisdn')
-        se_msisdn.text = msisdn
+    def get_transport_metadata(self, values):
+        transport_metadata = {
+            'sessionid': values['sessionid'],
+            'appid': values['appid'],
+        }
+        if self.reply_routing:
+            transport_metadata['reply_route'] = self.reply_route
+        return transport_metadata
 
-        se_sessionid = SubElement(e_ussdresp, 'sessionid')
-        se_sessionid.text = sessionid
+    def generate_body(self, msisdn, sessionid, appid, in_reply_to,
+                      reply_content, session_event, settings=None):
 
-        se_appid = SubElement(e_ussdresp, 'appid')
-        if appid is not None:
-            se_appid.text = appid
-        else:
-            config = self.get_static_config()
-            if config.app_id:
-                se_appid.text = config.app_id
-            else:
-                se_appid.text = None
+        if settings is None:
+            settings = self.response_config.default
+        if appid is None:
+            appid = settings.app_id
 
         # Set request type
-        se_type = SubElement(e_ussdresp, 'type')
         if session_event != TransportUserMessage.SESSION_CLOSE:
-            se_type.text = self.REQUEST_TYPE['response']
+            request_type = self.REQUEST_TYPE['response']
         else:
-            se_type.text = self.REQUEST_TYPE['release']
-
-        se_msg = SubElement(e_ussdresp, 'msg')
-        se_msg.text = reply_content
+            request_type = self.REQUEST_TYPE['release']
 
-        return minidom.parseString(tostring(
-            e_ussdresp,
-            encoding='utf-8',
-        )).toxml(encoding="utf-8")
+        return self.reply_cache.encode(
+            msisdn, sessionid, appid, request_type, reply_content,
+            settings.encoding, settings.max_reply_length)
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
@@ -180,40 +1265,135 @@ class BlastSMSUssdTransport(HttpRpcTransport):
         # Errors
         message_id = message['message_id']
         if not message['content']:
-            yield self.publish_nack(message_id, self.NO_CONTENT_ERROR)
+            self.queue_nack(message_id, self.NO_CONTENT_ERROR)
             return
         if not message['in_reply_to']:
-            yield self.publish_nack(message_id, self.NOT_REPLY_ERROR)
+            self.queue_nack(message_id, self.NOT_REPLY_ERROR)
             return
 
+        # Everything we need to reply comes from the inbound request rather
+        # than from the (application supplied) transport metadata.
+        context = self.get_request_context(message['in_reply_to'])
+        if context is None:
+            route = self.get_reply_route(message)
+            if route is not None and route != self.reply_route:
+                # Another transport process is holding the request.
+                forwarded = yield self.forward_reply(route, message)
+                if forwarded:
+                    return
+            # The request has already been responded to or has timed out.
+            self.nack_orphaned_reply(message['in_reply_to'], message_id)
+            return
+
+        if context.published_at is not None and context.coalesced is None:
+            self.latency.record(
+                'app', self.clock.seconds() - context.published_at)
+
+        if self.coalesce_window is not None:
+            self.coalesce_reply(message['in_reply_to'], context, message)
+            return
+        self.send_reply(
+            message['in_reply_to'], context, [message_id],
+            message['content'], message['session_event'])
+
+    def send_reply(self, request_id, context, message_ids, content,
+                   session_event):
+        """
+        Finish a request with a reply, and ack or nack the outbound
+        messages it was made from.
+        """
+        generate_start = self.clock.seconds()
+
         # Generate outbound message
-        body = self.generate_body(
-            message['to_addr'],  # msisdn
-            message['transport_metadata']['sessionid'],  # sessionid
-            message['transport_metadata']['appid'],  # appid
-            message['in_reply_to'],
-            message['content'],
-            message['session_event']
-        )
-        log.info('BlastSMSUssdTransport outbound message with content: %r'
-                 % (body,))
+        try:
+            body = self.generate_body(
+                context.msisdn,
+                context.sessionid,
+                context.appid,
+                request_id,
+                content,
+                session_event,
+                context.settings,
+            )
+        except EncodeError as e:
+            # The link would reject the reply, so we leave the request
+            # open for the application to try again.
+            for message_id in message_ids:
+                self.queue_nack(
+                    message_id, '%s %s' % (self.ENCODING_ERROR, e))
+            return
+        self.latency.record('generate', self.clock.seconds() - generate_start)
+
+        if session_event == TransportUserMessage.SESSION_CLOSE:
+            self.sessions.close(context.sessionid, 'app_close')
+        self.message_log.outbound(context.msisdn, context.sessionid, body)
 
         # Finish Request
-        response_id = self.finish_request(
-            message['in_reply_to'],
-            body,
-        )
+        response_id = self.finish_request(request_id, body)
 
         # Response failure
         if response_id is None:
-            # we don't yield on this publish because if a message store is
-            # used, that causes the worker to wait for Riak before processing
-            # the message and responding to USSD messages is time critical.
-            self.publish_nack(message_id, self.RESPONSE_FAILURE_ERROR)
+            for message_id in message_ids:
+                self.count_orphaned_reply('finish_failed')
+                self.queue_nack(message_id, self.RESPONSE_FAILURE_ERROR)
+            return
+
+        for message_id in message_ids:
+            self.queue_ack(message_id)
+
+    def coalesce_reply(self, request_id, context, message):
+        """
+        Hold on to a reply for `coalesce_window` seconds, in case the
+        application sends more replies to the same request. A reply that
+        ends the session is sent straight away, along with those before it.
+        """
+        if context.coalesced is None:
+            context.coalesced = []
+            context.coalesce_call = self.clock.callLater(
+                self.coalesce_window, self.flush_coalesced, request_id)
+        context.coalesced.append(message)
+        if message['session_event'] == TransportUserMessage.SESSION_CLOSE:
+            self.flush_coalesced(request_id)
+
+    def flush_coalesced(self, request_id):
+        """Send the replies held for a request as a single reply."""
+        context = self.get_request_context(request_id)
+        if context is None or not context.coalesced:
             return
+        self.cancel_coalescing(request_id)
+        messages, context.coalesced = context.coalesced, None
+        content = self.coalesce_separator.join(
+            message['content'] for message in messages)
+        session_event = messages[-1]['session_event']
+        if len(messages) > 1:
+            self.coalesced_replies['merged'] += 1
+            self.coalesced_replies['messages'] += len(messages)
+            settings = context.settings
+            if (settings.max_reply_length is not None and
+                    settings.encoding.length(content) >
+                    settings.max_reply_length):
+                self.coalesced_replies['truncated'] += 1
+        self.send_reply(
+            request_id, context,
+            [message['message_id'] for message in messages], content,
+            session_event)
 
-        # we don't yield on this publish because if a message store is
-        # used, that causes the worker to wait for Riak before processing
-        # the message and responding to USSD messages is time critical.
-        self.publish_ack(
-            user_message_id=message_id, sent_message_id=message_id)
+    def cancel_coalescing(self, request_id):
+        context = self.get_request_context(request_id)
+        if context is not None and context.coalesce_call is not None:
+            if context.coalesce_call.active():
+                context.coalesce_call.cancel()
+            context.coalesce_call = None
+
+    def drop_coalesced(self, request_id):
+        """
+        Nack the replies held for a request that was finished without
+        them.
+        """
+        self.cancel_coalescing(request_id)
+        context = self.get_request_context(request_id)
+        if context is None or not context.coalesced:
+            return
+        messages, context.coalesced = context.coalesced, None
+        for message in messages:
+            self.nack_orphaned_reply(request_id, message['message_id'])
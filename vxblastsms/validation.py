@@ -0,0 +1,73 @@
+"""Validation of decoded BlastSMS requests."""
+import json
+
+
+class RequestValidator(object):
+    """
+    Checks the fields of decoded requests.
+
+    The field sets are built once, and the bodies of the error responses
+    are rendered once per combination of missing and unexpected fields, so
+    rejecting a request costs a couple of set operations and a dict
+    lookup.
+
+    :param expected_fields:
+        Fields every request must have.
+    :param optional_fields:
+        Fields requests may have.
+    :param bool strict:
+        Reject requests with fields that are neither expected nor optional.
+    :param int max_error_bodies:
+        Maximum number of rendered error bodies to keep. Requests with
+        other combinations of fields have their error bodies rendered each
+        time.
+    """
+
+    def __init__(self, expected_fields, optional_fields, strict=True,
+                 max_error_bodies=1000):
+        self.expected_fields = frozenset(expected_fields)
+        self.known_fields = self.expected_fields | frozenset(optional_fields)
+        self.strict = strict
+        self.max_error_bodies = max_error_bodies
+        self._error_bodies = {}
+        self.rejections = {}
+
+    def count_rejection(self, reason):
+        self.rejections[reason] = self.rejections.get(reason, 0) + 1
+
+    def validate(self, request_data):
+        """
+        Check the fields in the ``request_data`` dict. Returns ``None`` if
+        they're valid and the JSON body for the error response otherwise.
+        """
+        missing = self.expected_fields.difference(request_data)
+        if self.strict:
+            unexpected = request_data.viewkeys() - self.known_fields
+        else:
+            unexpected = None
+        if not missing and not unexpected:
+            return None
+
+        if missing:
+            self.count_rejection('missing_parameter')
+        if unexpected:
+            self.count_rejection('unexpected_parameter')
+
+        key = (missing, frozenset(unexpected or ()))
+        body = self._error_bodies.get(key)
+        if body is None:
+            body = self.render_errors(missing, unexpected)
+            if len(self._error_bodies) < self.max_error_bodies:
+                self._error_bodies[key] = body
+        return body
+
+    def render_errors(self, missing, unexpected):
+        errors = {}
+        if unexpected:
+            errors['unexpected_parameter'] = sorted(unexpected)
+        if missing:
+            errors['missing_parameter'] = sorted(missing)
+        return json.dumps(errors)
+
+    def get_stats(self):
+        return dict(self.rejections)